@@ -1,6 +1,5 @@
 from monai.transforms import (
     EnsureChannelFirstd,
-    Compose,
     Orientationd,
     LoadImaged,
     RandFlipd,
@@ -10,18 +9,52 @@ from monai.transforms import (
     RandRotate90d,
     CenterSpatialCropd,
     SpatialPadd,
-    Spacingd
+    Spacingd,
+    FgBgToIndicesd,
+    DeleteItemsd,
+    MapTransform,
+    Compose
 )
 
+import os
+
+import numpy as np
 import torch
-from monai.data import DataLoader,load_decathlon_datalist, CacheDataset, Dataset
+from monai.data import DataLoader,load_decathlon_datalist, CacheDataset, Dataset, PersistentDataset
+from transform_pipeline import TransformPipeline
+from patch_queue import PatchQueue
+from volume_store import RandChunkCropd, load_store
 
 
+FG_INDICES_KEY = "label_fg_indices"
+BG_INDICES_KEY = "label_bg_indices"
 
 
-def make_loaders(voxel_size=(1.5,1.5,1.5),image_size=(128,256, 256), patch_size=(96,96,96), samples=2, cache_rate=0,
-                 num_workers=4,dataset_path= './data_list_pyfile.json',seed=42):
-    train_transforms = Compose([
+class CompactIndicesd(MapTransform):
+    """
+    FgBgToIndicesdで求めた前景・背景のボクセルの番号をint32に変換し、max_indices個を超える場合は等間隔に間引く。
+    番号は昇順に並んでいるため、等間隔に間引いても切り出しの中心はボリューム全体にほぼ一様に分布する。
+    """
+
+    def __init__(self, keys, max_indices=None, allow_missing_keys=False):
+        super().__init__(keys, allow_missing_keys)
+        self.max_indices = max_indices
+
+    def __call__(self, data):
+        d = dict(data)
+        for key in self.key_iterator(d):
+            indices = d[key]
+            indices = indices.cpu().numpy() if isinstance(indices, torch.Tensor) else np.asarray(indices)
+            if self.max_indices and len(indices) > self.max_indices:
+                indices = indices[np.linspace(0, len(indices) - 1, self.max_indices).astype(np.int64)]
+            # 128x256x256のボリュームでもボクセルの番号はint32に収まる
+            d[key] = indices.astype(np.int32)
+        return d
+
+
+def make_transform_pipeline(voxel_size=(1.5,1.5,1.5),image_size=(128,256, 256), patch_size=(96,96,96), samples=2,
+                            max_indices=100000):
+    return TransformPipeline([
                                 LoadImaged(keys=["image", "label"]),
                                 EnsureChannelFirstd(keys=["image", "label"]), #<class 'monai.data.meta_tensor.MetaTensor'>
                                 ScaleIntensityRanged(keys=["image"],a_min=-175,a_max=250,b_min=0.0,b_max=1.0,clip=True),
@@ -29,6 +62,11 @@ def make_loaders(voxel_size=(1.5,1.5,1.5),image_size=(128,256, 256), patch_size=
                                 SpatialPadd(keys=["image", "label"], spatial_size=image_size),
                                 CenterSpatialCropd(keys=["image", "label"], roi_size=image_size),
                                 Orientationd(keys=["image", "label"], axcodes="RAS"),
+                                # 前景・背景のボクセルの番号をボリュームごとに1回だけ求め、前処理の結果と一緒にキャッシュする
+                                FgBgToIndicesd(keys="label", image_key="image", image_threshold=0,
+                                               fg_postfix="_fg_indices", bg_postfix="_bg_indices"),
+                                CompactIndicesd(keys=[FG_INDICES_KEY, BG_INDICES_KEY], max_indices=max_indices),
+                                # ここから先はランダムな変換（TransformPipelineがキャッシュの境界を自動的に判定する）
                                 RandCropByPosNegLabeld(
                                     keys=["image", "label"],
                                     label_key="label",
@@ -38,7 +76,12 @@ def make_loaders(voxel_size=(1.5,1.5,1.5),image_size=(128,256, 256), patch_size=
                                     num_samples=samples,
                                     image_key="image",
                                     image_threshold=0,
+                                    # 事前に求めた番号を使い、サンプルごとのラベル全体の走査を省く
+                                    fg_indices_key=FG_INDICES_KEY,
+                                    bg_indices_key=BG_INDICES_KEY,
                                 ),
+                                # 番号はパッチの切り出しにのみ使うため、以降の変換とDataLoaderには渡さない
+                                DeleteItemsd(keys=[FG_INDICES_KEY, BG_INDICES_KEY]),
                                 RandFlipd(
                                     keys=["image", "label"],
                                     spatial_axis=[0],
@@ -67,28 +110,54 @@ def make_loaders(voxel_size=(1.5,1.5,1.5),image_size=(128,256, 256), patch_size=
                             ]
                             )
                 #output:torch.Size([2, 1, 96, 96, 96])
-        
-    val_transforms = Compose(
-                    [
-                        LoadImaged(keys=["image", "label"]),
-                        EnsureChannelFirstd(keys=["image", "label"]),
-                        ScaleIntensityRanged(
-                            keys=["image"], a_min=-175, a_max=250, b_min=0.0, b_max=1.0, clip=True
-                        ),
-                        Spacingd(keys=["image", "label"],pixdim=voxel_size,mode=("trilinear", "nearest")),
-                        SpatialPadd(keys=["image", "label"], spatial_size=image_size),
-                        CenterSpatialCropd(keys=["image", "label"], roi_size=image_size),
-                        Orientationd(keys=["image", "label"], axcodes="RAS"),
-                    ]
-                )
+
+
+def make_loaders(voxel_size=(1.5,1.5,1.5),image_size=(128,256, 256), patch_size=(96,96,96), samples=2, cache_rate=0,
+                 num_workers=4,dataset_path= './data_list_pyfile.json',seed=42,cache_dir=None,max_indices=100000,
+                 patch_batch_size=None,patches_per_volume=16,pool_size=4,volume_store=None):
+    pipeline = make_transform_pipeline(voxel_size,image_size,patch_size,samples,max_indices)
+    patch_transforms = pipeline.random
+    # パッチキューを使う場合、学習データセットは決定的な前処理だけを行い、パッチの切り出しはPatchQueueが行う
+    train_transforms = pipeline.full if patch_batch_size is None else pipeline.deterministic
+    if volume_store is not None:
+        # volume_store.pyで変換済みの配列から、パッチに重なるチャンクだけを読み込む（NIfTIのデコードと決定的な前処理を省く）
+        patch_transforms = Compose(
+            [RandChunkCropd(keys=["image", "label"], spatial_size=patch_size, num_samples=samples, pos=1, neg=1)]
+            + [t for t in pipeline.random.transforms if not isinstance(t, (RandCropByPosNegLabeld, DeleteItemsd))]
+        )
+        train_transforms = patch_transforms if patch_batch_size is None else None
+    # 検証はランダムな変換の手前まで（学習と同じ決定的な前処理）を使う。切り出し用の番号は不要なため求めない
+    val_pipeline = TransformPipeline([t for t in pipeline.deterministic.transforms if not isinstance(t, (FgBgToIndicesd, CompactIndicesd))])
+    val_transforms = val_pipeline.full
 
     torch.manual_seed(seed)
     train_files = load_decathlon_datalist(dataset_path, True, "training")
     val_files = load_decathlon_datalist(dataset_path, True, "testing")
 
-    train_ds = CacheDataset(data=train_files, transform=train_transforms,cache_rate=cache_rate)
-    val_ds = Dataset(data=val_files, transform=val_transforms)
-    train_loader = DataLoader(train_ds, num_workers=num_workers, batch_size=1, shuffle=True)
+    if volume_store is not None:
+        # 前処理のパラメータが変換時と異なる場合はValueErrorになる
+        train_ds = Dataset(data=load_store(volume_store, pipeline.cache_key()), transform=train_transforms)
+    if cache_dir is not None:
+        # 最初のランダムな変換（RandCropByPosNegLabeld）の手前までの出力をディスクに保存し、2エポック目以降は再利用する
+        # キャッシュのファイル名は入力ファイルのパスのハッシュ、ディレクトリ名は決定的な変換のパラメータのハッシュで決まる
+        # 検証の前処理は切り出し用の番号を求めない分だけ学習と異なるため、検証の変換のハッシュで決まる別のディレクトリを使う
+        persistent_cache_dir = os.path.join(cache_dir,pipeline.cache_key())
+        val_cache_dir = os.path.join(cache_dir,"val",val_pipeline.cache_key())
+        print(f"cache boundary: {pipeline.describe()}")
+        if volume_store is None:
+            train_ds = PersistentDataset(data=train_files, transform=train_transforms, cache_dir=persistent_cache_dir)
+        val_ds = PersistentDataset(data=val_files, transform=val_transforms, cache_dir=val_cache_dir)
+    else:
+        if volume_store is None:
+            train_ds = CacheDataset(data=train_files, transform=train_transforms,cache_rate=cache_rate)
+        val_ds = Dataset(data=val_files, transform=val_transforms)
+    if patch_batch_size is None:
+        train_loader = DataLoader(train_ds, num_workers=num_workers, batch_size=1, shuffle=True)
+    else:
+        # ワーカーごとにpool_size個のボリュームを保持し、1つのボリュームからpatches_per_volume個のパッチを切り出す
+        # GPUのバッチサイズはnum_samplesではなくpatch_batch_sizeで決まる
+        train_ds = PatchQueue(train_ds, patch_transforms, patches_per_volume=patches_per_volume, pool_size=pool_size)
+        train_loader = DataLoader(train_ds, num_workers=num_workers, batch_size=patch_batch_size)
     val_loader = DataLoader(val_ds, num_workers=num_workers, batch_size=1)
     
     return train_ds, val_ds, train_loader, val_loader
\ No newline at end of file
@@ -0,0 +1,156 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+
+class PatchQueue(IterableDataset):
+    """
+    ワーカープロセスごとに読み込んだボリュームをpool_size個保持し、各ボリュームからpatches_per_volume個のパッチを
+    切り出して、シャッフルしたパッチを1つずつ返すデータセット。
+    ボリュームの読み込み（重い処理）1回あたりのパッチ数と、DataLoaderのbatch_size（GPUのバッチサイズ）を独立に決められる。
+
+    queue = PatchQueue(CacheDataset(train_files, pipeline.deterministic), pipeline.random, patches_per_volume=16)
+    loader = DataLoader(queue, batch_size=4, num_workers=4)
+    """
+
+    def __init__(self, volume_ds, patch_transform, patches_per_volume=16, pool_size=4, buffer_size=16, shuffle=True):
+        # volume_ds: 決定的な前処理を行うデータセット（Dataset、CacheDataset、PersistentDataset）
+        # patch_transform: パッチの切り出しとデータ拡張（TransformPipeline.random）
+        self.volume_ds = volume_ds
+        self.patch_transform = patch_transform
+        self.patches_per_volume = patches_per_volume
+        self.pool_size = pool_size
+        self.buffer_size = buffer_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        # 1エポックで返すパッチの数（DataLoaderのlenに使われる）
+        return len(self.volume_ds) * self.patches_per_volume
+
+    def _volume_order(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+            base_seed = int(torch.randint(2**31, ()).item())
+        else:
+            # 全ワーカーで同じ順序に並べ替えてから分担するため、ワーカー間で共通のシードを使う
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+            base_seed = worker_info.seed - worker_info.id
+        order = np.arange(len(self.volume_ds))
+        if self.shuffle:
+            np.random.default_rng(base_seed % 2**32).shuffle(order)
+        return order[worker_id::num_workers], np.random.default_rng((base_seed + worker_id) % 2**32)
+
+    def __iter__(self):
+        order, rng = self._volume_order()
+        order = iter(order)
+        pool = []  # [前処理済みのボリューム, 残りのパッチ数]のリスト
+        buffer = []  # 切り出したパッチのシャッフル用のバッファ
+
+        def load_next():
+            index = next(order, None)
+            return None if index is None else [self.volume_ds[int(index)], self.patches_per_volume]
+
+        while len(pool) < self.pool_size:
+            volume = load_next()
+            if volume is None:
+                break
+            pool.append(volume)
+
+        while pool:
+            slot = int(rng.integers(len(pool))) if self.shuffle else 0
+            volume, remaining = pool[slot]
+            patches = self.patch_transform(volume)  # RandCropByPosNegLabeldはnum_samples個のパッチのリストを返す
+            patches = [patches] if isinstance(patches, dict) else patches
+            patches = patches[:remaining]
+            pool[slot][1] = remaining - len(patches)
+            if pool[slot][1] <= 0:
+                # パッチを切り出し終えたボリュームを次のボリュームに入れ替える
+                volume = load_next()
+                if volume is None:
+                    pool.pop(slot)
+                else:
+                    pool[slot] = volume
+            buffer.extend(patches)
+            while len(buffer) > self.buffer_size:
+                yield self._pop(buffer, rng)
+        while buffer:
+            yield self._pop(buffer, rng)
+
+    def _pop(self, buffer, rng):
+        if self.shuffle:
+            i = int(rng.integers(len(buffer)))
+            buffer[i], buffer[-1] = buffer[-1], buffer[i]
+        return buffer.pop() if self.shuffle else buffer.pop(0)
+
+
+# 合成したNIfTIのボリューム（ノイズの画像と楕円体のラベル）を作成する関数
+def make_synthetic_volumes(out_dir, num_volumes, volume_shape, seed=42):
+    import nibabel as nib
+
+    rng = np.random.default_rng(seed)
+    z, y, x = np.ogrid[tuple(slice(0, s) for s in volume_shape)]
+    files = []
+    for i in range(num_volumes):
+        image = rng.normal(0, 100, size=volume_shape).astype(np.float32)
+        center = [rng.uniform(0.3, 0.7) * s for s in volume_shape]
+        radius = [rng.uniform(0.1, 0.2) * s for s in volume_shape]
+        distance = sum(((a - c) / r) ** 2 for a, c, r in zip((z, y, x), center, radius))
+        label = np.zeros(volume_shape, dtype=np.uint8)
+        label[distance < 1] = 1  # 腎臓
+        label[distance < 0.2] = 2  # 腫瘍
+        image[label > 0] += 150
+        files.append({"image": os.path.join(out_dir, f"image_{i}.nii.gz"), "label": os.path.join(out_dir, f"label_{i}.nii.gz")})
+        nib.save(nib.Nifti1Image(image, np.eye(4)), files[-1]["image"])
+        nib.save(nib.Nifti1Image(label, np.eye(4)), files[-1]["label"])
+    return files
+
+
+# DataLoaderを1エポック回し、パッチ数と経過時間を測る関数
+def measure(loader, num_epochs):
+    num_patches = 0
+    t0 = time.perf_counter()
+    for _ in range(num_epochs):
+        for batch in loader:
+            num_patches += batch["image"].shape[0]
+    return num_patches, time.perf_counter() - t0
+
+
+if __name__ == "__main__":
+    from monai.data import DataLoader, Dataset
+    from loaders import make_transform_pipeline
+
+    parser = argparse.ArgumentParser(description="patch queue throughput benchmark (CPU)")
+    parser.add_argument("--num_volumes", default=8, type=int, help="number of synthetic volumes")
+    parser.add_argument("--volume_shape", default=(96,192,192), type=int, nargs=3, help="shape of synthetic volumes")
+    parser.add_argument("--voxel_size", default=(1.5,1.5,1.5), type=float, nargs=3, help="voxel size")
+    parser.add_argument("--image_size", default=(64,128,128), type=int, nargs=3, help="image size")
+    parser.add_argument("--patch_size", default=(48,48,48), type=int, nargs=3, help="patch size")
+    parser.add_argument("--num_sumples", default=2, type=int, help="number of random crop")
+    parser.add_argument("--batch_size", default=4, type=int, help="patch batch size of patch queue")
+    parser.add_argument("--patches_per_volume", default=16, type=int, help="number of patches per loaded volume")
+    parser.add_argument("--pool_size", default=4, type=int, help="number of volumes kept in each worker")
+    parser.add_argument("--num_workers", default=2, type=int, help="number of workers")
+    parser.add_argument("--epochs", default=1, type=int, help="number of epochs to measure")
+    args = parser.parse_args()
+
+    torch.manual_seed(42)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files = make_synthetic_volumes(tmp_dir, args.num_volumes, tuple(args.volume_shape))
+        pipeline = make_transform_pipeline(tuple(args.voxel_size), tuple(args.image_size), tuple(args.patch_size), args.num_sumples)
+
+        # 従来の方法: ボリュームごとにbatch_size=1で読み込み、num_samples個のパッチを切り出す
+        baseline = DataLoader(Dataset(files, pipeline.full), batch_size=1, shuffle=True, num_workers=args.num_workers)
+        num_patches, seconds = measure(baseline, args.epochs)
+        print(f"volume loader: {num_patches / seconds:.1f} patches/s ({num_patches} patches, {seconds:.1f}s)")
+
+        # パッチキュー: 読み込んだボリュームからpatches_per_volume個のパッチを切り出し、batch_sizeごとにまとめる
+        queue = PatchQueue(Dataset(files, pipeline.deterministic), pipeline.random, args.patches_per_volume, args.pool_size)
+        queue_loader = DataLoader(queue, batch_size=args.batch_size, num_workers=args.num_workers)
+        num_patches, seconds = measure(queue_loader, args.epochs)
+        print(f"patch queue:   {num_patches / seconds:.1f} patches/s ({num_patches} patches, {seconds:.1f}s)")
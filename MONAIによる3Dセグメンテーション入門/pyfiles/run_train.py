@@ -33,6 +33,12 @@ if __name__ == "__main__":
     parser.add_argument("--parallel", action='store_true', help="multi gpu processing or not")
     parser.add_argument("--pretrain", action='store_true', help="use pretrained model")
     parser.add_argument("--cache_rate", default=0, type=float, help="cache rate for train dataset")
+    parser.add_argument("--cache_dir", default=None, type=str, help="directory for persistent cache of deterministic transforms")
+    parser.add_argument("--patch_batch_size", default=None, type=int, help="batch size of patch queue (None: one volume per batch)")
+    parser.add_argument("--patches_per_volume", default=16, type=int, help="number of patches sampled from each loaded volume in patch queue")
+    parser.add_argument("--pool_size", default=4, type=int, help="number of volumes kept in each worker of patch queue")
+    parser.add_argument("--volume_store", default=None, type=str, help="directory of chunked volumes converted by volume_store.py")
+    parser.add_argument("--max_indices", default=100000, type=int, help="max number of cached foreground/background indices per volume (0: keep all)")
     args = parser.parse_args()
 
 
@@ -41,7 +47,11 @@ if __name__ == "__main__":
     set_seed(args.seed)
     
     train_ds, val_ds, train_loader, val_loader = make_loaders(args.voxel_size,args.image_size,RAND_CROP_SIZE,args.num_sumples,args.cache_rate,
-                                                              args.num_workers,dataset_path=args.dataset_jsonpath,seed=args.seed)
+                                                              args.num_workers,dataset_path=args.dataset_jsonpath,seed=args.seed,
+                                                              cache_dir=args.cache_dir,max_indices=args.max_indices,
+                                                              patch_batch_size=args.patch_batch_size,
+                                                              patches_per_volume=args.patches_per_volume,pool_size=args.pool_size,
+                                                              volume_store=args.volume_store)
     
     
     MODEL = SwinUNETR(
@@ -72,7 +82,7 @@ if __name__ == "__main__":
                 "label_names":LABEL_NAMES,
 
                 # train settings
-                "train_batch_size": 1,
+                "train_batch_size": args.patch_batch_size or 1,
                 "val_batch_size": 1,
                 "lr": 1e-4,
                 "max_epochs": args.epochs,
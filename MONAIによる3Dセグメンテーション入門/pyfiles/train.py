@@ -134,7 +134,8 @@ class TrainLoop:
             del images, labels, logit
             torch.cuda.empty_cache()
         
-        mean_epoch_loss = epoch_loss / len(self.train_loader)
+        # PatchQueueではワーカーごとに端数のバッチができるため、lenではなく実際のバッチ数で割る
+        mean_epoch_loss = epoch_loss / (idx + 1)
 
         return mean_epoch_loss
    
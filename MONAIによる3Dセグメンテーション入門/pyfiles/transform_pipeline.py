@@ -0,0 +1,62 @@
+import hashlib
+import json
+
+import monai
+import numpy as np
+from monai.transforms import Compose, Randomizable, Transform
+
+
+# 変換のクラス名と、数値・文字列の属性（内部の変換の属性も含む）を辞書にまとめる関数
+def transform_signature(transform, depth=0):
+    signature = {"class": type(transform).__name__}
+    for name, value in sorted(vars(transform).items()):
+        if value is None or isinstance(value, (bool, int, float, str)):
+            signature[name] = value
+        elif isinstance(value, (tuple, list)) and all(isinstance(v, (bool, int, float, str)) for v in value):
+            signature[name] = list(value)
+        elif isinstance(value, np.ndarray) and value.size <= 16:
+            signature[name] = value.tolist()
+        elif isinstance(value, Transform) and depth < 2:
+            signature[name] = transform_signature(value, depth + 1)
+    return signature
+
+
+class TransformPipeline:
+    """
+    前処理とデータ拡張の変換を1つのリストで宣言し、最初のランダムな変換の位置で
+    決定的な部分（キャッシュできる部分）とランダムな部分に分ける。
+
+    pipeline = TransformPipeline([LoadImaged(...), ..., RandCropByPosNegLabeld(...), ...])
+    pipeline.full           # 学習用（すべての変換）
+    pipeline.deterministic  # 検証用、キャッシュの対象（最初のランダムな変換の手前まで）
+    pipeline.cache_key()    # 決定的な部分のパラメータのハッシュ
+    """
+
+    def __init__(self, transforms):
+        self.transforms = list(transforms)
+        # CacheDataset、PersistentDatasetと同じく、最初のRandomizableな変換の手前までをキャッシュの境界とする
+        self.cache_boundary = next(
+            (i for i, t in enumerate(self.transforms) if isinstance(t, Randomizable) or not isinstance(t, Transform)),
+            len(self.transforms),
+        )
+
+    @property
+    def full(self):
+        return Compose(self.transforms)
+
+    @property
+    def deterministic(self):
+        return Compose(self.transforms[: self.cache_boundary])
+
+    @property
+    def random(self):
+        return Compose(self.transforms[self.cache_boundary :])
+
+    def cache_key(self):
+        signatures = [transform_signature(t) for t in self.transforms[: self.cache_boundary]]
+        payload = json.dumps({"transforms": signatures, "monai_version": monai.__version__}, sort_keys=True, default=str)
+        return hashlib.md5(payload.encode()).hexdigest()[:16]
+
+    def describe(self):
+        names = [type(t).__name__ for t in self.transforms]
+        return " -> ".join(names[: self.cache_boundary]) + " | cache | " + " -> ".join(names[self.cache_boundary :])
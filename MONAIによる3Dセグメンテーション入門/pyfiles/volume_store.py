@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+from monai.transforms import MapTransform, Randomizable
+
+CHUNK_SIZE = (32,32,32)
+MANIFEST_NAME = "manifest.json"
+
+
+# (C, D, H, W)の配列をチャンクの順（nz, ny, nx, C, cz, cy, cx）に並べ替えて、非圧縮の.npyとして書き出す関数
+# 1つのチャンクがファイル上で連続するため、パッチに重なるチャンクだけをmemmapで読み込める
+def write_chunked(path, array, chunk_size=CHUNK_SIZE):
+    channels, spatial = array.shape[0], array.shape[1:]
+    grid = [-(-s // c) for s, c in zip(spatial, chunk_size)]
+    padded = np.zeros((channels, *[g * c for g, c in zip(grid, chunk_size)]), dtype=array.dtype)
+    padded[(slice(None), *[slice(0, s) for s in spatial])] = array
+    chunked = padded.reshape(channels, grid[0], chunk_size[0], grid[1], chunk_size[1], grid[2], chunk_size[2])
+    np.save(path, np.ascontiguousarray(chunked.transpose(1, 3, 5, 0, 2, 4, 6)))
+
+
+class ChunkedArray:
+    """
+    write_chunkedで書き出した配列を読み込むクラス。memmapはプロセスごとに最初の読み込み時に開くため、
+    DataLoaderのワーカーにはファイルのパスだけが渡される。
+    """
+
+    def __init__(self, path, shape, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.shape = tuple(shape)  # (C, D, H, W)
+        self.chunk_size = tuple(chunk_size)
+        self._memmap = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_memmap"] = None
+        return state
+
+    def read(self, start, size):
+        # start（D, H, Wの開始位置）からsizeの範囲に重なるチャンクだけを読み込み、(C, *size)の配列を返す
+        if self._memmap is None:
+            self._memmap = np.load(self.path, mmap_mode="r")
+        first = [s // c for s, c in zip(start, self.chunk_size)]
+        last = [(s + n - 1) // c + 1 for s, n, c in zip(start, size, self.chunk_size)]
+        block = np.asarray(self._memmap[first[0]:last[0], first[1]:last[1], first[2]:last[2]])
+        gz, gy, gx, channels = block.shape[:4]
+        cz, cy, cx = self.chunk_size
+        block = block.transpose(3, 0, 4, 1, 5, 2, 6).reshape(channels, gz * cz, gy * cy, gx * cx)
+        offset = [s - f * c for s, f, c in zip(start, first, self.chunk_size)]
+        return np.ascontiguousarray(block[(slice(None), *[slice(o, o + n) for o, n in zip(offset, size)])])
+
+
+# 決定的な前処理（TransformPipeline.deterministic）の出力をチャンク化した配列として保存し、manifest.jsonを書き出す関数
+def convert_volumes(files, pipeline, out_dir, chunk_size=CHUNK_SIZE):
+    from loaders import FG_INDICES_KEY, BG_INDICES_KEY
+
+    os.makedirs(out_dir, exist_ok=True)
+    transform = pipeline.deterministic
+    volumes = []
+    for i, item in enumerate(files):
+        d = transform(item)
+        image = np.asarray(d["image"], dtype=np.float32)
+        label = np.asarray(d["label"], dtype=np.uint8)
+        name = f"{i:05d}"
+        entry = {
+            "source": item["image"],
+            "shape": list(image.shape),
+            "image": f"{name}_image.npy",
+            "label": f"{name}_label.npy",
+            "fg_indices": f"{name}_fg_indices.npy",
+            "bg_indices": f"{name}_bg_indices.npy",
+        }
+        write_chunked(os.path.join(out_dir, entry["image"]), image, chunk_size)
+        write_chunked(os.path.join(out_dir, entry["label"]), label, chunk_size)
+        np.save(os.path.join(out_dir, entry["fg_indices"]), np.asarray(d[FG_INDICES_KEY], dtype=np.int32))
+        np.save(os.path.join(out_dir, entry["bg_indices"]), np.asarray(d[BG_INDICES_KEY], dtype=np.int32))
+        volumes.append(entry)
+        print(f"[{i + 1}/{len(files)}] {item['image']} -> {entry['image']} {tuple(image.shape)}")
+    manifest = {"cache_key": pipeline.cache_key(), "chunk_size": list(chunk_size), "volumes": volumes}
+    with open(os.path.join(out_dir, MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+# manifest.jsonを読み込み、RandChunkCropdに渡すデータのリストを返す関数
+def load_store(store_dir, cache_key=None):
+    with open(os.path.join(store_dir, MANIFEST_NAME), encoding="utf-8") as f:
+        manifest = json.load(f)
+    if cache_key is not None and manifest["cache_key"] != cache_key:
+        raise ValueError(
+            f"{store_dir} was converted with different preprocessing (cache key {manifest['cache_key']} != {cache_key}). "
+            "Run volume_store.py again."
+        )
+    data = []
+    for entry in manifest["volumes"]:
+        label_shape = [1] + entry["shape"][1:]
+        data.append({
+            "image": ChunkedArray(os.path.join(store_dir, entry["image"]), entry["shape"], manifest["chunk_size"]),
+            "label": ChunkedArray(os.path.join(store_dir, entry["label"]), label_shape, manifest["chunk_size"]),
+            "fg_indices": os.path.join(store_dir, entry["fg_indices"]),
+            "bg_indices": os.path.join(store_dir, entry["bg_indices"]),
+        })
+    return data
+
+
+class RandChunkCropd(Randomizable, MapTransform):
+    """
+    RandCropByPosNegLabeldと同じく前景・背景の比率pos:negで中心を選び、ChunkedArrayからパッチに重なるチャンクだけを読み込む。
+    num_samples個の{"image", "label"}の辞書のリストを返す。
+    """
+
+    def __init__(self, keys, spatial_size, num_samples=1, pos=1, neg=1):
+        MapTransform.__init__(self, keys)
+        self.spatial_size = tuple(spatial_size)
+        self.num_samples = num_samples
+        self.pos_ratio = pos / (pos + neg)
+
+    def randomize(self, data):
+        shape = data[self.keys[0]].shape[1:]
+        fg_indices = np.load(data["fg_indices"], mmap_mode="r")
+        bg_indices = np.load(data["bg_indices"], mmap_mode="r")
+        starts = []
+        for _ in range(self.num_samples):
+            indices = fg_indices if (self.R.rand() < self.pos_ratio and len(fg_indices)) or not len(bg_indices) else bg_indices
+            if len(indices):
+                center = np.unravel_index(int(indices[self.R.randint(len(indices))]), shape)
+            else:
+                center = [self.R.randint(s) for s in shape]
+            # パッチがボリュームからはみ出さないように開始位置を調整する
+            starts.append([int(np.clip(c - n // 2, 0, s - n)) for c, n, s in zip(center, self.spatial_size, shape)])
+        return starts
+
+    def __call__(self, data):
+        return [
+            {key: torch.as_tensor(data[key].read(start, self.spatial_size)) for key in self.keys}
+            for start in self.randomize(data)
+        ]
+
+
+if __name__ == "__main__":
+    from monai.data import load_decathlon_datalist
+    from loaders import make_transform_pipeline
+
+    parser = argparse.ArgumentParser(description="convert preprocessed training volumes to chunked memmap arrays")
+    parser.add_argument("--dataset_jsonpath", default="./data_list_pyfile.json", type=str, help="dataset json path")
+    parser.add_argument("--out_dir", required=True, type=str, help="output directory of volume store")
+    parser.add_argument("--voxel_size", default=(1.5,1.5,1.5), type=float, nargs=3, help="voxel size")
+    parser.add_argument("--image_size", default=(128,256,256), type=int, nargs=3, help="image size")
+    parser.add_argument("--chunk_size", default=CHUNK_SIZE, type=int, nargs=3, help="chunk size")
+    parser.add_argument("--max_indices", default=100000, type=int, help="max number of stored foreground/background indices per volume (0: keep all)")
+    args = parser.parse_args()
+
+    pipeline = make_transform_pipeline(tuple(args.voxel_size), tuple(args.image_size), max_indices=args.max_indices)
+    train_files = load_decathlon_datalist(args.dataset_jsonpath, True, "training")
+    convert_volumes(train_files, pipeline, args.out_dir, tuple(args.chunk_size))
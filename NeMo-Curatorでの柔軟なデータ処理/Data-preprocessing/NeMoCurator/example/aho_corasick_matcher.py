@@ -0,0 +1,319 @@
+# Copyright (c) 2024, NVIDIA CORPORATION.  All rights reserved.
+#
+# このファイルはApache License 2.0のもとでライセンスされています。
+# このスクリプトは、評価タスクの文字列（JCommonsenseQAの問題文など）をAho-Corasickオートマトンにまとめ、
+# 各ドキュメントを1回の線形走査で照合するための文字単位のマッチャーです。
+#
+# 日本語は単語の区切りに空白を使わないため、TaskDecontaminationの単語n-gramではほとんど一致しません。
+# このマッチャーは空白を除いたテキストを文字単位で照合し、一致した範囲を元のテキストの文字位置で返します。
+# pyahocorasickがインストールされている場合はそれを使用し、ない場合はPythonによる実装で照合します。
+#
+# 直接実行すると、合成した日本語のコーパスでこのマッチャーとnc.TaskDecontaminationの処理速度を比較します。
+#
+# 使用例:
+# python example/aho_corasick_matcher.py --num-docs 20000 --num-patterns 20000
+
+import argparse
+import json
+import random
+import time
+from collections import deque
+
+import numpy as np
+
+try:
+    import ahocorasick  # pyahocorasick（任意）
+except ImportError:
+    ahocorasick = None
+
+WHITESPACE_CHARS = " \t\n\r\f\v　"
+DELETE_WHITESPACE = str.maketrans("", "", WHITESPACE_CHARS)
+WHITESPACE_CODES = np.array([ord(c) for c in WHITESPACE_CHARS], dtype=np.uint32)
+
+
+def normalize_with_positions(text):
+    """
+    テキストから空白を除き、正規化後の各文字の元のテキストでの位置を返す。
+    小文字化で文字数が変わらない場合は小文字化も行う。
+
+    戻り値:
+    - (正規化したテキスト, 元の文字位置の配列)のタプル
+    """
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+    positions = np.flatnonzero(~np.isin(codes, WHITESPACE_CODES))
+    normalized = text.translate(DELETE_WHITESPACE)
+    lowered = normalized.lower()
+    if len(lowered) == len(normalized):
+        normalized = lowered
+    return normalized, positions
+
+
+def normalize_pattern(pattern):
+    """
+    照合するパターンをテキストと同じ方法で正規化する。
+    """
+    return normalize_with_positions(pattern)[0]
+
+
+class PythonAhoCorasick:
+    """
+    pyahocorasickがない場合に使用する、PythonによるAho-Corasickオートマトン。
+    """
+
+    def __init__(self):
+        self.goto = [{}]  # ノードごとの遷移（文字 -> 次のノード）
+        self.fail = [0]  # ノードごとの失敗時の遷移先
+        self.outputs = [[]]  # ノードで一致が確定するパターンの(番号, 長さ)のリスト
+
+    def add_word(self, pattern, value):
+        """
+        パターンをトライ木に追加する。
+        """
+        node = 0
+        for char in pattern:
+            next_node = self.goto[node].get(char)
+            if next_node is None:
+                next_node = len(self.goto)
+                self.goto[node][char] = next_node
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+            node = next_node
+        self.outputs[node].append(value)
+
+    def make_automaton(self):
+        """
+        幅優先探索で失敗時の遷移先を計算し、遷移先の出力を統合する。
+        """
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                state = self.fail[node]
+                while state and char not in self.goto[state]:
+                    state = self.fail[state]
+                self.fail[child] = self.goto[state].get(char, 0)
+                self.outputs[child] = self.outputs[child] + self.outputs[self.fail[child]]
+
+    def iter(self, text):
+        """
+        テキストを1回走査し、一致したパターンの(終了位置, 値)を返す。
+        """
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        node = 0
+        for end, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for value in outputs[node]:
+                yield end, value
+
+
+class AhoCorasickMatcher:
+    """
+    評価タスクの文字列をAho-Corasickオートマトンにまとめ、ドキュメント内の一致した範囲を探すクラス。
+
+    使用例:
+    matcher = AhoCorasickMatcher(["日本で一番高い山は", ...], char_ngram=20)
+    matcher.find_matches(text)  # [(パターンの番号, 開始文字位置, 終了文字位置), ...]
+    """
+
+    def __init__(self, patterns, char_ngram=0, use_python=False):
+        """
+        パラメータ:
+        - patterns: 評価タスクの文字列のリスト
+        - char_ngram: 0より大きい場合、各文字列をこの文字数のすべての部分文字列に分けて登録する
+                      （0の場合は文字列全体を登録する）
+        - use_python: Trueの場合、pyahocorasickがあってもPythonによる実装を使用する
+        """
+        self.backend = "python" if use_python or ahocorasick is None else "pyahocorasick"
+        automaton = PythonAhoCorasick() if self.backend == "python" else ahocorasick.Automaton()
+        self.num_patterns = 0
+        seen = set()
+        for pattern in patterns:
+            pattern = normalize_pattern(pattern)
+            if char_ngram > 0 and len(pattern) > char_ngram:
+                pieces = (pattern[i : i + char_ngram] for i in range(len(pattern) - char_ngram + 1))
+            else:
+                pieces = (pattern,)
+            for piece in pieces:
+                if piece and piece not in seen:
+                    seen.add(piece)
+                    automaton.add_word(piece, (self.num_patterns, len(piece)))
+                    self.num_patterns += 1
+        if self.num_patterns:
+            automaton.make_automaton()
+        self.automaton = automaton
+
+    @classmethod
+    def from_file(cls, path, char_ngram=0, text_field="text"):
+        """
+        1行に1つの文字列を書いたテキストファイル、またはtext_fieldを持つJSONLファイルからマッチャーを作成する。
+        """
+        with open(path, "r", encoding="utf-8") as f:
+            if path.endswith(".jsonl"):
+                patterns = [json.loads(line)[text_field] for line in f if line.strip()]
+            else:
+                patterns = [line.rstrip("\n") for line in f if line.strip()]
+        return cls(patterns, char_ngram)
+
+    def find_matches(self, text):
+        """
+        テキストを1回走査し、一致したパターンの番号と元のテキストでの範囲を返す。
+
+        戻り値:
+        - (パターンの番号, 開始文字位置, 終了文字位置)のタプルのリスト
+        """
+        if not self.num_patterns:
+            return []
+        normalized, positions = normalize_with_positions(text)
+        return [
+            (pattern_id, int(positions[end - length + 1]), int(positions[end]) + 1)
+            for end, (pattern_id, length) in self.automaton.iter(normalized)
+        ]
+
+
+def make_synthetic_corpus(num_docs, doc_chars, num_patterns, pattern_chars, contamination_rate, seed=42):
+    """
+    ひらがな、カタカナ、漢字をランダムに並べた1〜4文字の単語を空白で区切った合成コーパスと評価タスクの文字列を作成し、
+    contamination_rateの割合のドキュメントの単語の境界に評価タスクの文字列を埋め込む。
+    単語を空白で区切ることで、nc.TaskDecontaminationの単語n-gramでも同じ混入を検出できる
+    （このマッチャーは空白を除いて照合するため、結果は空白の有無に依存しない）。
+
+    戻り値:
+    - (ドキュメントのリスト, 評価タスクの文字列のリスト, 評価タスクの文字列を埋め込んだドキュメント数)のタプル
+    """
+    rng = random.Random(seed)
+    alphabet = (
+        [chr(c) for c in range(0x3041, 0x3097)]
+        + [chr(c) for c in range(0x30A1, 0x30FB)]
+        + [chr(c) for c in range(0x4E00, 0x4E00 + 2000)]
+    )
+
+    def random_words(num_chars):
+        words = []
+        while num_chars > 0:
+            length = rng.randint(1, 4)
+            words.append("".join(rng.choices(alphabet, k=length)))
+            num_chars -= length
+        return words
+
+    patterns = [" ".join(random_words(pattern_chars)) for _ in range(num_patterns)]
+    docs = []
+    num_contaminated = 0
+    for _ in range(num_docs):
+        words = random_words(doc_chars)
+        if rng.random() < contamination_rate:
+            position = rng.randrange(len(words) + 1)
+            words = words[:position] + [rng.choice(patterns)] + words[position:]
+            num_contaminated += 1
+        docs.append(" ".join(words))
+    return docs, patterns, num_contaminated
+
+
+def benchmark_task_decontamination(docs, patterns):
+    """
+    同じコーパスと評価タスクの文字列でnc.TaskDecontaminationを1プロセスで実行し、処理時間を測定する。
+
+    戻り値:
+    - (処理時間（秒）, 除去後のドキュメント数, 一部または全体が除去されたドキュメント数)のタプル
+    """
+    import dask
+    import dask.dataframe as dd
+    import pandas as pd
+
+    import nemo_curator as nc
+    from nemo_curator.datasets import DocumentDataset
+    from nemo_curator.tasks.downstream_task import DownstreamTask
+
+    class SyntheticTask(DownstreamTask):
+        def __init__(self, texts, min_ngram_size=8, max_ngram_size=13):
+            super().__init__()
+            self._task_name = "synthetic"
+            self._texts = texts
+            self._min_ngram_size = min_ngram_size
+            self._max_ngram_size = max_ngram_size
+
+        def generate_ngrams(self):
+            for text in self._texts:
+                self._update_ngrams(text, self._min_ngram_size, self._max_ngram_size)
+            return self.ngrams
+
+    task = SyntheticTask(patterns)
+    if not task.generate_ngrams():
+        raise ValueError("評価タスクの文字列から単語n-gramを作成できません（--pattern-charsを大きくしてください）")
+    dataset = DocumentDataset(dd.from_pandas(pd.DataFrame({"text": docs}), npartitions=1))
+    t0 = time.perf_counter()
+    with dask.config.set(scheduler="synchronous"):
+        result = nc.TaskDecontamination([task])(dataset).df.compute()
+    seconds = time.perf_counter() - t0
+    # 元のテキストのまま残ったドキュメント以外は、一致した単語n-gramの除去で分割または削除されている
+    num_changed = len(docs) - len(set(docs) & set(result["text"]))
+    return seconds, len(result), num_changed
+
+
+# コマンドライン引数の設定
+def attach_args(
+    parser=argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    ),
+):
+    """
+    コマンドライン引数を追加するヘルパー関数。
+
+    戻り値:
+    - 引数を追加したArgumentParserオブジェクト
+    """
+    parser.add_argument("--num-docs", type=int, default=10000, help="合成コーパスのドキュメント数")
+    parser.add_argument("--doc-chars", type=int, default=2000, help="ドキュメントの文字数")
+    parser.add_argument("--num-patterns", type=int, default=10000, help="評価タスクの文字列の数")
+    parser.add_argument("--pattern-chars", type=int, default=40, help="評価タスクの文字列の文字数")
+    parser.add_argument("--char-ngram", type=int, default=20, help="評価タスクの文字列を分割する文字数")
+    parser.add_argument("--contamination-rate", type=float, default=0.01, help="評価タスクの文字列を埋め込むドキュメントの割合")
+    parser.add_argument(
+        "--skip-task-decontamination",
+        action="store_true",
+        help="nc.TaskDecontaminationとの比較を行わない",
+    )
+    return parser
+
+
+# メイン処理
+def main(args):
+    """
+    合成コーパスで、Aho-Corasickマッチャーとnc.TaskDecontaminationの処理速度（docs/s）を比較します。
+
+    パラメータ:
+    - args: コマンドライン引数
+    """
+    docs, patterns, num_contaminated = make_synthetic_corpus(
+        args.num_docs, args.doc_chars, args.num_patterns, args.pattern_chars, args.contamination_rate
+    )
+    print(f"合成コーパス: {len(docs)}件、評価タスクの文字列を埋め込んだドキュメント{num_contaminated}件")
+    backends = [False] if ahocorasick is None else [False, True]
+    for use_python in backends:
+        t0 = time.perf_counter()
+        matcher = AhoCorasickMatcher(patterns, args.char_ngram, use_python=use_python)
+        build_seconds = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        matches = [matcher.find_matches(doc) for doc in docs]
+        scan_seconds = time.perf_counter() - t0
+        num_matched = sum(1 for doc_matches in matches if doc_matches)
+        print(
+            f"aho-corasick ({matcher.backend}): {matcher.num_patterns}パターン, 構築{build_seconds:.2f}秒, "
+            f"{len(docs) / scan_seconds:.1f} docs/s, 一致したドキュメント{num_matched}件"
+            f"（一致した範囲{sum(len(doc_matches) for doc_matches in matches)}個）"
+        )
+    if not args.skip_task_decontamination:
+        seconds, num_remaining, num_changed = benchmark_task_decontamination(docs, patterns)
+        print(
+            f"nc.TaskDecontamination: {len(docs) / seconds:.1f} docs/s, "
+            f"一致して分割または削除されたドキュメント{num_changed}件, "
+            f"除去後のドキュメント{num_remaining}件（元のドキュメント{len(docs)}件）"
+        )
+
+
+# スクリプトのエントリーポイント
+if __name__ == "__main__":
+    main(attach_args().parse_args())
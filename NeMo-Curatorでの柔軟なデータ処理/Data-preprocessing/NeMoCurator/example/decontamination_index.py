@@ -0,0 +1,224 @@
+# Copyright (c) 2024, NVIDIA CORPORATION.  All rights reserved.
+#
+# このファイルはApache License 2.0のもとでライセンスされています。
+# このスクリプトは、除去の対象となるダウンストリームタスクのn-gramを一度だけ作成し、
+# ソート済みのハッシュ配列（.npy）としてディスクに保存するためのものです。
+#
+# task_decontamination.pyに--ngram-indexを指定すると、各ワーカーはこのファイルをメモリマップして照合します。
+# タスクのn-gramを実行のたびに作り直したり、ワーカーごとにコピーを送ったりする必要がなくなります。
+#
+#   <output_dir>/ngrams.npy  n-gramのハッシュ値（uint64、昇順、重複なし）
+#   <output_dir>/meta.json   n-gramの語数、タスク名、件数などのメタデータ
+#
+# n-gramのハッシュ値は、各単語のBLAKE2bハッシュを先頭から順に多項式で結合して計算します。
+# 同じ方法でドキュメントの単語列のハッシュ値をNumPyでまとめて計算し、二分探索で照合します。
+
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+from nemo_curator.tasks import (  # タスク群（除外対象として使うデータセット）
+    ANLI,
+    CB,
+    PIQA,
+    RTE,
+    WSC,
+    ArcChallenge,
+    ArcEasy,
+    BoolQ,
+    Copa,
+    Drop,
+    MultiRC,
+    OpenBookQA,
+    Quac,
+    Race,
+    Record,
+    Squad,
+    TriviaQA,
+    WebQA,
+    WiC,
+    Winogrande,
+)
+from nemo_curator.utils.text_utils import get_words  # TaskDecontaminationと同じ単語分割
+
+INDEX_FILE = "ngrams.npy"
+META_FILE = "meta.json"
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def build_downstream_tasks():
+    """
+    除去の対象となるダウンストリームタスクのリストを返す。
+    """
+    return [
+        Winogrande(),
+        Squad(),
+        TriviaQA(),
+        Quac(),
+        WebQA(),
+        Race(),
+        Drop(),
+        WiC(),
+        PIQA(),
+        ArcEasy(),
+        ArcChallenge(),
+        OpenBookQA(),
+        BoolQ(),
+        Copa(),
+        RTE(),
+        MultiRC(),
+        WSC(),
+        CB(),
+        ANLI(),
+        Record(),
+    ]
+
+
+def word_hashes(words):
+    """
+    単語のリストを、単語ごとの64bitのBLAKE2bハッシュの配列に変換する。
+    """
+    cache = {}
+    hashes = np.empty(len(words), dtype=np.uint64)
+    for i, word in enumerate(words):
+        value = cache.get(word)
+        if value is None:
+            value = cache[word] = int.from_bytes(
+                hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little"
+            )
+        hashes[i] = value
+    return hashes
+
+
+def ngram_hashes(hashes, ngram_size):
+    """
+    単語のハッシュ値の配列から、先頭位置ごとのngram_size語のn-gramのハッシュ値を計算する。
+
+    戻り値:
+    - n-gramのハッシュ値の配列（長さは単語数 - ngram_size + 1）
+    """
+    num_ngrams = len(hashes) - ngram_size + 1
+    if num_ngrams <= 0:
+        return np.empty(0, dtype=np.uint64)
+    combined = np.full(num_ngrams, ngram_size, dtype=np.uint64)
+    for k in range(ngram_size):
+        combined = combined * HASH_MULTIPLIER + hashes[k : k + num_ngrams]
+    return combined
+
+
+def build_index(tasks, output_dir):
+    """
+    タスクのn-gramのハッシュ値をソート済みの配列として保存する。
+
+    パラメータ:
+    - tasks: ダウンストリームタスクのリスト
+    - output_dir: インデックスの出力先
+
+    戻り値:
+    - メタデータの辞書
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    chunks = []
+    ngram_sizes = set()
+    for task in tasks:
+        for ngram in task.generate_ngrams():
+            words = ngram.split(" ")
+            ngram_sizes.add(len(words))
+            chunks.append(ngram_hashes(word_hashes(words), len(words)))
+    ngrams = np.unique(np.concatenate(chunks)) if chunks else np.empty(0, dtype=np.uint64)
+
+    np.save(os.path.join(output_dir, INDEX_FILE + ".tmp.npy"), ngrams)
+    os.replace(os.path.join(output_dir, INDEX_FILE + ".tmp.npy"), os.path.join(output_dir, INDEX_FILE))
+    meta = {
+        "tasks": [type(task).__name__ for task in tasks],
+        "num_ngrams": int(len(ngrams)),
+        "ngram_sizes": sorted(ngram_sizes),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    with open(os.path.join(output_dir, META_FILE), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    return meta
+
+
+def load_index(index_dir):
+    """
+    インデックスをメモリマップして読み込む。同じノードのワーカーはページキャッシュを共有する。
+
+    戻り値:
+    - (n-gramのハッシュ値の配列, メタデータの辞書)のタプル
+    """
+    with open(os.path.join(index_dir, META_FILE), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    ngrams = np.load(os.path.join(index_dir, INDEX_FILE), mmap_mode="r")
+    return ngrams, meta
+
+
+def find_ngram_matches(text, ngrams, ngram_sizes):
+    """
+    テキストの単語n-gramのうち、インデックスに含まれるものを探す。
+
+    パラメータ:
+    - text: ドキュメントのテキスト
+    - ngrams: load_indexで読み込んだハッシュ値の配列
+    - ngram_sizes: 照合するn-gramの語数のリスト
+
+    戻り値:
+    - (n-gramのハッシュ値, 開始文字位置, 終了文字位置)のタプルのリスト
+    """
+    words, positions = get_words(text)
+    if not words or len(ngrams) == 0:
+        return []
+    hashes = word_hashes(words)
+    matches = []
+    for ngram_size in ngram_sizes:
+        candidates = ngram_hashes(hashes, ngram_size)
+        if len(candidates) == 0:
+            continue
+        found = np.searchsorted(ngrams, candidates)
+        hit = ngrams[np.minimum(found, len(ngrams) - 1)] == candidates
+        for start in np.flatnonzero(hit):
+            last = start + ngram_size - 1
+            matches.append((int(candidates[start]), positions[start], positions[last] + len(words[last])))
+    return matches
+
+
+# コマンドライン引数の設定
+def attach_args(
+    parser=argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    ),
+):
+    """
+    コマンドライン引数を追加するヘルパー関数。
+
+    戻り値:
+    - 引数を追加したArgumentParserオブジェクト
+    """
+    parser.add_argument(
+        "--output-dir",
+        default="/workspace/data/mydata/decontamination_index",
+        help="タスクのn-gramのインデックスの出力先",
+    )
+    return parser
+
+
+# メイン処理
+def main(args):
+    """
+    ダウンストリームタスクのn-gramのインデックスを作成します。
+
+    パラメータ:
+    - args: コマンドライン引数
+    """
+    t0 = time.time()
+    meta = build_index(build_downstream_tasks(), args.output_dir)
+    print(f"{meta['num_ngrams']}件のn-gramを{args.output_dir}に保存しました（{time.time() - t0:.1f}秒）")
+
+
+# スクリプトのエントリーポイント
+if __name__ == "__main__":
+    main(attach_args().parse_args())
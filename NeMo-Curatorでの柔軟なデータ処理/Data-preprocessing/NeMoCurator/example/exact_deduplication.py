@@ -8,12 +8,15 @@
 import argparse
 import time
 
+from nemo_curator import AddId  # 一意なドキュメントIDの付与
 from nemo_curator.datasets import DocumentDataset  # データセットの読み込みと処理
 from nemo_curator.modules import ExactDuplicates  # 重複検出モジュール
-from nemo_curator.utils.distributed_utils import get_client, read_data, write_to_disk  # データの読み込みと書き出し
-from nemo_curator.utils.file_utils import get_all_files_paths_under  # ファイル検索ユーティリティ
+from nemo_curator.utils.distributed_utils import get_client  # クライアントの作成
 from nemo_curator.utils.script_utils import ArgumentHelper  # スクリプト引数のヘルパー関数
 
+from stage_io import add_stage_io_args, read_stage, stage_columns, write_stage  # ステージ間の中間データの読み書き
+from stage_profiler import StageProfiler, add_profile_args  # ステージごとの時間の計測
+
 
 def pre_imports():
     """
@@ -22,6 +25,24 @@ def pre_imports():
     import cudf  # GPU用のデータフレームライブラリ
 
 
+def remove_by_anti_join(df, docs_to_remove, id_field):
+    """
+    docs_to_removeに含まれるIDの行を、クラスタ上でのアンチジョインによってdfから除外する。
+
+    パラメータ:
+    - df: 入力データのDaskデータフレーム
+    - docs_to_remove: 削除するドキュメントのIDを含むDaskデータフレーム
+    - id_field: IDのフィールド名
+
+    戻り値:
+    - 重複を除外したDaskデータフレーム
+    """
+    # 同じIDが複数回含まれていても結合で行が増えないよう、削除対象のIDは一意にしておく
+    removal_ids = docs_to_remove[[id_field]].drop_duplicates().assign(_dup=True)
+    merged = df.merge(removal_ids, on=id_field, how="left")
+    return merged[merged["_dup"].isna()].drop(columns=["_dup"])
+
+
 def main(args):
     """
     メイン処理関数。データセットの読み込み、重複検出、重複データの削除を行います。
@@ -31,10 +52,12 @@ def main(args):
     """
 
     # データセットとログ、出力ディレクトリのパス設定
-    dataset_dir = "/workspace/data/mydata/split_curator/1_cleaned_pro"
+    dataset_dir = args.input_data_dir
     log_dir = "./"  # ログの保存ディレクトリ
-    output_dir = "./"  # 出力データの保存ディレクトリ
-    dataset_id_field = "title"  # 各データの識別フィールド（ここではタイトル）
+    output_dir = args.output_data_dir  # 出力データの保存ディレクトリ
+    # 各データの識別フィールド。split_textで1ページが複数のチャンクに分かれるとタイトルは一意にならないため、
+    # 読み込み時に一意なIDを付与して使用する
+    dataset_id_field = args.id_field
     dataset_text_field = "text"  # 重複を検出する際に使用するテキストフィールド
     client = get_client(**ArgumentHelper.parse_client_args(args))  # クライアント設定
     backend = "cudf" if args.device == "gpu" else "pandas"  # 実行環境に応じてバックエンドを選択
@@ -45,41 +68,64 @@ def main(args):
 
     # 処理開始時間の記録
     t0 = time.time()
-    
-    # データセットの読み込み（JSON形式）
-    input_dataset = DocumentDataset.read_json(dataset_dir, backend=backend)
-
-    # 重複検出モジュールのインスタンス化
-    exact_dup = ExactDuplicates(
-        logger=log_dir,
-        id_field=dataset_id_field,
-        text_field=dataset_text_field,
-        # cache_dir=output_dir  # 必要に応じて出力をキャッシュに保存
-    )
 
-    # 重複データの検出
-    duplicates = exact_dup(dataset=input_dataset)
-
-    # キャッシュを使用する場合、結果はキャッシュに保存されたデータセットへのパス
-    if isinstance(duplicates, str):
-        duplicates = DocumentDataset.read_parquet(duplicates, backend=backend)
-
-    # データフレーム操作を簡単にするため、df（データフレーム）を利用可能
-
-    # 重複IDをすべて取得し、最初の1つを残して他の重複を削除する設定
-    docs_to_remove = duplicates.df.map_partitions(
-        lambda x: x[x._hashes.duplicated(keep="first")]
-    )
-
-    # 重複が少ない場合、計算結果をリストに格納し、`isin`を使ってデータをフィルタリング
-    result = input_dataset.df[
-        ~input_dataset.df[dataset_id_field].isin(
-            docs_to_remove[dataset_id_field].compute()
-        )
-    ]
-
-    # 重複のないデータセットをディスクに保存（Parquet形式）
-    write_to_disk(result, output_dir, output_type="parquet")
+    with StageProfiler(client, args.profile_dir, "exact_deduplication") as profiler:
+        with profiler.stage("read"):
+            read_kwargs = {"backend": backend, "blocksize": args.blocksize, "partitioning": args.jsonl_partitioning}
+            if dataset_id_field in (stage_columns(dataset_dir, args.input_format) or []):
+                # IDを持つParquetの場合、重複の検出にはIDとテキストの列だけを読み込み、
+                # すべての列は削除の段階で読み込む
+                input_df = read_stage(dataset_dir, args.input_format, **read_kwargs)
+                hash_df = read_stage(
+                    dataset_dir, args.input_format, columns=[dataset_id_field, dataset_text_field], **read_kwargs
+                )
+            else:
+                # パーティション番号と行番号から一意なIDを付与する（全体の件数を数えないため、追加のパスは発生しない）
+                input_df = read_stage(dataset_dir, args.input_format, **read_kwargs)
+                input_df = AddId(id_field=dataset_id_field, id_prefix="doc")(DocumentDataset(input_df)).df
+                hash_df = input_df
+            hash_dataset = DocumentDataset(profiler.materialize(hash_df))
+
+        with profiler.stage("hash"):
+            # 重複検出モジュールのインスタンス化
+            exact_dup = ExactDuplicates(
+                logger=log_dir,
+                id_field=dataset_id_field,
+                text_field=dataset_text_field,
+                # cache_dir=output_dir  # 必要に応じて出力をキャッシュに保存
+            )
+
+            # 重複データの検出
+            duplicates = exact_dup(dataset=hash_dataset)
+
+            # キャッシュを使用する場合、結果はキャッシュに保存されたデータセットへのパス
+            if isinstance(duplicates, str):
+                duplicates = DocumentDataset.read_parquet(duplicates, backend=backend)
+
+            # データフレーム操作を簡単にするため、df（データフレーム）を利用可能
+
+            # 重複IDをすべて取得し、最初の1つを残して他の重複を削除する設定
+            docs_to_remove = profiler.materialize(
+                duplicates.df.map_partitions(lambda x: x[x._hashes.duplicated(keep="first")])
+            )
+
+        with profiler.stage("shuffle"):
+            if args.removal_mode == "anti-join":
+                # 削除するIDをクライアントに集めず、IDでハッシュシャッフルしてパーティションごとに結合（アンチジョイン）する。
+                # 重複の件数によらず、クライアントのメモリ使用量は一定になる
+                result = remove_by_anti_join(input_df, docs_to_remove, dataset_id_field)
+            else:
+                # 重複が少ない場合、計算結果をリストに格納し、`isin`を使ってデータをフィルタリング
+                result = input_df[
+                    ~input_df[dataset_id_field].isin(
+                        docs_to_remove[dataset_id_field].compute()
+                    )
+                ]
+            result = profiler.materialize(result)
+
+        with profiler.stage("write"):
+            # 重複のないデータセットをディスクに保存（デフォルトはParquet形式）
+            write_stage(result, output_dir, args.output_format, partition_size=args.output_partition_size)
 
     # 処理にかかった時間を表示
     print(time.time() - t0)
@@ -97,7 +143,30 @@ def attach_args(
     戻り値:
     - 引数を追加したArgumentParserオブジェクト
     """
-    return ArgumentHelper(parser).add_distributed_args()
+    parser = add_profile_args(ArgumentHelper(parser).add_distributed_args())
+    parser = add_stage_io_args(parser, input_format="jsonl", output_format="parquet")
+    parser.add_argument(
+        "--input-data-dir",
+        default="/workspace/data/mydata/split_curator/1_cleaned_pro",
+        help="重複を検出するデータセットのディレクトリ",
+    )
+    parser.add_argument(
+        "--output-data-dir",
+        default="./",
+        help="重複を除去したデータの出力先",
+    )
+    parser.add_argument(
+        "--id-field",
+        default="doc_id",
+        help="一意なドキュメントIDのフィールド名（入力のParquetにない場合は読み込み時に付与する）",
+    )
+    parser.add_argument(
+        "--removal-mode",
+        choices=["anti-join", "isin"],
+        default="anti-join",
+        help="重複の削除方法（anti-join: クラスタ上でのアンチジョイン、isin: 削除するIDをクライアントに集めてフィルタリング）",
+    )
+    return parser
 
 
 # スクリプトのエントリーポイント
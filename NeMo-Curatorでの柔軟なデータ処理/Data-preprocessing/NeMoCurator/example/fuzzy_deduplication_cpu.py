@@ -0,0 +1,369 @@
+# Copyright (c) 2024, NVIDIA CORPORATION.  All rights reserved.
+#
+# このファイルはApache License 2.0のもとでライセンスされています。利用条件は上記URLで確認できます。
+#
+# このスクリプトは、日付やフッターだけが異なるページのような、ほぼ同一のドキュメントを検出して削除するためのものです。
+# GPUを使用せず、pandasバックエンドのCPUワーカーで実行します。
+#
+# 1. 空白を除いた文字n-gramのハッシュから、MinHashシグネチャをNumPyでバッチ単位に計算します。
+# 2. シグネチャをバンドに分割してハッシュ化し（LSH）、同じバケットに入ったドキュメントを候補ペアとします。
+# 3. 必要に応じて候補ペアの文字n-gramのJaccard類似度を計算し、しきい値未満のペアを除外します。
+# 4. ペアでつながったドキュメントのグループごとに、IDが最小のものだけを残します。
+
+import argparse
+import re
+import time
+
+import dask
+import dask.dataframe as dd
+import numpy as np
+import pandas as pd
+
+from nemo_curator import AddId  # 一意なドキュメントIDの付与
+from nemo_curator.datasets import DocumentDataset  # データセットの読み込みと処理
+from nemo_curator.utils.distributed_utils import get_client  # クライアントの作成
+from nemo_curator.utils.script_utils import ArgumentHelper  # スクリプト引数のヘルパー関数
+
+from exact_deduplication import remove_by_anti_join  # クラスタ上でのアンチジョイン
+from stage_io import add_stage_io_args, head_partitions, read_stage, stage_columns, write_stage  # ステージ間の中間データの読み書き
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+MAX_BLOCK_ELEMENTS = 1 << 22  # MinHashの計算で一度に確保する要素数の上限（約32MB）
+
+
+def mix64(x):
+    """
+    uint64の配列を攪拌する（splitmix64の最終化関数）。
+    """
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def shingle_hashes(text, char_ngram):
+    """
+    空白を除いたテキストの文字n-gramを64bitのハッシュ値に変換する。
+
+    日本語は単語の区切りがないため、単語ではなく文字のn-gramを使用する。
+    n文字に満たないテキストは全体を1つのn-gramとして扱う。
+
+    パラメータ:
+    - text: テキスト
+    - char_ngram: n-gramの文字数
+
+    戻り値:
+    - 重複を除いたハッシュ値の配列（uint64）
+    """
+    codes = np.frombuffer(
+        WHITESPACE_PATTERN.sub("", text).encode("utf-32-le"), dtype=np.uint32
+    ).astype(np.uint64)
+    if len(codes) == 0:
+        return np.zeros(1, dtype=np.uint64)
+    n = min(char_ngram, len(codes))
+    num_shingles = len(codes) - n + 1
+    hashes = np.zeros(num_shingles, dtype=np.uint64)
+    for k in range(n):
+        hashes = hashes * HASH_MULTIPLIER + codes[k : k + num_shingles]
+    return np.unique(mix64(hashes))
+
+
+def make_seeds(num_perm, seed=42):
+    """
+    MinHashの各ハッシュ関数に対応するシードを作成する。
+    """
+    return np.random.default_rng(seed).integers(
+        0, np.iinfo(np.uint64).max, size=num_perm, dtype=np.uint64, endpoint=True
+    )
+
+
+def compute_minhash_signatures(texts, seeds, char_ngram=5, batch_size=256):
+    """
+    テキストのリストのMinHashシグネチャを計算する。
+
+    batch_size件のドキュメントのn-gramを連結し、全ハッシュ関数の値をまとめて計算したあと、
+    ドキュメントごとの最小値をnp.minimum.reduceatで求める。
+
+    パラメータ:
+    - texts: テキストのリスト
+    - seeds: make_seedsで作成したシード
+    - char_ngram: n-gramの文字数
+    - batch_size: 一度に処理するドキュメント数
+
+    戻り値:
+    - シグネチャの配列（ドキュメント数 x ハッシュ関数の数、uint32）
+    """
+    signatures = np.empty((len(texts), len(seeds)), dtype=np.uint32)
+    for start in range(0, len(texts), batch_size):
+        shingles = [shingle_hashes(text, char_ngram) for text in texts[start : start + batch_size]]
+        counts = np.fromiter((len(s) for s in shingles), dtype=np.int64, count=len(shingles))
+        offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        all_shingles = np.concatenate(shingles)[:, None]
+        # 一時配列が大きくなりすぎないよう、ハッシュ関数をブロックに分けて計算する
+        block = max(1, MAX_BLOCK_ELEMENTS // len(all_shingles))
+        for column in range(0, len(seeds), block):
+            mixed = mix64(all_shingles ^ seeds[None, column : column + block])
+            minimum = np.minimum.reduceat(mixed, offsets, axis=0)
+            signatures[start : start + len(shingles), column : column + block] = minimum >> np.uint64(32)
+    return signatures
+
+
+def lsh_buckets(signatures, num_bands):
+    """
+    シグネチャをnum_bands個のバンドに分け、バンドごとのバケットのハッシュ値を計算する。
+    バンドの番号もハッシュに含めるため、異なるバンドのバケットは衝突しない。
+
+    戻り値:
+    - バケットのハッシュ値の配列（ドキュメント数 x バンド数、uint64）
+    """
+    num_docs, num_perm = signatures.shape
+    rows = num_perm // num_bands
+    values = signatures.astype(np.uint64)
+    buckets = np.empty((num_docs, num_bands), dtype=np.uint64)
+    for band in range(num_bands):
+        hashes = np.full(num_docs, band, dtype=np.uint64)
+        for column in values[:, band * rows : (band + 1) * rows].T:
+            hashes = hashes * HASH_MULTIPLIER + column
+        buckets[:, band] = mix64(hashes)
+    return buckets
+
+
+def minhash_lsh_partition(df, id_field, text_field, seeds, char_ngram, num_bands):
+    """
+    パーティション内の各ドキュメントについて、(ID, バケット)の行をバンドの数だけ作成する。
+    """
+    signatures = compute_minhash_signatures(df[text_field].tolist(), seeds, char_ngram)
+    buckets = lsh_buckets(signatures, num_bands)
+    return pd.DataFrame(
+        {
+            id_field: np.repeat(df[id_field].to_numpy(), num_bands),
+            "_bucket": buckets.ravel(),
+        }
+    )
+
+
+def bucket_to_pairs(df, id_field):
+    """
+    同じバケットのドキュメントを、バケット内で最小のIDのドキュメントとの候補ペアにする。
+    """
+    anchors = df.groupby("_bucket")[id_field].transform("min")
+    pairs = pd.DataFrame({f"{id_field}_x": anchors, f"{id_field}_y": df[id_field]})
+    return pairs[pairs[f"{id_field}_x"] != pairs[f"{id_field}_y"]]
+
+
+def jaccard_partition(df, text_field, char_ngram):
+    """
+    候補ペアの文字n-gramの集合のJaccard類似度を計算する。
+    """
+    similarities = []
+    for text_x, text_y in zip(df[f"{text_field}_x"], df[f"{text_field}_y"]):
+        shingles_x = shingle_hashes(text_x, char_ngram)
+        shingles_y = shingle_hashes(text_y, char_ngram)
+        intersection = len(np.intersect1d(shingles_x, shingles_y, assume_unique=True))
+        similarities.append(intersection / (len(shingles_x) + len(shingles_y) - intersection))
+    return df.drop(columns=[f"{text_field}_x", f"{text_field}_y"]).assign(
+        _jaccard=np.asarray(similarities, dtype=np.float32)
+    )
+
+
+def find_documents_to_remove(pairs, id_field):
+    """
+    ペアでつながったドキュメントのグループ（連結成分）を求め、各グループでIDが最小のもの以外を返す。
+
+    パラメータ:
+    - pairs: 重複と判定したペアのpandasデータフレーム
+    - id_field: IDのフィールド名
+
+    戻り値:
+    - 削除するドキュメントのIDのリスト
+    """
+    parent = {}
+
+    def find(node):
+        root = parent.setdefault(node, node)
+        while root != parent[root]:
+            root = parent[root]
+        while node != root:
+            parent[node], node = root, parent[node]
+        return root
+
+    for x, y in zip(pairs[f"{id_field}_x"], pairs[f"{id_field}_y"]):
+        root_x, root_y = find(x), find(y)
+        if root_x != root_y:
+            # IDが小さい方を代表にする
+            parent[max(root_x, root_y)] = min(root_x, root_y)
+    return [node for node in parent if find(node) != node]
+
+
+def run_benchmark(df, id_field, text_field, seeds, char_ngram, num_bands, num_docs):
+    """
+    先頭のnum_docs件について、このプロセス（1コア）でのシグネチャとバケットの計算速度を測定する。
+    """
+    # 先頭から必要な数のパーティションだけを読み込む
+    sample = head_partitions(df, num_docs)
+    t0 = time.perf_counter()
+    minhash_lsh_partition(sample, id_field, text_field, seeds, char_ngram, num_bands)
+    elapsed = time.perf_counter() - t0
+    print(f"{len(sample)}件: {elapsed:.2f}秒, {len(sample) / elapsed:.1f} docs/s/core")
+
+
+def main(args):
+    """
+    メイン処理関数。データセットの読み込み、MinHash-LSHによる候補ペアの検出、検証、重複データの削除を行います。
+
+    パラメータ:
+    - args: コマンドライン引数
+    """
+    if args.num_perm % args.num_bands != 0:
+        raise ValueError("--num-permは--num-bandsで割り切れる必要があります")
+
+    dataset_id_field = args.id_field
+    dataset_text_field = "text"
+    client = get_client(**ArgumentHelper.parse_client_args(args))
+    seeds = make_seeds(args.num_perm, args.seed)
+
+    t0 = time.time()
+
+    # CPUワーカーで処理するため、pandasバックエンドで読み込む
+    read_kwargs = {"blocksize": args.blocksize, "partitioning": args.jsonl_partitioning}
+    if dataset_id_field in (stage_columns(args.input_data_dir, args.input_format) or []):
+        # IDを持つParquetの場合、重複の検出にはIDとテキストの列だけを読み込み、すべての列は削除の段階で読み込む
+        input_df = read_stage(args.input_data_dir, args.input_format, **read_kwargs)
+        df = read_stage(
+            args.input_data_dir, args.input_format, columns=[dataset_id_field, dataset_text_field], **read_kwargs
+        )
+    else:
+        input_df = read_stage(args.input_data_dir, args.input_format, **read_kwargs)
+        input_df = AddId(id_field=dataset_id_field, id_prefix="doc")(DocumentDataset(input_df)).df
+        df = input_df
+
+    if args.benchmark:
+        run_benchmark(df, dataset_id_field, dataset_text_field, seeds,
+                      args.char_ngram, args.num_bands, args.benchmark)
+        return
+
+    # 1. MinHashシグネチャとLSHのバケットの計算
+    buckets = df.map_partitions(
+        minhash_lsh_partition,
+        dataset_id_field,
+        dataset_text_field,
+        seeds,
+        args.char_ngram,
+        args.num_bands,
+        meta={dataset_id_field: df[dataset_id_field].dtype, "_bucket": np.uint64},
+    )
+
+    # 2. バケットでシャッフルし、同じバケットのドキュメントを候補ペアにする
+    pairs = buckets.shuffle(on="_bucket").map_partitions(
+        bucket_to_pairs,
+        dataset_id_field,
+        meta={f"{dataset_id_field}_x": df[dataset_id_field].dtype,
+              f"{dataset_id_field}_y": df[dataset_id_field].dtype},
+    ).drop_duplicates()
+
+    # 3. 候補ペアのJaccard類似度による検証
+    if not args.skip_verification:
+        texts = df[[dataset_id_field, dataset_text_field]]
+        for suffix in ("_x", "_y"):
+            pairs = pairs.merge(
+                texts.rename(columns={dataset_id_field: dataset_id_field + suffix,
+                                      dataset_text_field: dataset_text_field + suffix}),
+                on=dataset_id_field + suffix,
+                how="inner",
+            )
+        pairs = pairs.map_partitions(
+            jaccard_partition,
+            dataset_text_field,
+            args.char_ngram,
+            meta={f"{dataset_id_field}_x": df[dataset_id_field].dtype,
+                  f"{dataset_id_field}_y": df[dataset_id_field].dtype,
+                  "_jaccard": np.float32},
+        )
+        pairs = pairs[pairs["_jaccard"] >= args.jaccard_threshold]
+
+    # 4. 連結成分ごとに1件を残す。クライアントに集めるのは重複と判定したペアだけで、ドキュメント本体は集めない
+    # ドキュメント数も同じグラフで数え、入力の読み込みを1回で済ませる
+    num_docs, duplicate_pairs = dask.compute(
+        df.shape[0], pairs[[f"{dataset_id_field}_x", f"{dataset_id_field}_y"]]
+    )
+    ids_to_remove = find_documents_to_remove(duplicate_pairs, dataset_id_field)
+    print(f"重複ペア: {len(duplicate_pairs)}件, 削除するドキュメント: {len(ids_to_remove)}件")
+
+    docs_to_remove = dd.from_pandas(
+        pd.DataFrame({dataset_id_field: pd.Series(ids_to_remove, dtype=df[dataset_id_field].dtype)}),
+        npartitions=max(1, df.npartitions // 8),
+    )
+    result = remove_by_anti_join(input_df, docs_to_remove, dataset_id_field)
+
+    # 重複のないデータセットをディスクに保存（デフォルトはParquet形式）
+    write_stage(result, args.output_data_dir, args.output_format, partition_size=args.output_partition_size)
+
+    # 処理にかかった時間と、1コアあたりの処理速度を表示
+    elapsed = time.time() - t0
+    num_cores = sum(client.ncores().values())
+    print(f"{elapsed:.1f}秒, {num_docs / elapsed / num_cores:.1f} docs/s/core（{num_cores}コア）")
+
+
+# コマンドライン引数の設定
+def attach_args(
+    parser=argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    ),
+):
+    """
+    コマンドライン引数を定義する関数。
+
+    戻り値:
+    - 引数を追加したArgumentParserオブジェクト
+    """
+    parser = ArgumentHelper(parser).add_distributed_args()
+    parser = add_stage_io_args(parser, input_format="jsonl", output_format="parquet")
+    parser.add_argument(
+        "--input-data-dir",
+        default="/workspace/data/mydata/split_curator/1_cleaned_pro",
+        help="重複を検出するデータセットのディレクトリ",
+    )
+    parser.add_argument(
+        "--output-data-dir",
+        default="./fuzzy_dedup",
+        help="重複を除去したデータの出力先",
+    )
+    parser.add_argument(
+        "--id-field",
+        default="doc_id",
+        help="一意なドキュメントIDのフィールド名（入力のParquetにない場合は読み込み時に付与する）",
+    )
+    parser.add_argument("--char-ngram", type=int, default=5, help="n-gramの文字数")
+    parser.add_argument("--num-perm", type=int, default=128, help="MinHashのハッシュ関数の数")
+    parser.add_argument(
+        "--num-bands",
+        type=int,
+        default=16,
+        help="LSHのバンド数（類似度のしきい値の目安は(1/バンド数)^(バンド数/ハッシュ関数の数)）",
+    )
+    parser.add_argument(
+        "--jaccard-threshold",
+        type=float,
+        default=0.8,
+        help="重複と判定するJaccard類似度のしきい値",
+    )
+    parser.add_argument(
+        "--skip-verification",
+        action="store_true",
+        help="Jaccard類似度による検証を行わず、LSHの候補ペアをすべて重複とみなす",
+    )
+    parser.add_argument("--seed", type=int, default=42, help="MinHashのシードの乱数シード")
+    parser.add_argument(
+        "--benchmark",
+        type=int,
+        default=0,
+        help="指定した件数のドキュメントでシグネチャの計算速度（docs/s/core）を測定して終了する",
+    )
+    return parser
+
+
+# スクリプトのエントリーポイント
+if __name__ == "__main__":
+    main(attach_args().parse_args())
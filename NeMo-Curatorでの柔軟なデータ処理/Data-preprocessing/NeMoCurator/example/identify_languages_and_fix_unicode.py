@@ -12,19 +12,37 @@ import os
 import logging
 
 import ftfy  # テキストデータのUnicodeエラーを修正するライブラリ
+import numpy as np  # 文字種の集計
+import pandas as pd  # パーティション単位の処理
 import nemo_curator as nc  # NeMo Curatorモジュール
+from nemo_curator import AddId  # 一意なドキュメントIDの付与
 from nemo_curator.datasets import DocumentDataset  # データセットの読み込み
 from nemo_curator.filters import FastTextLangId  # FastTextベースの言語識別フィルター
-from nemo_curator.utils.distributed_utils import get_client, read_data, write_to_disk  # データの読み込みと書き出し
+from nemo_curator.utils.distributed_utils import (
+    get_client,  # クライアントの作成
+    load_object_on_worker,  # ワーカーごとに1回だけのオブジェクトの読み込み
+    read_data,  # データの読み込み
+)
 from nemo_curator.utils.file_utils import (
     get_all_files_paths_under,  # ディレクトリ内の全ファイルを取得
     separate_by_metadata,  # メタデータによる分割処理
 )
 from nemo_curator.utils.script_utils import ArgumentHelper  # スクリプト引数のヘルパー
 
+from stage_io import add_stage_io_args, read_planned_jsonl, write_stage  # ステージ間の中間データの読み書き
+from stage_profiler import StageProfiler, add_profile_args  # ステージごとの時間の計測
+
 # ログ設定：INFOレベルでログを出力
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# ftfyが変更しない文字（&以外のASCII印字可能文字、改行、タブ、全角の句読点・記号、ひらがな、カタカナ、CJK統合漢字）。
+# これらの文字だけで構成されるテキストには文字化けの兆候がないため、ftfyを呼び出さずにそのまま使用する。
+# &はHTMLエンティティの復元対象になるため含めない
+SAFE_TEXT_PATTERN = (
+    "[\t\n\x20-\x25\x27-\x7e"
+    "\u3001-\u303f\u3041-\u3096\u309d\u309e\u30a1-\u30fa\u30fc-\u30fe\u4e00-\u9fff]*"
+)
+
 # テキストのUnicodeエラーを修正する関数
 def fix_unicode(text):
     """
@@ -37,17 +55,196 @@ def fix_unicode(text):
     - 修正済みのテキスト
     """
     fixed = ftfy.fix_text(text)
-    if fixed != text:
+    if logging.getLogger().isEnabledFor(logging.DEBUG) and fixed != text:
         logging.debug(f"Fixed Unicode: '{text}' -> '{fixed}'")
     return fixed
 
+# パーティション単位でテキストのUnicodeエラーを修正する関数
+def fix_unicode_partition(texts):
+    """
+    パーティション内のテキストのうち、ftfyが変更しない文字だけで構成されるものを正規表現でまとめて判定し、
+    それ以外のテキストだけにfix_unicodeを適用します。
+
+    パラメータ:
+    - texts: テキストのpandas Series
+
+    戻り値:
+    - 修正済みのテキストのpandas Series
+    """
+    needs_fix = ~texts.str.fullmatch(SAFE_TEXT_PATTERN, na=False)
+    if not needs_fix.any():
+        return texts
+    fixed = texts.copy()
+    fixed[needs_fix] = [fix_unicode(text) for text in texts[needs_fix]]
+    return fixed
+
+# 文字種の比率を計算する関数
+def script_ratios(texts):
+    """
+    パーティション内のテキストの文字コードを連結し、空白以外の文字数と、かな（ひらがな・カタカナ）の比率、
+    日本語の文字（かな、漢字、全角の句読点・記号）の比率をNumPyでまとめて計算します。
+
+    パラメータ:
+    - texts: テキストのリスト
+
+    戻り値:
+    - (空白以外の文字数, かなの比率, 日本語の文字の比率)の配列のタプル
+    """
+    encoded = [text.encode("utf-32-le") for text in texts]
+    codes = np.frombuffer(b"".join(encoded), dtype=np.uint32)
+    ends = np.cumsum(np.fromiter((len(b) // 4 for b in encoded), dtype=np.int64, count=len(encoded)))
+    starts = np.concatenate(([0], ends[:-1])).astype(np.int64)
+
+    kana = (
+        ((codes >= 0x3041) & (codes <= 0x30FF))  # ひらがな・カタカナ
+        | ((codes >= 0x31F0) & (codes <= 0x31FF))  # カタカナ拡張
+        | ((codes >= 0xFF66) & (codes <= 0xFF9F))  # 半角カタカナ
+    )
+    japanese = (
+        kana
+        | ((codes >= 0x3400) & (codes <= 0x4DBF))  # CJK統合漢字拡張A
+        | ((codes >= 0x4E00) & (codes <= 0x9FFF))  # CJK統合漢字
+        | ((codes >= 0x3001) & (codes <= 0x303F))  # 全角の句読点・記号
+    )
+    non_space = (codes > 0x20) & (codes != 0x3000)
+
+    def count(mask):
+        cumulative = np.concatenate(([0], np.cumsum(mask, dtype=np.int64)))
+        return cumulative[ends] - cumulative[starts]
+
+    num_chars = count(non_space)
+    denominator = np.maximum(num_chars, 1)
+    return num_chars, count(kana) / denominator, count(japanese) / denominator
+
+# FastTextモデルを読み込む関数（ワーカーごとに1回だけ呼び出される）
+def load_fasttext_model(model_path):
+    """
+    FastText言語識別モデルを読み込みます。
+    """
+    import fasttext
+
+    return fasttext.load_model(model_path)
+
+# FastTextで複数のテキストの言語をまとめて識別する関数
+def predict_languages(model, texts):
+    """
+    FastTextのpredictにテキストのリストを渡し、まとめて言語を識別します。
+
+    戻り値:
+    - (スコアの配列, 言語コード（大文字2文字）のリスト)のタプル
+    """
+    labels, scores = model.predict([text.replace("\n", " ") for text in texts], k=1)
+    return (
+        np.array([score[0] for score in scores], dtype=np.float32),
+        [label[0][-2:].upper() for label in labels],
+    )
+
+# 文字種の比率で明らかな日本語を判定し、残りだけをFastTextで識別する関数
+def identify_language_partition(
+    df, model_path, language_field, target_language, kana_threshold, japanese_threshold, min_chars, min_langid_score
+):
+    """
+    かなの比率と日本語の文字の比率がしきい値以上のドキュメントはFastTextを使わずに対象言語と判定し、
+    それ以外のドキュメントだけをFastTextでまとめて識別します。
+    FastTextのスコアがmin_langid_score未満のドキュメントは、FastTextLangIdと同様に除外します。
+
+    パラメータ:
+    - df: パーティションのデータフレーム
+    - model_path: FastText言語識別モデルのパス
+    - language_field: 言語を格納するフィールド名
+    - target_language: 文字種で判定する言語（日本語）
+    - kana_threshold: かなの比率のしきい値
+    - japanese_threshold: 日本語の文字の比率のしきい値
+    - min_chars: 文字種で判定するドキュメントの最小文字数
+    - min_langid_score: FastTextのスコアのしきい値
+
+    戻り値:
+    - 言語のフィールドを追加したデータフレーム
+    """
+    texts = df["text"].tolist()
+    num_chars, kana_ratio, japanese_ratio = script_ratios(texts)
+    obvious = (num_chars >= min_chars) & (kana_ratio >= kana_threshold) & (japanese_ratio >= japanese_threshold)
+
+    languages = np.full(len(df), target_language, dtype=object)
+    keep = np.ones(len(df), dtype=bool)
+    ambiguous = np.flatnonzero(~obvious)
+    if len(ambiguous):
+        model = load_object_on_worker("fasttext_langid_model", load_fasttext_model, {"model_path": model_path})
+        scores, labels = predict_languages(model, [texts[i] for i in ambiguous])
+        languages[ambiguous] = labels
+        keep[ambiguous] = scores >= min_langid_score
+    logging.debug(f"Script fast path: {int(obvious.sum())}/{len(df)} documents")
+    return df.assign(**{language_field: languages})[keep]
+
+# パーティションの先頭のドキュメントについて、文字種による判定とFastTextの一致数を数える関数
+def script_agreement_partition(
+    df, model_path, target_language, kana_threshold, japanese_threshold, min_chars, max_docs
+):
+    """
+    パーティションの先頭のmax_docs件について、文字種で対象言語と判定したドキュメントの数と、
+    そのうちFastTextでも対象言語と識別されたドキュメントの数を数えます。
+    FastTextのモデルはidentify_language_partitionと同じく、ワーカーごとに1回だけ読み込みます。
+
+    戻り値:
+    - 件数を1行にまとめたデータフレーム
+    """
+    texts = df["text"].head(max_docs).tolist()
+    num_chars, kana_ratio, japanese_ratio = script_ratios(texts)
+    obvious = (num_chars >= min_chars) & (kana_ratio >= kana_threshold) & (japanese_ratio >= japanese_threshold)
+    fasttext_target = np.zeros(len(texts), dtype=bool)
+    if texts:
+        model = load_object_on_worker("fasttext_langid_model", load_fasttext_model, {"model_path": model_path})
+        _, labels = predict_languages(model, texts)
+        fasttext_target = np.array([label == target_language for label in labels])
+    return pd.DataFrame(
+        {
+            "num_docs": [len(texts)],
+            "num_obvious": [int(obvious.sum())],
+            "num_agree": [int((obvious & fasttext_target).sum())],
+            "num_left": [int((~obvious & fasttext_target).sum())],
+        }
+    )
+
+# 文字種による判定とFastTextの一致率を表示する関数
+def report_script_agreement(df, model_path, target_language, kana_threshold, japanese_threshold, min_chars, sample_size):
+    """
+    先頭のsample_size件程度のドキュメントについて、文字種で対象言語と判定したドキュメントのうち、
+    FastTextでも対象言語と識別されたものの割合をログに出力します。
+    件数はワーカーで数え、先頭のパーティションから必要な数だけを1, 2, 4, ...と倍にしながら処理します。
+    """
+    meta = pd.DataFrame({name: pd.Series(dtype="int64") for name in ("num_docs", "num_obvious", "num_agree", "num_left")})
+    totals = meta.sum()
+    start, step = 0, 1
+    while totals["num_docs"] < sample_size and start < df.npartitions:
+        stop = min(start + step, df.npartitions)
+        counts = df.partitions[start:stop].map_partitions(
+            script_agreement_partition,
+            model_path,
+            target_language,
+            kana_threshold,
+            japanese_threshold,
+            min_chars,
+            int(sample_size - totals["num_docs"]),
+            meta=meta,
+        ).compute()
+        totals += counts.sum()
+        start, step = stop, step * 2
+    num_docs, num_obvious, num_agree = int(totals["num_docs"]), int(totals["num_obvious"]), int(totals["num_agree"])
+    logging.info(
+        f"Script fast path on {num_docs} sampled documents: {num_obvious} decided by script "
+        f"({num_obvious / max(num_docs, 1):.1%}), agreement with FastText {num_agree}/{num_obvious} "
+        f"({num_agree / max(num_obvious, 1):.2%}), "
+        f"{int(totals['num_left'])} {target_language} documents left to FastText"
+    )
+
 # データセットを読み込む関数
-def load_dataset(input_data_dir):
+def load_dataset(input_data_dir, partitioning="planned"):
     """
     指定されたディレクトリ内のファイルを読み込み、データセットとして返します。
 
     パラメータ:
     - input_data_dir: データセットのディレクトリ
+    - partitioning: パーティションの分け方（planned: 小さいファイルをまとめ、大きいファイルを分割する、per-file: ファイルごと）
 
     戻り値:
     - 読み込まれたデータセット
@@ -57,7 +254,10 @@ def load_dataset(input_data_dir):
         logging.warning(f"No files found in {input_data_dir}")
         return None
     logging.info(f"Found {len(files)} files in {input_data_dir}")
-    raw_data = read_data(files, file_type="jsonl", backend="pandas", add_filename=True)
+    if partitioning == "planned":
+        raw_data = read_planned_jsonl(files, add_filename=True)
+    else:
+        raw_data = read_data(files, file_type="jsonl", backend="pandas", add_filename=True)
     dataset = DocumentDataset(raw_data)
     return dataset
 
@@ -70,64 +270,113 @@ def main(args):
     - args: コマンドライン引数
     """
     # データとモデルのパス設定
-    multilingual_data_path = "/workspace/data/mydata/split_curator/0_processed_pro"  # 多言語データ
-    language_separated_output_path = "/workspace/data/mydata/split_curator/1_Language_Identification_pro"  # 言語分離後のデータ出力先
-    cleaned_data_output_path = "/workspace/data/mydata/split_curator/1_cleaned_pro"  # クリーンデータの出力先
-    model_path = "/workspace/models/Language_identification/lid.176.bin"  # 言語識別モデルのパス
+    multilingual_data_path = args.input_data_dir  # 多言語データ
+    language_separated_output_path = args.language_separated_output_dir  # 言語分離後のデータ出力先
+    cleaned_data_output_path = args.output_data_dir  # クリーンデータの出力先
+    model_path = args.model_path  # 言語識別モデルのパス
     target_language = "JA"  # 対象言語 (ここでは日本語)
     language_field = "language"  # 言語フィールド
 
     # クライアント設定を読み込む
     client = get_client(**ArgumentHelper.parse_client_args(args))
 
-    # データセットの読み込み
-    multilingual_dataset = load_dataset(multilingual_data_path)
-    if multilingual_dataset is None:
-        logging.error("Failed to load dataset. Exiting.")
-        return
+    with StageProfiler(client, args.profile_dir, "identify_languages_and_fix_unicode") as profiler:
+        # データセットの読み込み
+        with profiler.stage("read"):
+            multilingual_dataset = load_dataset(multilingual_data_path, args.jsonl_partitioning)
+            if multilingual_dataset is None:
+                logging.error("Failed to load dataset. Exiting.")
+                return
+            multilingual_dataset = DocumentDataset(profiler.materialize(multilingual_dataset.df))
 
-    # FastText言語識別フィルターを設定してデータに適用
-    language_id_pipeline = nc.ScoreFilter(
-        FastTextLangId(model_path), score_field=language_field, score_type="object"
-    )
-    filtered_dataset = language_id_pipeline(multilingual_dataset)
+        with profiler.stage("score"):
+            if args.script_fast_path:
+                script_thresholds = (args.kana_threshold, args.japanese_threshold, args.min_chars)
+                if args.agreement_sample_size > 0:
+                    report_script_agreement(
+                        multilingual_dataset.df, model_path, target_language, *script_thresholds, args.agreement_sample_size
+                    )
+                # 文字種で明らかな日本語を判定し、残りのドキュメントだけをFastTextでまとめて識別
+                filtered_dataset = DocumentDataset(
+                    multilingual_dataset.df.map_partitions(
+                        identify_language_partition,
+                        model_path,
+                        language_field,
+                        target_language,
+                        *script_thresholds,
+                        args.min_langid_score,
+                        meta=multilingual_dataset.df._meta.assign(**{language_field: pd.Series(dtype=object)}),
+                    )
+                )
+            else:
+                # FastText言語識別フィルターを設定してデータに適用
+                language_id_pipeline = nc.ScoreFilter(
+                    FastTextLangId(model_path, min_langid_score=args.min_langid_score),
+                    score_field=language_field,
+                    score_type="object",
+                )
+                filtered_dataset = language_id_pipeline(multilingual_dataset)
 
-    # 言語スコアを除去して日本語データに限定
-    filtered_dataset.df[language_field] = filtered_dataset.df[language_field].apply(
-        lambda score: score[1], meta=(None, str)
-    )
+                # 言語スコアを除去して日本語データに限定
+                filtered_dataset.df[language_field] = filtered_dataset.df[language_field].apply(
+                    lambda score: score[1], meta=(None, str)
+                )
+            filtered_dataset = DocumentDataset(profiler.materialize(filtered_dataset.df))
 
-    # 言語ごとにデータセットを分割
-    try:
-        language_stats = separate_by_metadata(
-            filtered_dataset.df,
-            language_separated_output_path,
-            metadata_field=language_field,
-        ).compute()
-        logging.info(f"Language statistics: {language_stats}")
-    except Exception as e:
-        logging.error(f"Error while separating metadata: {e}")
-        return
-
-    # 言語ごとのデータを読み込み、Unicodeエラーを修正
-    lang_data_path = os.path.join(language_separated_output_path, target_language)
-    if not os.path.exists(lang_data_path):
-        logging.error(f"Dataset did not have language: {target_language}")
-        return
-    lang_data = load_dataset(lang_data_path)
-    if lang_data is None:
-        logging.error(f"Failed to load language-specific data for {target_language}")
-        return
-
-    # テキストのUnicode修正を適用
-    lang_data.df['text'] = lang_data.df['text'].apply(fix_unicode)
-
-    # クリーンデータをファイルに書き出す
-    try:
-        write_to_disk(lang_data.df, cleaned_data_output_path, write_to_filename=True)
-        logging.info(f"Cleaned data written to {cleaned_data_output_path}")
-    except Exception as e:
-        logging.error(f"Error while writing cleaned data: {e}")
+        if args.single_pass:
+            # 対象言語のデータだけをメモリ上で抽出し、他の言語はディスクに書き出さない
+            lang_data = DocumentDataset(
+                filtered_dataset.df[filtered_dataset.df[language_field] == target_language]
+            )
+        else:
+            # 言語ごとにデータセットを分割
+            try:
+                with profiler.stage("separate_by_metadata"):
+                    language_stats = separate_by_metadata(
+                        filtered_dataset.df,
+                        language_separated_output_path,
+                        metadata_field=language_field,
+                    ).compute()
+                logging.info(f"Language statistics: {language_stats}")
+            except Exception as e:
+                logging.error(f"Error while separating metadata: {e}")
+                return
+
+            # 言語ごとのデータを読み込み、Unicodeエラーを修正
+            lang_data_path = os.path.join(language_separated_output_path, target_language)
+            if not os.path.exists(lang_data_path):
+                logging.error(f"Dataset did not have language: {target_language}")
+                return
+            lang_data = load_dataset(lang_data_path, args.jsonl_partitioning)
+            if lang_data is None:
+                logging.error(f"Failed to load language-specific data for {target_language}")
+                return
+
+        with profiler.stage("fix_unicode"):
+            # テキストのUnicode修正をパーティション単位で適用
+            lang_data.df['text'] = lang_data.df['text'].map_partitions(
+                fix_unicode_partition, meta=('text', str)
+            )
+            lang_data = DocumentDataset(profiler.materialize(lang_data.df))
+
+        # クリーンデータをファイルに書き出す
+        # single-passでプロファイルしない場合は、言語識別からここまでが1回の計算で実行される
+        try:
+            stage_name = "identify_filter_fix_write" if args.single_pass and not profiler.enabled else "write"
+            with profiler.stage(stage_name):
+                if args.output_format == "parquet":
+                    # 後続のステージがIDとテキストの列だけを読み込めるよう、Parquetに書き出す際に一意なIDを付与する
+                    lang_data = AddId(id_field=args.id_field, id_prefix="doc")(lang_data)
+                write_stage(
+                    lang_data.df,
+                    cleaned_data_output_path,
+                    args.output_format,
+                    partition_size=args.output_partition_size,
+                    write_to_filename=True,
+                )
+            logging.info(f"Cleaned data written to {cleaned_data_output_path}")
+        except Exception as e:
+            logging.error(f"Error while writing cleaned data: {e}")
 
 # コマンドライン引数の設定
 def attach_args(
@@ -141,7 +390,74 @@ def attach_args(
     戻り値:
     - 引数付きのArgumentParserオブジェクト
     """
-    return ArgumentHelper(parser).add_distributed_args()
+    parser = add_profile_args(ArgumentHelper(parser).add_distributed_args())
+    parser = add_stage_io_args(parser, input_format=None, output_format="jsonl")
+    parser.add_argument(
+        "--input-data-dir",
+        default="/workspace/data/mydata/split_curator/0_processed_pro",
+        help="多言語データのディレクトリ",
+    )
+    parser.add_argument(
+        "--language-separated-output-dir",
+        default="/workspace/data/mydata/split_curator/1_Language_Identification_pro",
+        help="言語ごとに分離したデータの出力先",
+    )
+    parser.add_argument(
+        "--output-data-dir",
+        default="/workspace/data/mydata/split_curator/1_cleaned_pro",
+        help="クリーンデータの出力先",
+    )
+    parser.add_argument(
+        "--model-path",
+        default="/workspace/models/Language_identification/lid.176.bin",
+        help="FastText言語識別モデルのパス",
+    )
+    parser.add_argument(
+        "--id-field",
+        default="doc_id",
+        help="--output-format parquetの場合に付与する一意なドキュメントIDのフィールド名",
+    )
+    parser.add_argument(
+        "--single-pass",
+        action="store_true",
+        help="言語ごとのデータを書き出さず、対象言語だけをメモリ上で抽出してUnicode修正と書き出しを1回で行う",
+    )
+    parser.add_argument(
+        "--min-langid-score",
+        type=float,
+        default=0.3,
+        help="FastTextのスコアがこの値未満のドキュメントを除外する",
+    )
+    parser.add_argument(
+        "--script-fast-path",
+        action="store_true",
+        help="かなの比率で明らかな日本語をFastTextを使わずに判定し、残りのドキュメントだけをFastTextで識別する",
+    )
+    parser.add_argument(
+        "--kana-threshold",
+        type=float,
+        default=0.1,
+        help="日本語と判定するかな（ひらがな・カタカナ）の比率の下限",
+    )
+    parser.add_argument(
+        "--japanese-threshold",
+        type=float,
+        default=0.5,
+        help="日本語と判定する日本語の文字（かな、漢字、全角の句読点・記号）の比率の下限",
+    )
+    parser.add_argument(
+        "--min-chars",
+        type=int,
+        default=50,
+        help="文字種で判定するドキュメントの最小文字数（これより短いドキュメントはFastTextで識別する）",
+    )
+    parser.add_argument(
+        "--agreement-sample-size",
+        type=int,
+        default=0,
+        help="指定した件数のドキュメントで、文字種による判定とFastTextの一致率を表示する",
+    )
+    return parser
 
 # スクリプトのエントリーポイント
 if __name__ == "__main__":
@@ -0,0 +1,295 @@
+# Copyright (c) 2024, NVIDIA CORPORATION.  All rights reserved.
+#
+# このファイルはApache License 2.0のもとでライセンスされています。利用条件は上記URLで確認できます。
+#
+# このスクリプトは、新しいクロールのバッチを、過去のすべてのバッチを含むコーパスと照合して完全一致の重複を削除するためのものです。
+# コーパス全体を処理し直す代わりに、ディスク上に永続化したハッシュのインデックスと照合し、新しいハッシュをインデックスに追加します。
+#
+# インデックスはテキストのMD5ハッシュの先頭の文字（プレフィックス）ごとのディレクトリに分かれたファイルです。
+# 各ファイルはMD5ダイジェスト（16バイト）をソートして重複を除いた配列で、非圧縮の.npyとして保存します。
+#   <index_dir>/index.json                    取り込み済みのバッチの一覧
+#   <index_dir>/prefix=<xx>/part-<batch>.npy  バッチごとに追加されたハッシュ
+#   <index_dir>/prefix=<xx>/part-compacted.npy  --compactで統合されたハッシュ
+#
+# バッチはプレフィックスでシャッフルされ、各パーティションは自分のプレフィックスのインデックスファイルを
+# memmapで開き、バッチのハッシュだけを二分探索（searchsorted）で照合します。
+# インデックス全体を読み込まないため、照合で読み込むのはバッチのハッシュ数×log(インデックスのサイズ)程度のページだけになり、
+# 処理時間はコーパス全体ではなく新しいバッチのサイズで決まります。
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from nemo_curator import AddId  # 一意なドキュメントIDの付与
+from nemo_curator.datasets import DocumentDataset  # データセットの読み込みと処理
+from nemo_curator.utils.distributed_utils import get_client  # クライアントの作成
+from nemo_curator.utils.script_utils import ArgumentHelper  # スクリプト引数のヘルパー関数
+
+from stage_io import add_stage_io_args, read_stage, write_stage  # ステージ間の中間データの読み書き
+
+MANIFEST_NAME = "index.json"
+COMPACTED_NAME = "part-compacted.npy"
+HASH_DTYPE = "S16"  # MD5ダイジェスト（16バイト）。バイト列の辞書順でソートされる
+
+
+def load_manifest(index_dir, prefix_chars):
+    """
+    インデックスの取り込み済みバッチの一覧を読み込む。存在しない場合は空の一覧を返す。
+    """
+    manifest_path = os.path.join(index_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {"prefix_chars": prefix_chars, "batches": []}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(index_dir, manifest):
+    """
+    取り込み済みバッチの一覧を一時ファイル経由で書き出す。
+    """
+    manifest_path = os.path.join(index_dir, MANIFEST_NAME)
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def hash_partition(df, text_field, prefix_chars):
+    """
+    各ドキュメントのテキストのMD5ハッシュと、そのプレフィックスの列を追加する。
+    """
+    hashes = df[text_field].map(lambda text: hashlib.md5(text.encode("utf-8")).hexdigest())
+    return df.assign(_hashes=hashes, _prefix=hashes.str[:prefix_chars])
+
+
+def to_digests(hashes):
+    """
+    16進数のMD5ハッシュの列を、16バイトのダイジェストの配列に変換する。
+    """
+    return np.frombuffer(bytes.fromhex("".join(hashes)), dtype=HASH_DTYPE)
+
+
+def save_hashes(path, digests):
+    """
+    ダイジェストの配列を一時ファイル経由で.npyとして書き出す。
+    """
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, digests)
+    os.replace(path + ".tmp", path)
+
+
+def index_paths(index_dir, prefix, batch_name=None):
+    """
+    プレフィックスのインデックスファイルの一覧を返す。
+    途中で失敗したバッチを再実行できるよう、batch_nameのファイルは含めない。
+    """
+    return [
+        path
+        for path in glob.glob(os.path.join(index_dir, f"prefix={prefix}", "*.npy"))
+        if os.path.basename(path) != f"part-{batch_name}.npy"
+    ]
+
+
+def lookup_hashes(paths, digests):
+    """
+    ダイジェストのうち、インデックスファイルのいずれかに含まれるものを判定する。
+    インデックスファイルはmemmapで開き、二分探索で参照する部分だけを読み込む。
+
+    戻り値:
+    - 登録済みのダイジェストの位置がTrueのブール配列
+    """
+    found = np.zeros(len(digests), dtype=bool)
+    for path in paths:
+        index = np.load(path, mmap_mode="r")
+        if not len(index):
+            continue
+        positions = np.minimum(np.searchsorted(index, digests), len(index) - 1)
+        found |= index[positions] == digests
+    return found
+
+
+def write_prefix_hashes(index_dir, prefix, batch_name, digests):
+    """
+    バッチで新しく見つかったハッシュをソートし、プレフィックスのインデックスファイルとして書き出す。
+    ファイル名はバッチとプレフィックスで決まるため、タスクが再実行されても同じファイルが上書きされる。
+    """
+    prefix_dir = os.path.join(index_dir, f"prefix={prefix}")
+    os.makedirs(prefix_dir, exist_ok=True)
+    save_hashes(os.path.join(prefix_dir, f"part-{batch_name}.npy"), np.sort(digests))
+
+
+def dedup_against_index(df, index_dir, id_field, batch_name):
+    """
+    プレフィックスでシャッフルしたパーティションについて、バッチ内の重複とインデックスに登録済みのドキュメントを除外し、
+    残ったドキュメントのハッシュをインデックスに追加する。
+
+    パラメータ:
+    - df: 同じプレフィックスのレコードがすべて含まれるパーティション
+    - index_dir: インデックスのディレクトリ
+    - id_field: IDのフィールド名
+    - batch_name: バッチの名前
+
+    戻り値:
+    - 重複を除外したパーティション
+    """
+    # バッチ内の重複は、IDが最小のドキュメントを残す
+    df = df.sort_values(id_field).drop_duplicates(subset="_hashes", keep="first")
+    kept = []
+    for prefix, group in df.groupby("_prefix", sort=False):
+        digests = to_digests(group["_hashes"])
+        new = ~lookup_hashes(index_paths(index_dir, prefix, batch_name), digests)
+        write_prefix_hashes(index_dir, prefix, batch_name, digests[new])
+        kept.append(group[new])
+    if not kept:
+        return df.drop(columns=["_hashes", "_prefix"])
+    return pd.concat(kept).drop(columns=["_hashes", "_prefix"])
+
+
+def compact_prefix(prefix_dir):
+    """
+    プレフィックスのディレクトリ内のインデックスファイルを、ソートして重複を除いた1つのファイルに統合する。
+
+    戻り値:
+    - 統合したファイルの数
+    """
+    paths = sorted(glob.glob(os.path.join(prefix_dir, "*.npy")))
+    if len(paths) <= 1:
+        return 0
+    compacted_path = os.path.join(prefix_dir, COMPACTED_NAME)
+    save_hashes(compacted_path, np.unique(np.concatenate([np.load(path) for path in paths])))
+    for path in paths:
+        if path != compacted_path:
+            os.remove(path)
+    return len(paths)
+
+
+def count_batch_hashes(index_dir, batch_name):
+    """
+    バッチで新しくインデックスに追加したハッシュの数を、.npyのヘッダーから数える。
+    """
+    paths = glob.glob(os.path.join(index_dir, "prefix=*", f"part-{batch_name}.npy"))
+    return sum(len(np.load(path, mmap_mode="r")) for path in paths)
+
+
+def main(args):
+    """
+    メイン処理関数。新しいバッチを読み込み、インデックスと照合して重複を削除し、新しいハッシュをインデックスに追加します。
+
+    パラメータ:
+    - args: コマンドライン引数
+    """
+    dataset_id_field = args.id_field
+    dataset_text_field = "text"
+    batch_name = args.batch_name or os.path.basename(os.path.normpath(args.input_data_dir))
+    client = get_client(**ArgumentHelper.parse_client_args(args))
+
+    os.makedirs(args.index_dir, exist_ok=True)
+    manifest = load_manifest(args.index_dir, args.prefix_chars)
+    prefix_chars = manifest["prefix_chars"]  # 既存のインデックスのプレフィックス長に合わせる
+    if any(batch["name"] == batch_name for batch in manifest["batches"]):
+        raise ValueError(f"バッチ{batch_name}はすでにインデックスに取り込まれています")
+
+    t0 = time.time()
+
+    # ハッシュの計算にhashlibを使用するため、pandasバックエンドで読み込む
+    input_dataset = DocumentDataset(
+        read_stage(
+            args.input_data_dir, args.input_format, blocksize=args.blocksize, partitioning=args.jsonl_partitioning
+        )
+    )
+    # バッチをまたいでもIDが一意になるよう、バッチ名をIDのプレフィックスにする
+    input_dataset = AddId(id_field=dataset_id_field, id_prefix=batch_name)(input_dataset)
+    df = input_dataset.df
+
+    hashed = df.map_partitions(hash_partition, dataset_text_field, prefix_chars)
+    # 同じプレフィックスのレコードを1つのパーティションに集め、パーティションごとにインデックスと照合する
+    result = hashed.shuffle(on="_prefix", npartitions=df.npartitions).map_partitions(
+        dedup_against_index,
+        args.index_dir,
+        dataset_id_field,
+        batch_name,
+        meta=df._meta,
+    )
+
+    # 重複のないデータセットをディスクに保存（デフォルトはParquet形式）
+    write_stage(result, args.output_data_dir, args.output_format, partition_size=args.output_partition_size)
+
+    # すべてのパーティションの書き出しが終わってから、バッチを取り込み済みとして記録する
+    new_documents = count_batch_hashes(args.index_dir, batch_name)
+    manifest["batches"].append(
+        {"name": batch_name, "new_documents": new_documents, "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    )
+    save_manifest(args.index_dir, manifest)
+    print(f"バッチ{batch_name}: 新しいドキュメント{new_documents}件をインデックスに追加しました")
+
+    # プレフィックスごとのインデックスファイルを並列に統合する
+    if args.compact:
+        prefix_dirs = sorted(glob.glob(os.path.join(args.index_dir, "prefix=*")))
+        merged = client.gather(client.map(compact_prefix, prefix_dirs))
+        print(f"{sum(1 for n in merged if n)}個のプレフィックスで{sum(merged)}ファイルを統合しました")
+
+    # 処理にかかった時間を表示
+    print(time.time() - t0)
+
+
+# コマンドライン引数の設定
+def attach_args(
+    parser=argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    ),
+):
+    """
+    コマンドライン引数を定義する関数。
+
+    戻り値:
+    - 引数を追加したArgumentParserオブジェクト
+    """
+    parser = ArgumentHelper(parser).add_distributed_args()
+    parser = add_stage_io_args(parser, input_format="jsonl", output_format="parquet")
+    parser.add_argument(
+        "--input-data-dir",
+        default="/workspace/data/mydata/split_curator/1_cleaned_pro",
+        help="新しいバッチのデータセットのディレクトリ",
+    )
+    parser.add_argument(
+        "--output-data-dir",
+        default="./",
+        help="重複を除去したデータの出力先",
+    )
+    parser.add_argument(
+        "--index-dir",
+        default="/workspace/data/mydata/dedup_index",
+        help="永続化したハッシュのインデックスのディレクトリ",
+    )
+    parser.add_argument(
+        "--batch-name",
+        default=None,
+        help="バッチの名前（省略時は入力ディレクトリ名）",
+    )
+    parser.add_argument(
+        "--id-field",
+        default="doc_id",
+        help="読み込み時に付与する一意なドキュメントIDのフィールド名",
+    )
+    parser.add_argument(
+        "--prefix-chars",
+        type=int,
+        default=2,
+        help="インデックスを分割するハッシュのプレフィックスの文字数（新しいインデックスの作成時のみ有効）",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="取り込み後に、プレフィックスごとのインデックスファイルを並列に統合する",
+    )
+    return parser
+
+
+# スクリプトのエントリーポイント
+if __name__ == "__main__":
+    main(attach_args().parse_args())
@@ -0,0 +1,341 @@
+# Copyright (c) 2024, NVIDIA CORPORATION.  All rights reserved.
+#
+# このファイルはApache License 2.0のもとでライセンスされています。
+# このスクリプトは、言語識別のあとに残った日本語のドキュメントから、メニュー、日付の一覧、繰り返しの定型文のような
+# 低品質なページを、日本語向けのヒューリスティックで除外するためのものです。
+#
+# パーティション内のテキストの文字コードを連結し、次の指標をNumPyとpandasでまとめて計算します。
+#   hiragana_ratio        ひらがな /（ひらがな + 漢字）。名詞の羅列では低く、極端に高い場合も不自然な文章
+#   symbol_ratio          空白以外の文字に占める記号の比率
+#   repeated_ngram_ratio  ドキュメント内で2回以上出現する文字n-gramの比率
+#   duplicate_line_ratio  空行以外の行のうち、同じドキュメントの前の行と重複する行の比率
+#   mean_sentence_length  文（句点、感嘆符、疑問符、改行で区切る）の平均文字数
+#
+# しきい値はYAMLファイル（config/japanese_quality_filter.yaml）で指定し、値をnullにしたルールは適用しません。
+# 実行後に、ルールごとに除外の条件に当てはまったドキュメントの件数を表示します（1件が複数のルールに当てはまる場合もあります）。
+
+import argparse
+import json
+
+import dask
+import numpy as np
+import pandas as pd
+import yaml
+
+from nemo_curator.utils.distributed_utils import get_client  # クライアントの作成
+from nemo_curator.utils.script_utils import ArgumentHelper  # スクリプト引数のヘルパー関数
+
+from stage_io import add_stage_io_args, read_stage, write_stage  # ステージ間の中間データの読み書き
+from stage_profiler import StageProfiler, add_profile_args  # ステージごとの時間の計測
+
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+DOC_MULTIPLIER = np.uint64(0xC2B2AE3D27D4EB4F)  # ドキュメントごとにハッシュ値をずらすための乗数
+MAX_BATCH_CHARS = 1 << 22  # 指標の計算で一度に連結する文字数の上限（約400万文字）
+SENTENCE_END_CODES = np.array([ord(c) for c in "。！？!?\n"], dtype=np.uint32)
+REJECT_PREFIX = "_reject_"
+
+# 指標ごとの(下限のしきい値の名前, 上限のしきい値の名前)
+RULES = {
+    "hiragana_ratio": ("min_hiragana_ratio", "max_hiragana_ratio"),
+    "symbol_ratio": (None, "max_symbol_ratio"),
+    "repeated_ngram_ratio": (None, "max_repeated_ngram_ratio"),
+    "duplicate_line_ratio": (None, "max_duplicate_line_ratio"),
+    "mean_sentence_length": ("min_mean_sentence_length", "max_mean_sentence_length"),
+}
+
+DEFAULT_THRESHOLDS = {
+    "min_hiragana_ratio": 0.2,
+    "max_hiragana_ratio": 0.95,
+    "max_symbol_ratio": 0.1,
+    "repeated_ngram_size": 10,
+    "max_repeated_ngram_ratio": 0.3,
+    "max_duplicate_line_ratio": 0.3,
+    "min_mean_sentence_length": 10,
+    "max_mean_sentence_length": 250,
+}
+
+
+def load_thresholds(config_path=None):
+    """
+    YAMLファイルからしきい値を読み込み、指定されていない項目はデフォルト値で補う。
+    """
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    if config_path:
+        with open(config_path, "r", encoding="utf-8") as f:
+            config = yaml.safe_load(f) or {}
+        unknown = set(config) - set(DEFAULT_THRESHOLDS)
+        if unknown:
+            raise ValueError(f"不明なしきい値: {sorted(unknown)}")
+        thresholds.update(config)
+    return thresholds
+
+
+def active_rules(thresholds):
+    """
+    値がnullでないしきい値の名前を、指標の順に返す。
+    """
+    return [name for bounds in RULES.values() for name in bounds if name and thresholds.get(name) is not None]
+
+
+def character_classes(codes):
+    """
+    文字コードの配列から、ひらがな、漢字、記号、空白以外の文字のマスクを返す。
+    """
+    hiragana = (codes >= 0x3041) & (codes <= 0x309F)
+    kanji = (
+        ((codes >= 0x3400) & (codes <= 0x4DBF))  # CJK統合漢字拡張A
+        | ((codes >= 0x4E00) & (codes <= 0x9FFF))  # CJK統合漢字
+        | (codes == 0x3005)  # 々
+    )
+    symbol = (
+        ((codes >= 0x21) & (codes <= 0x2F))  # ASCIIの記号
+        | ((codes >= 0x3A) & (codes <= 0x40))
+        | ((codes >= 0x5B) & (codes <= 0x60))
+        | ((codes >= 0x7B) & (codes <= 0x7E))
+        | ((codes >= 0x2010) & (codes <= 0x2BFF))  # 一般句読点、矢印、罫線、図形などの記号
+        | ((codes >= 0x3012) & (codes <= 0x3020))  # 〒、〓、〔〕などの記号
+        | (codes == 0x30FB)  # 中点
+        | ((codes >= 0xFF01) & (codes <= 0xFF0F))  # 全角の記号
+        | ((codes >= 0xFF1A) & (codes <= 0xFF20))
+        | ((codes >= 0xFF3B) & (codes <= 0xFF40))
+        | ((codes >= 0xFF5B) & (codes <= 0xFF65))
+    )
+    non_space = (codes > 0x20) & (codes != 0x3000)
+    return hiragana, kanji, symbol, non_space
+
+
+def repeated_ngram_ratio(codes, starts, lengths, ngram_size):
+    """
+    ドキュメントごとに、2回以上出現する文字n-gramの開始位置の比率を計算する。
+    連結した文字コード全体でn-gramのハッシュ値を計算し、ドキュメントをまたぐn-gramを除いたあと、
+    ドキュメント番号を混ぜたハッシュ値を並べ替えて、隣り合う値が等しいものを数える。
+    """
+    num_ngrams = np.maximum(lengths - ngram_size + 1, 0)
+    num_windows = len(codes) - ngram_size + 1
+    if num_ngrams.sum() == 0 or num_windows <= 0:
+        return np.zeros(len(starts))
+    hashes = np.zeros(num_windows, dtype=np.uint64)
+    for k in range(ngram_size):
+        hashes = hashes * HASH_MULTIPLIER + codes[k : k + num_windows]
+    doc_index = np.repeat(np.arange(len(starts)), lengths)[:num_windows]
+    valid = np.arange(num_windows) + ngram_size <= (starts + lengths)[doc_index]
+    doc_index = doc_index[valid]
+    keys = hashes[valid] + doc_index.astype(np.uint64) * DOC_MULTIPLIER
+
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    same = sorted_keys[1:] == sorted_keys[:-1]
+    repeated = np.zeros(len(keys), dtype=bool)
+    repeated[1:] |= same
+    repeated[:-1] |= same
+    num_repeated = np.bincount(doc_index[order], weights=repeated, minlength=len(starts))
+    return num_repeated / np.maximum(num_ngrams, 1)
+
+
+def duplicate_line_ratio(texts):
+    """
+    ドキュメントごとに、空行以外の行のうち前の行と内容が重複する行の比率を計算する。
+    """
+    lines = pd.Series(texts).str.split("\n").explode().str.strip()
+    lines = lines[lines.str.len() > 0]
+    frame = pd.DataFrame({"doc": lines.index, "line": lines.to_numpy()})
+    num_lines = np.bincount(frame["doc"], minlength=len(texts))
+    num_duplicates = np.bincount(frame["doc"], weights=frame.duplicated(), minlength=len(texts))
+    return num_duplicates / np.maximum(num_lines, 1)
+
+
+def batch_signals(texts, ngram_size):
+    """
+    テキストのリストの品質の指標をまとめて計算する。
+
+    戻り値:
+    - 指標ごとの配列の辞書
+    """
+    encoded = [text.encode("utf-32-le") for text in texts]
+    codes = np.frombuffer(b"".join(encoded), dtype=np.uint32)
+    lengths = np.fromiter((len(b) // 4 for b in encoded), dtype=np.int64, count=len(encoded))
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    hiragana, kanji, symbol, non_space = character_classes(codes)
+
+    def count(mask):
+        cumulative = np.concatenate(([0], np.cumsum(mask, dtype=np.int64)))
+        return cumulative[ends] - cumulative[starts]
+
+    # 句点などが連続する場合は1つの区切りとして数え、末尾が区切りでない場合は最後の文を1つ加える
+    sentence_end = np.isin(codes, SENTENCE_END_CODES)
+    next_is_end = np.zeros(len(codes), dtype=bool)
+    next_is_end[:-1] = sentence_end[1:]
+    nonempty = lengths > 0
+    next_is_end[ends[nonempty] - 1] = False
+    last_is_end = np.zeros(len(texts), dtype=bool)
+    last_is_end[nonempty] = sentence_end[ends[nonempty] - 1]
+    num_sentences = count(sentence_end & ~next_is_end) + (nonempty & ~last_is_end)
+
+    num_chars = count(non_space)
+    num_hiragana = count(hiragana)
+    return {
+        "hiragana_ratio": num_hiragana / np.maximum(num_hiragana + count(kanji), 1),
+        "symbol_ratio": count(symbol) / np.maximum(num_chars, 1),
+        "repeated_ngram_ratio": repeated_ngram_ratio(codes, starts, lengths, ngram_size),
+        "duplicate_line_ratio": duplicate_line_ratio(texts),
+        "mean_sentence_length": num_chars / np.maximum(num_sentences, 1),
+    }
+
+
+def quality_signals(texts, ngram_size):
+    """
+    テキストのSeriesを連結する文字数が上限を超えないバッチに分け、品質の指標を計算する。
+
+    戻り値:
+    - 指標を列とするデータフレーム（行の順序はtextsと同じ、インデックスは0からの連番）
+    """
+    texts = texts.fillna("").tolist()
+    results = []
+    start = 0
+    while start < len(texts):
+        end, num_chars = start, 0
+        while end < len(texts) and (end == start or num_chars + len(texts[end]) <= MAX_BATCH_CHARS):
+            num_chars += len(texts[end])
+            end += 1
+        results.append(pd.DataFrame(batch_signals(texts[start:end], ngram_size)))
+        start = end
+    if not results:
+        return pd.DataFrame({name: pd.Series(dtype=float) for name in RULES})
+    return pd.concat(results, ignore_index=True)
+
+
+def reject_masks(signals, thresholds):
+    """
+    しきい値ごとに、除外の条件に当てはまるドキュメントのマスクを返す。
+    """
+    masks = {}
+    for signal, (min_name, max_name) in RULES.items():
+        if min_name and thresholds.get(min_name) is not None:
+            masks[min_name] = (signals[signal] < thresholds[min_name]).to_numpy()
+        if max_name and thresholds.get(max_name) is not None:
+            masks[max_name] = (signals[signal] > thresholds[max_name]).to_numpy()
+    return masks
+
+
+def score_partition(df, text_field, thresholds):
+    """
+    パーティションの各ドキュメントについて、しきい値ごとに除外の条件に当てはまるかを示す列を追加する。
+    """
+    signals = quality_signals(df[text_field], thresholds["repeated_ngram_size"])
+    masks = reject_masks(signals, thresholds)
+    return df.assign(**{REJECT_PREFIX + name: mask for name, mask in masks.items()})
+
+
+def print_rejection_counts(num_docs, counts, num_rejected):
+    """
+    ルールごとの除外件数を表示する。
+    """
+    print(f"ドキュメント: {num_docs}件, 除外: {num_rejected}件（{num_rejected / max(num_docs, 1):.1%}）")
+    for name, count in counts.items():
+        print(f"  {name}: {count}件（{count / max(num_docs, 1):.1%}）")
+
+
+# コマンドライン引数の設定
+def attach_args(
+    parser=argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    ),
+):
+    """
+    コマンドライン引数を追加するヘルパー関数。
+
+    戻り値:
+    - 引数を追加したArgumentParserオブジェクト
+    """
+    parser = add_profile_args(ArgumentHelper(parser).add_distributed_args())
+    parser = add_stage_io_args(parser, input_format="parquet", output_format="parquet")
+    parser.add_argument(
+        "--input-data-dir",
+        default="/workspace/data/mydata/split_curator/1_cleaned_pro",
+        help="言語識別後のデータセットのディレクトリ",
+    )
+    parser.add_argument(
+        "--output-data-dir",
+        default="/workspace/data/mydata/split_curator/1_quality_filtered_pro",
+        help="品質フィルタを通過したデータの出力先",
+    )
+    parser.add_argument(
+        "--config",
+        default=None,
+        help="しきい値のYAMLファイル（省略時はデフォルト値）",
+    )
+    parser.add_argument(
+        "--stats-output",
+        default=None,
+        help="ルールごとの除外件数を書き出すJSONファイル",
+    )
+    return parser
+
+
+# メイン処理
+def main(args):
+    """
+    品質の指標を計算し、しきい値に当てはまるドキュメントを除外して書き出します。
+
+    パラメータ:
+    - args: コマンドライン引数
+    """
+    thresholds = load_thresholds(args.config)
+    rules = active_rules(thresholds)
+    reject_columns = [REJECT_PREFIX + name for name in rules]
+    dataset_text_field = "text"
+    client = get_client(**ArgumentHelper.parse_client_args(args))
+
+    with StageProfiler(client, args.profile_dir, "japanese_quality_filter") as profiler:
+        with profiler.stage("read"):
+            df = read_stage(
+                args.input_data_dir,
+                args.input_format,
+                blocksize=args.blocksize,
+                add_filename=True,
+                partitioning=args.jsonl_partitioning,
+            )
+            df = profiler.materialize(df)
+
+        with profiler.stage("score"):
+            scored = df.map_partitions(
+                score_partition,
+                dataset_text_field,
+                thresholds,
+                meta=df._meta.assign(**{column: pd.Series(dtype=bool) for column in reject_columns}),
+            )
+            scored = profiler.materialize(scored)
+            rejected = scored[reject_columns].any(axis=1)
+            kept = scored[~rejected].drop(columns=reject_columns)
+            counts = scored[reject_columns].sum()
+
+        with profiler.stage("write"):
+            # 除外件数の集計と書き出しを1回の計算で行い、指標の計算を繰り返さない
+            # JSONLはfilename列の値ごとのファイルに、パーティションをまたいだ行も上書きせずに書き出す
+            write = write_stage(
+                kept,
+                args.output_data_dir,
+                args.output_format,
+                partition_size=args.output_partition_size,
+                write_to_filename=args.output_format == "jsonl",
+                compute=False,
+            )
+            num_docs, counts, num_rejected, _ = dask.compute(scored.shape[0], counts, rejected.sum(), write)
+
+    counts = {name: int(counts[REJECT_PREFIX + name]) for name in rules}
+    print_rejection_counts(int(num_docs), counts, int(num_rejected))
+    if args.stats_output:
+        with open(args.stats_output, "w", encoding="utf-8") as f:
+            json.dump(
+                {"num_docs": int(num_docs), "num_rejected": int(num_rejected), "rejected_by_rule": counts,
+                 "thresholds": thresholds},
+                f,
+                ensure_ascii=False,
+                indent=2,
+            )
+
+
+# スクリプトのエントリーポイント
+if __name__ == "__main__":
+    main(attach_args().parse_args())
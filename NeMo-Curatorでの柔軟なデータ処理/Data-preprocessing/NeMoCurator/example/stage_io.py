@@ -0,0 +1,467 @@
+# Copyright (c) 2024, NVIDIA CORPORATION.  All rights reserved.
+#
+# このファイルはApache License 2.0のもとでライセンスされています。
+# このモジュールは、NeMo Curatorのサンプルスクリプトのステージ間で受け渡す中間データの読み書きをまとめたものです。
+#
+# ステージ間の中間データは、パーティションに分割したParquetファイル（<output_dir>/part.<n>.parquet）で受け渡します。
+# Parquetは列単位で保存されるため、重複排除のようにIDとテキストだけを使うステージは必要な列だけを読み込めます。
+# JSONLとの変換は、パイプラインの入口（process_data_pro.pyの出力）と出口（PEFT用データセットの作成）でだけ行います。
+#
+# 入口でread_dataのadd_filenameで付与したfilename列はParquetの列としてそのまま引き継がれるため、
+# 出口でJSONLに書き出す際にwrite_to_filenameで元のファイル名（processed_pro.jsonlなど）に戻せます。
+# Parquetの行グループやJSONLのバイト範囲で分けたパーティションでは、同じファイル名の行が複数のパーティションにまたがるため、
+# パーティションごとの一時ファイルに書き出してから、ファイル名ごとにパーティションの順に連結します。
+#
+# JSONLの読み込みでは、ファイルごとに1パーティションを作る代わりに、全体のバイト数とワーカーのスレッド数から
+# パーティションの大きさを決め、小さいファイルはまとめ、大きいファイルは行境界に揃えたバイト範囲に分割します。
+# separate_by_metadataやシャードごとの書き出しのあとで数千個の小さいファイルを読み込む場合も、
+# タスク数がスレッド数に見合った数に抑えられ、Daskのスケジューラーのオーバーヘッドが小さくなります。
+#
+# 直接実行すると、既存のデータをJSONLとParquetの間で変換します。
+#
+# 使用例:
+# python example/stage_io.py --input-data-dir <jsonl_dir> --input-format jsonl --output-data-dir <parquet_dir> --output-format parquet
+
+import argparse
+import io
+import os
+import shutil
+import time
+
+import dask
+import dask.dataframe as dd
+import pandas as pd
+import pyarrow.parquet as pq
+
+from nemo_curator.utils.distributed_utils import get_client, read_data, write_to_disk  # データの読み込みと書き出し
+from nemo_curator.utils.file_utils import get_all_files_paths_under  # ファイル検索ユーティリティ
+from nemo_curator.utils.script_utils import ArgumentHelper  # スクリプト引数のヘルパー関数
+
+STAGE_FORMATS = ["jsonl", "parquet"]
+ROW_GROUP_SIZE = 20000  # Parquetの行グループの行数（読み込み時にパーティションを細かく分けられるよう小さめにする）
+PARTITIONS_PER_THREAD = 2  # 1スレッドあたりのパーティション数の目安
+MIN_PARTITION_BYTES = 16 * 2**20  # JSONLの1パーティションあたりの最小のバイト数
+MAX_PARTITION_BYTES = 256 * 2**20  # JSONLの1パーティションあたりの最大のバイト数
+COMPRESSED_SUFFIXES = (".gz", ".zst", ".bz2", ".xz")  # バイト範囲に分割できない圧縮ファイル
+META_SAMPLE_ROWS = 100  # 列の型を推定するために読み込む行数
+FILENAME_PARTS_COLUMNS = ["filename", "part", "number"]  # ファイル名ごとの書き出しの一時ファイルの一覧の列
+
+
+def add_stage_io_args(parser, input_format="jsonl", output_format="jsonl"):
+    """
+    ArgumentHelperで作成したパーサーに中間データの形式とパーティションサイズの引数を追加する。
+
+    パラメータ:
+    - parser: ArgumentParserオブジェクト
+    - input_format: --input-formatのデフォルト値（Noneの場合は入力の引数を追加しない）
+    - output_format: --output-formatのデフォルト値
+
+    戻り値:
+    - 引数を追加したArgumentParserオブジェクト
+    """
+    if input_format is not None:
+        parser.add_argument(
+            "--input-format",
+            choices=STAGE_FORMATS,
+            default=input_format,
+            help="入力データの形式",
+        )
+        parser.add_argument(
+            "--blocksize",
+            default="256MiB",
+            help="Parquetを読み込む際の1パーティションあたりの目安のサイズ",
+        )
+    parser.add_argument(
+        "--jsonl-partitioning",
+        choices=["planned", "per-file"],
+        default="planned",
+        help="JSONLのパーティションの分け方（planned: 全体のバイト数とスレッド数から計画する、per-file: ファイルごと）",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=STAGE_FORMATS,
+        default=output_format,
+        help="出力データの形式（ステージ間の受け渡しはparquet、パイプラインの出口はjsonl）",
+    )
+    parser.add_argument(
+        "--output-partition-size",
+        default=None,
+        help="Parquetを書き出す前にパーティションをこのサイズに揃える（例: 256MB、省略時は揃えない）",
+    )
+    return parser
+
+
+def list_stage_files(input_dir, file_format):
+    """
+    ディレクトリ内の指定した形式のデータファイルを返す。Parquetの場合は_metadataなどの補助ファイルを除く。
+    """
+    files = sorted(get_all_files_paths_under(input_dir))
+    if file_format == "parquet":
+        files = [path for path in files if path.endswith(".parquet")]
+    return files
+
+
+def stage_columns(input_dir, file_format):
+    """
+    中間データの列名を返す。Parquetはファイルのスキーマだけを読み込み、JSONLは列名が分からないためNoneを返す。
+    """
+    if file_format != "parquet":
+        return None
+    files = list_stage_files(input_dir, file_format)
+    return pq.read_schema(files[0]).names if files else []
+
+
+def default_num_threads():
+    """
+    Daskクラスタのワーカーのスレッド数の合計を返す。クライアントがない場合はCPUコア数を返す。
+    """
+    from distributed import get_client as get_dask_client
+
+    try:
+        return max(1, sum(get_dask_client().nthreads().values()))
+    except ValueError:
+        return os.cpu_count() or 1
+
+
+def split_line_ranges(path, size, num_ranges):
+    """
+    ファイルをおよそnum_ranges個の、行境界に揃えたバイト範囲に分割する。
+
+    戻り値:
+    - (開始位置, 終了位置)のタプルのリスト
+    """
+    boundaries = [0]
+    with open(path, "rb") as f:
+        for i in range(1, num_ranges):
+            # 直前の1バイトから読み始めることで、境界がちょうど行頭の場合もその行を次の範囲に含める
+            f.seek(size * i // num_ranges - 1)
+            f.readline()
+            if boundaries[-1] < f.tell() < size:
+                boundaries.append(f.tell())
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def plan_partitions(paths, num_threads, min_bytes=MIN_PARTITION_BYTES, max_bytes=MAX_PARTITION_BYTES):
+    """
+    JSONLファイルの全体のバイト数とスレッド数から1パーティションあたりのバイト数を決め、
+    小さいファイルをまとめ、大きいファイルを行境界に揃えたバイト範囲に分割する。
+
+    パラメータ:
+    - paths: JSONLファイルのパスのリスト
+    - num_threads: ワーカーのスレッド数の合計
+    - min_bytes: 1パーティションあたりの最小のバイト数
+    - max_bytes: 1パーティションあたりの最大のバイト数
+
+    戻り値:
+    - (パーティションのリスト, 1パーティションあたりの目安のバイト数)のタプル
+      各パーティションは(パス, 開始位置, 終了位置)のリスト（終了位置がNoneの場合はファイル全体）
+    """
+    sizes = [(path, os.path.getsize(path)) for path in paths]
+    total_bytes = sum(size for _, size in sizes)
+    target_bytes = int(min(max(total_bytes / (num_threads * PARTITIONS_PER_THREAD), min_bytes), max_bytes))
+
+    partitions = []
+    current, current_bytes = [], 0
+    for path, size in sizes:
+        if size == 0:
+            continue
+        num_ranges = round(size / target_bytes)
+        if num_ranges > 1 and not path.endswith(COMPRESSED_SUFFIXES):
+            # パーティションの順がファイルの順と一致するよう、まとめている途中の小さいファイルを先に確定する
+            if current:
+                partitions.append(current)
+                current, current_bytes = [], 0
+            partitions.extend([(path, start, end)] for start, end in split_line_ranges(path, size, num_ranges))
+            continue
+        if current and current_bytes + size > target_bytes:
+            partitions.append(current)
+            current, current_bytes = [], 0
+        current.append((path, 0, None))
+        current_bytes += size
+    if current:
+        partitions.append(current)
+    return partitions, target_bytes
+
+
+def print_partition_plan(paths, partitions, target_bytes, num_threads):
+    """
+    パーティション計画（ファイル数、パーティション数、まとめたファイル数、分割したファイル数）を表示する。
+    """
+    total_bytes = sum(os.path.getsize(path) for path in paths)
+    num_combined = sum(len(pieces) for pieces in partitions if len(pieces) > 1)
+    num_split = len({pieces[0][0] for pieces in partitions if pieces[0][2] is not None})
+    print(
+        f"パーティション計画: {len(paths)}ファイル（{total_bytes / 2**20:.1f}MiB） -> {len(partitions)}パーティション"
+        f"（目安{target_bytes / 2**20:.1f}MiB、{num_threads}スレッド）、"
+        f"まとめたファイル{num_combined}個、バイト範囲に分割したファイル{num_split}個"
+    )
+
+
+def read_jsonl_pieces(pieces, add_filename=False, nrows=None):
+    """
+    パーティション計画の1パーティション分のファイルまたはバイト範囲を読み込み、1つのデータフレームにする。
+    """
+    frames = []
+    for path, start, end in pieces:
+        if end is None:
+            df = pd.read_json(path, lines=True, nrows=nrows)
+        else:
+            with open(path, "rb") as f:
+                f.seek(start)
+                if nrows is None:
+                    data = f.read(end - start)
+                else:
+                    # 列の型の推定などでは、バイト範囲全体ではなく先頭のnrows行だけを読み込む
+                    lines = []
+                    while len(lines) < nrows and f.tell() < end:
+                        line = f.readline()
+                        if not line:
+                            break
+                        lines.append(line)
+                    data = b"".join(lines)
+            df = pd.read_json(io.BytesIO(data), lines=True)
+        if add_filename:
+            df["filename"] = os.path.basename(path)
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+
+
+def read_planned_jsonl(paths, add_filename=False, num_threads=None):
+    """
+    パーティション計画に従ってJSONLファイルをDaskデータフレームとして読み込み、計画を表示する。
+
+    パラメータ:
+    - paths: JSONLファイルのパスのリスト
+    - add_filename: 各行のファイル名をfilename列として付与する
+    - num_threads: ワーカーのスレッド数の合計（Noneの場合はクラスタから取得）
+
+    戻り値:
+    - Daskデータフレーム
+    """
+    num_threads = num_threads or default_num_threads()
+    partitions, target_bytes = plan_partitions(paths, num_threads)
+    print_partition_plan(paths, partitions, target_bytes, num_threads)
+    if not partitions:
+        # すべてのファイルが空の場合は、ファイルごとの読み込みで空のデータフレームを作る
+        return read_data(paths, file_type="jsonl", backend="pandas", add_filename=add_filename)
+    # 列の型は先頭の数行から推定する（パーティションごとに型が異なる場合もあるため、型の検証は行わない）
+    meta = read_jsonl_pieces(partitions[0][:1], add_filename, nrows=META_SAMPLE_ROWS).iloc[:0]
+    return dd.from_map(
+        read_jsonl_pieces,
+        partitions,
+        add_filename=add_filename,
+        meta=meta,
+        label="read-jsonl-planned",
+        enforce_metadata=False,
+    )
+
+
+def read_stage(
+    input_dir,
+    file_format,
+    columns=None,
+    backend="pandas",
+    blocksize="256MiB",
+    add_filename=False,
+    partitioning="planned",
+):
+    """
+    ステージの中間データをDaskデータフレームとして読み込む。
+
+    パラメータ:
+    - input_dir: データのディレクトリ
+    - file_format: "jsonl"または"parquet"
+    - columns: 読み込む列のリスト（Noneの場合はすべての列）。Parquetでは指定した列だけをディスクから読み込む
+    - backend: "pandas"または"cudf"
+    - blocksize: Parquetの行グループをまとめる1パーティションあたりの目安のサイズ
+    - add_filename: JSONLの場合にfilename列を付与する（Parquetではfilename列が保存されていればそのまま読み込まれる）
+    - partitioning: JSONLのパーティションの分け方（"planned"または"per-file"、plannedはpandasバックエンドのみ）
+
+    戻り値:
+    - Daskデータフレーム
+    """
+    files = list_stage_files(input_dir, file_format)
+    if not files:
+        raise FileNotFoundError(f"{input_dir}に{file_format}のファイルがありません")
+    if file_format == "parquet":
+        with dask.config.set({"dataframe.backend": backend}):
+            return dd.read_parquet(files, columns=columns, blocksize=blocksize, split_row_groups="adaptive")
+    if partitioning == "planned" and backend == "pandas":
+        df = read_planned_jsonl(files, add_filename=add_filename)
+    else:
+        df = read_data(files, file_type="jsonl", backend=backend, add_filename=add_filename)
+    # JSONLは行全体を解析するため、列の選択は読み込み後に行う
+    return df[columns] if columns is not None else df
+
+
+def head_partitions(df, num_rows):
+    """
+    先頭のパーティションから順に、num_rows行が集まるまで読み込む。
+    df.head(num_rows, npartitions=-1)と異なり、すべてのパーティションを1つのタスクにまとめないため、
+    読み込むのは必要な数のパーティションだけになる。読み込むパーティションの数は1, 2, 4, ...と倍にしていく。
+
+    パラメータ:
+    - df: DaskデータフレームまたはDaskシリーズ
+    - num_rows: 取得する行数
+
+    戻り値:
+    - 先頭のnum_rows行（データ全体がnum_rows行未満の場合はすべての行）のpandasオブジェクト
+    """
+    pieces = []
+    num_collected = 0
+    start, step = 0, 1
+    while num_collected < num_rows and start < df.npartitions:
+        stop = min(start + step, df.npartitions)
+        piece = df.partitions[start:stop].compute()
+        pieces.append(piece)
+        num_collected += len(piece)
+        start, step = stop, step * 2
+    if not pieces:
+        return df._meta
+    return pd.concat(pieces).iloc[:num_rows]
+
+
+def write_filename_parts(df, parts_dir, partition_info=None):
+    """
+    パーティションの行をfilename列の値ごとに一時ファイルに書き出す（filename列は出力しない）。
+
+    戻り値:
+    - (filename, 一時ファイルのパス, パーティション番号)のデータフレーム
+    """
+    if not isinstance(df, pd.DataFrame):
+        df = df.to_pandas()
+    number = partition_info["number"] if partition_info is not None else 0
+    rows = []
+    for i, (filename, group) in enumerate(df.groupby("filename", sort=False)):
+        path = os.path.join(parts_dir, f"part-{number:06d}-{i:04d}.jsonl")
+        text = group.drop(columns="filename").to_json(orient="records", lines=True, force_ascii=False)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text if not text or text.endswith("\n") else text + "\n")
+        rows.append((filename, path, number))
+    return pd.DataFrame(rows, columns=FILENAME_PARTS_COLUMNS)
+
+
+def merge_filename_parts(parts, output_dir, parts_dir):
+    """
+    一時ファイルをファイル名ごとにパーティションの順に連結し、<output_dir>/<filename>に書き出す。
+
+    戻り値:
+    - 書き出したファイルの数
+    """
+    parts = parts.sort_values(["number", "part"])
+    for filename, group in parts.groupby("filename", sort=False):
+        with open(os.path.join(output_dir, filename), "wb") as out:
+            for path in group["part"]:
+                with open(path, "rb") as f:
+                    shutil.copyfileobj(f, out)
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    return parts["filename"].nunique()
+
+
+def write_jsonl_by_filename(df, output_dir, compute=True):
+    """
+    filename列の値ごとのJSONLファイルに書き出す。同じファイル名の行が複数のパーティションにまたがっていても、
+    パーティションごとに上書きせず、すべての行を元の順に書き出す。
+
+    パラメータ:
+    - df: filename列を持つDaskデータフレーム
+    - output_dir: 出力先のディレクトリ
+    - compute: Falseの場合、書き出しを遅延オブジェクトとして返す
+
+    戻り値:
+    - compute=Falseの場合は書き出しの遅延オブジェクト、それ以外は書き出したファイルの数
+    """
+    parts_dir = os.path.join(output_dir, ".parts")
+    # 前回の実行が途中で終了した場合に残った一時ファイルを削除する
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    os.makedirs(parts_dir, exist_ok=True)
+    meta = pd.DataFrame({column: pd.Series(dtype="int64" if column == "number" else object) for column in FILENAME_PARTS_COLUMNS})
+    parts = df.map_partitions(write_filename_parts, parts_dir, meta=meta, enforce_metadata=False)
+    merged = dask.delayed(merge_filename_parts)(parts, output_dir, parts_dir)
+    return merged.compute() if compute else merged
+
+
+def write_stage(df, output_dir, file_format, partition_size=None, write_to_filename=False, compute=True):
+    """
+    ステージの出力を書き出す。Parquetの場合はパーティションごとに1ファイルを書き出す。
+
+    パラメータ:
+    - df: Daskデータフレーム
+    - output_dir: 出力先のディレクトリ
+    - file_format: "jsonl"または"parquet"
+    - partition_size: Parquetを書き出す前にパーティションを揃えるサイズ（Noneの場合は揃えない）
+    - write_to_filename: JSONLの場合にfilename列の値ごとのファイルに書き出す
+    - compute: Falseの場合、Parquetまたはwrite_to_filenameでのJSONLの書き出しを遅延オブジェクトとして返す
+               （他の集計と1回の計算で実行できる）
+
+    戻り値:
+    - compute=Falseの場合は書き出しの遅延オブジェクト、それ以外はNone
+    """
+    if file_format == "jsonl":
+        if write_to_filename:
+            # パーティションがファイル名ごとにまとまっているとは限らないため、write_to_diskのファイル名ごとの書き出しは使わない
+            written = write_jsonl_by_filename(df, output_dir, compute=compute)
+            return None if compute else written
+        if not compute:
+            raise ValueError("JSONLの書き出しは遅延できません")
+        write_to_disk(df, output_dir, output_type="jsonl")
+        return
+    if partition_size is not None:
+        # パーティションごとのメモリ使用量を計算するため、入力を1回余分に読み込む
+        df = df.repartition(partition_size=partition_size)
+    kwargs = {"row_group_size": ROW_GROUP_SIZE} if isinstance(df._meta, pd.DataFrame) else {}
+    return df.to_parquet(output_dir, write_index=False, compute=compute, **kwargs)
+
+
+# コマンドライン引数の設定
+def attach_args(
+    parser=argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    ),
+):
+    """
+    コマンドライン引数を追加するヘルパー関数。
+
+    戻り値:
+    - 引数を追加したArgumentParserオブジェクト
+    """
+    parser = add_stage_io_args(
+        ArgumentHelper(parser).add_distributed_args(), input_format="jsonl", output_format="parquet"
+    )
+    parser.add_argument("--input-data-dir", required=True, help="変換するデータのディレクトリ")
+    parser.add_argument("--output-data-dir", required=True, help="変換したデータの出力先")
+    return parser
+
+
+# メイン処理
+def main(args):
+    """
+    データをJSONLとParquetの間で変換します。filename列は保持されます。
+
+    パラメータ:
+    - args: コマンドライン引数
+    """
+    client = get_client(**ArgumentHelper.parse_client_args(args))
+    t0 = time.time()
+    df = read_stage(
+        args.input_data_dir,
+        args.input_format,
+        blocksize=args.blocksize,
+        add_filename=True,
+        partitioning=args.jsonl_partitioning,
+    )
+    write_stage(
+        df,
+        args.output_data_dir,
+        args.output_format,
+        partition_size=args.output_partition_size,
+        write_to_filename="filename" in df.columns,
+    )
+    print(f"{args.input_data_dir}（{args.input_format}）を{args.output_data_dir}（{args.output_format}）に変換しました")
+    print(time.time() - t0)
+
+
+# スクリプトのエントリーポイント
+if __name__ == "__main__":
+    main(attach_args().parse_args())
@@ -0,0 +1,185 @@
+# Copyright (c) 2024, NVIDIA CORPORATION.  All rights reserved.
+#
+# このファイルはApache License 2.0のもとでライセンスされています。
+# このモジュールは、NeMo Curatorのサンプルスクリプトの各ステージ（読み込み、スコア計算、シャッフル、書き出しなど）の
+# 経過時間を記録し、最も遅いステージとパーティション（タスク）を特定するためのものです。
+#
+# 各ステージの経過時間と、Daskのタスクストリームから集計した処理ごとの計算時間は常に表示されます。
+# --profile-dirを指定すると、さらに次のファイルを書き出します。
+#   dask-report.html    Daskのパフォーマンスレポート（タスクストリーム、ワーカーのプロファイル、通信量）
+#   stage_summary.json  ステージごとの経過時間、計算時間、最も遅いタスク、クラスタのメモリ使用量のピーク
+#
+# --profile-dirを指定した場合は、ステージの境界で中間結果をpersistし、各ステージの時間を分けて計測します。
+# そのため、プロファイル時のメモリ使用量は通常の実行より大きくなります。
+#
+# 使用例:
+# parser = add_profile_args(ArgumentHelper(parser).add_distributed_args())
+# with StageProfiler(client, args.profile_dir, "exact_deduplication") as profiler:
+#     with profiler.stage("read"):
+#         df = profiler.materialize(read_json(...))
+
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager, nullcontext
+
+from dask.distributed import get_task_stream, performance_report, wait
+from dask.utils import key_split
+
+NUM_SLOWEST_TASKS = 5  # ステージごとに記録する最も遅いタスクの数
+
+
+def add_profile_args(parser):
+    """
+    ArgumentHelperで作成したパーサーにプロファイル用の引数を追加する。
+
+    戻り値:
+    - 引数を追加したArgumentParserオブジェクト
+    """
+    parser.add_argument(
+        "--profile-dir",
+        default=None,
+        help="Daskのパフォーマンスレポート（HTML）とステージごとの集計（JSON）の出力先",
+    )
+    return parser
+
+
+def summarize_task_stream(tasks):
+    """
+    タスクストリームの記録から、処理ごとの計算時間と最も遅いタスクを集計する。
+
+    パラメータ:
+    - tasks: get_task_streamで記録したタスクのリスト
+
+    戻り値:
+    - (処理名ごとの計算時間の辞書, 最も遅いタスクのリスト)のタプル
+    """
+    compute_seconds = defaultdict(float)
+    task_seconds = []
+    for task in tasks:
+        seconds = sum(
+            startstop["stop"] - startstop["start"]
+            for startstop in task["startstops"]
+            if startstop["action"] == "compute"
+        )
+        compute_seconds[key_split(task["key"])] += seconds
+        task_seconds.append((seconds, task))
+    task_seconds.sort(key=lambda item: item[0], reverse=True)
+    slowest = [
+        {
+            "key": str(task["key"]),
+            "name": key_split(task["key"]),
+            "seconds": round(seconds, 3),
+            "worker": task.get("worker"),
+        }
+        for seconds, task in task_seconds[:NUM_SLOWEST_TASKS]
+    ]
+    return dict(sorted(compute_seconds.items(), key=lambda item: item[1], reverse=True)), slowest
+
+
+class StageProfiler:
+    """
+    ステージごとの経過時間とDaskのタスクストリームを記録するクラス。
+    """
+
+    def __init__(self, client, profile_dir=None, script_name=None):
+        """
+        パラメータ:
+        - client: Daskクライアント
+        - profile_dir: パフォーマンスレポートと集計の出力先（Noneの場合は表示のみ）
+        - script_name: 集計に記録するスクリプト名
+        """
+        self.client = client
+        self.profile_dir = profile_dir
+        self.script_name = script_name
+        self.stages = []
+        self._memory_sampler = None
+        self._exit_stack = None
+        self._t0 = None
+
+    @property
+    def enabled(self):
+        """
+        パフォーマンスレポートと集計を書き出すかどうか。
+        """
+        return self.profile_dir is not None
+
+    def __enter__(self):
+        self._t0 = time.perf_counter()
+        self._exit_stack = ExitStack()
+        if self.enabled:
+            from distributed.diagnostics import MemorySampler
+
+            os.makedirs(self.profile_dir, exist_ok=True)
+            self._memory_sampler = MemorySampler()
+            self._exit_stack.enter_context(
+                performance_report(filename=os.path.join(self.profile_dir, "dask-report.html"))
+            )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._exit_stack.close()
+        total_seconds = time.perf_counter() - self._t0
+        print(f"total: {total_seconds:.1f}s")
+        if self.enabled:
+            self.write_summary(total_seconds, failed=exc_type is not None)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        ブロック内の処理を1つのステージとして計測する。
+        """
+        memory = (
+            self._memory_sampler.sample(name, client=self.client, measure="process")
+            if self._memory_sampler is not None
+            else nullcontext()
+        )
+        t0 = time.perf_counter()
+        with get_task_stream(self.client) as task_stream, memory:
+            yield
+        wall_seconds = time.perf_counter() - t0
+        compute_seconds, slowest_tasks = summarize_task_stream(task_stream.data)
+        self.stages.append(
+            {
+                "stage": name,
+                "wall_seconds": round(wall_seconds, 3),
+                "num_tasks": len(task_stream.data),
+                "compute_seconds": {task_name: round(s, 3) for task_name, s in compute_seconds.items()},
+                "slowest_tasks": slowest_tasks,
+            }
+        )
+        print(f"[{name}] elapsed: {wall_seconds:.1f}s, {len(task_stream.data)} tasks")
+        for task_name, seconds in compute_seconds.items():
+            print(f"[{name}]   {task_name}: {seconds:.1f}s (compute, all workers)")
+
+    def materialize(self, df):
+        """
+        プロファイル時は中間結果をpersistして計算を完了させ、時間が現在のステージに計上されるようにする。
+        プロファイルしない場合はそのまま返す。
+        """
+        if not self.enabled:
+            return df
+        df = df.persist()
+        wait(df)
+        return df
+
+    def write_summary(self, total_seconds, failed=False):
+        """
+        ステージごとの集計と、クラスタのメモリ使用量のピークをJSONとして書き出す。
+        """
+        peak_memory = {}
+        if self._memory_sampler is not None and self._memory_sampler.samples:
+            memory = self._memory_sampler.to_pandas()
+            peak_memory = {stage: int(memory[stage].max()) for stage in memory.columns}
+        for stage in self.stages:
+            stage["peak_memory_bytes"] = peak_memory.get(stage["stage"])
+        summary = {
+            "script": self.script_name,
+            "failed": failed,
+            "total_seconds": round(total_seconds, 3),
+            "slowest_stage": max(self.stages, key=lambda s: s["wall_seconds"])["stage"] if self.stages else None,
+            "stages": self.stages,
+        }
+        with open(os.path.join(self.profile_dir, "stage_summary.json"), "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
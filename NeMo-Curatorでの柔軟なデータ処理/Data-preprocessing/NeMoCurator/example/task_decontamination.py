@@ -6,53 +6,191 @@
 
 import argparse
 
+import numpy as np
+import pandas as pd
+
 import nemo_curator as nc  # NeMo Curator モジュール
 from nemo_curator.datasets import DocumentDataset  # ドキュメントデータセット
-from nemo_curator.tasks import (  # タスク群（除外対象として使うデータセット）
-    ANLI,
-    CB,
-    PIQA,
-    RTE,
-    WSC,
-    ArcChallenge,
-    ArcEasy,
-    BoolQ,
-    Copa,
-    Drop,
-    MultiRC,
-    OpenBookQA,
-    Quac,
-    Race,
-    Record,
-    Squad,
-    TriviaQA,
-    WebQA,
-    WiC,
-    Winogrande,
+from nemo_curator.utils.distributed_utils import (  # データ操作ユーティリティ
+    get_client,
+    load_object_on_worker,
 )
-from nemo_curator.utils.distributed_utils import get_client, read_data, write_to_disk  # データ操作ユーティリティ
-from nemo_curator.utils.file_utils import get_all_files_paths_under  # ファイル操作ユーティリティ
 from nemo_curator.utils.script_utils import ArgumentHelper  # スクリプト引数ヘルパー
 
+from aho_corasick_matcher import AhoCorasickMatcher  # 文字単位のマッチャー
+from decontamination_index import (  # タスクのn-gramのインデックス
+    build_downstream_tasks,
+    find_ngram_matches,
+    load_index,
+)
+from stage_io import add_stage_io_args, read_stage, write_stage  # ステージ間の中間データの読み書き
+from stage_profiler import StageProfiler, add_profile_args  # ステージごとの時間の計測
+
 
 # データセットを読み込む関数
-def load_dataset(input_data_dir):
+def load_dataset(input_data_dir, file_format="jsonl", blocksize="256MiB", partitioning="planned"):
     """
     指定されたディレクトリからファイルを読み込み、データセットとして返します。
 
     パラメータ:
     - input_data_dir: データのディレクトリパス
+    - file_format: 入力データの形式（"jsonl"または"parquet"）
+    - blocksize: Parquetを読み込む際の1パーティションあたりの目安のサイズ
+    - partitioning: JSONLのパーティションの分け方（"planned"または"per-file"）
 
     戻り値:
     - 読み込まれたドキュメントデータセット
     """
-    files = list(get_all_files_paths_under(input_data_dir))  # ディレクトリ内のすべてのファイルを取得
-    raw_data = read_data(files, file_type="jsonl", backend="pandas", add_filename=True)  # JSONLファイルを読み込み
+    # JSONLの場合はfilename列を付与する（Parquetの場合は入口で付与したfilename列がそのまま読み込まれる）
+    raw_data = read_stage(
+        input_data_dir, file_format, blocksize=blocksize, add_filename=True, partitioning=partitioning
+    )
     dataset = DocumentDataset(raw_data)  # データセットを作成
 
     return dataset
 
 
+# マッチした範囲の前後を除去してドキュメントを分割する関数
+def split_around_spans(text, spans, remove_char_each_side, min_document_length, max_splits):
+    """
+    TaskDecontaminationと同様に、マッチした範囲の前後remove_char_each_side文字を除去し、残りの部分に分割します。
+
+    パラメータ:
+    - text: ドキュメントのテキスト
+    - spans: マッチした範囲（開始文字位置, 終了文字位置）のリスト
+    - remove_char_each_side: マッチした範囲の前後で除去する文字数
+    - min_document_length: 残す断片の最小文字数
+    - max_splits: 除去する範囲がこの数を超えるドキュメントは全体を除外する
+
+    戻り値:
+    - 残す断片のリスト（ドキュメント全体を除外する場合は空のリスト）
+    """
+    if not spans:
+        return [text]
+    merged = []
+    for start, end in sorted(spans):
+        start, end = max(0, start - remove_char_each_side), min(len(text), end + remove_char_each_side)
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    if len(merged) > max_splits:
+        return []
+    fragments = []
+    previous_end = 0
+    for start, end in merged:
+        fragments.append(text[previous_end:start])
+        previous_end = end
+    fragments.append(text[previous_end:])
+    return [fragment for fragment in fragments if len(fragment) >= min_document_length]
+
+
+# 照合方法に応じてマッチャーを作成する関数
+def load_matcher(matcher_type, path, char_ngram=0):
+    """
+    テキストを受け取り、(マッチしたn-gramまたはパターンの番号, 開始文字位置, 終了文字位置)のリストを返す関数を作成します。
+
+    パラメータ:
+    - matcher_type: "ngram-index"（decontamination_index.pyのインデックス）または"aho-corasick"（文字単位の照合）
+    - path: インデックスのディレクトリ、または評価タスクの文字列のファイル
+    - char_ngram: aho-corasickの場合に評価タスクの文字列を分割する文字数
+
+    戻り値:
+    - テキストを受け取る照合関数
+    """
+    if matcher_type == "ngram-index":
+        ngrams, meta = load_index(path)
+        return lambda text: find_ngram_matches(text, ngrams, meta["ngram_sizes"])
+    return AhoCorasickMatcher.from_file(path, char_ngram).find_matches
+
+
+# ワーカーごとに1回だけマッチャーを作成する関数
+def get_matcher(matcher_spec):
+    """
+    (照合方法, パス, 文字数)のタプルに対応するマッチャーをワーカー上に1回だけ作成し、以降は再利用します。
+    """
+    matcher_type, path, char_ngram = matcher_spec
+    return load_object_on_worker(
+        f"decontamination_matcher_{matcher_type}",
+        load_matcher,
+        {"matcher_type": matcher_type, "path": path, "char_ngram": char_ngram},
+    )
+
+
+# パーティション内でマッチしたn-gramを列挙する関数
+def collect_matches_partition(df, matcher_spec, text_field):
+    """
+    各ドキュメントを照合し、マッチしたn-gramのハッシュ値（またはパターンの番号）を出現ごとに返します。
+    """
+    find_matches = get_matcher(matcher_spec)
+    return pd.Series(
+        [key for text in df[text_field] for key, _, _ in find_matches(text)],
+        dtype=np.uint64,
+    )
+
+
+# パーティション内のマッチした範囲を除去する関数
+def remove_matches_partition(
+    df, matcher_spec, text_field, frequent_ngrams, remove_char_each_side, min_document_length, max_splits
+):
+    """
+    出現回数の多すぎるn-gramを除いてマッチした範囲を除去し、分割された断片をそれぞれ1行とするデータフレームを返します。
+    """
+    find_matches = get_matcher(matcher_spec)
+    fragments = []
+    for text in df[text_field]:
+        spans = [(start, end) for key, start, end in find_matches(text) if key not in frequent_ngrams]
+        fragments.append(split_around_spans(text, spans, remove_char_each_side, min_document_length, max_splits))
+    result = df.assign(**{text_field: fragments}).explode(text_field)
+    return result[result[text_field].notna()]
+
+
+# マッチャーを使用してタスクに関連するデータを除去する関数
+def decontaminate_with_matcher(
+    dataset,
+    matcher_spec,
+    text_field="text",
+    max_matches=10,
+    remove_char_each_side=200,
+    min_document_length=200,
+    max_splits=10,
+):
+    """
+    decontamination_index.pyのインデックス、またはAho-Corasickマッチャーを使用して、TaskDecontaminationと同じ手順で除去を行います。
+
+    1. 各ワーカーがマッチャーを1回だけ作成し（インデックスの場合はメモリマップし）、
+       データセット全体でマッチしたn-gramの出現回数を数える。
+    2. 出現回数がmax_matchesを超えるn-gramは一般的な表現とみなして除去の対象から外す。
+    3. 残りのn-gramにマッチした範囲の前後を除去し、ドキュメントを分割する。
+
+    パラメータ:
+    - dataset: 除去前のドキュメントデータセット
+    - matcher_spec: (照合方法, パス, 文字数)のタプル（load_matcherを参照）
+    - その他: TaskDecontaminationの同名のパラメータと同じ
+
+    戻り値:
+    - 除去後のドキュメントデータセット
+    """
+    df = dataset.df
+    match_counts = (
+        df.map_partitions(collect_matches_partition, matcher_spec, text_field, meta=(None, np.uint64))
+        .value_counts()
+        .compute()
+    )
+    frequent_ngrams = frozenset(int(h) for h in match_counts[match_counts > max_matches].index)
+    result = df.map_partitions(
+        remove_matches_partition,
+        matcher_spec,
+        text_field,
+        frequent_ngrams,
+        remove_char_each_side,
+        min_document_length,
+        max_splits,
+        meta=df._meta,
+    )
+    return DocumentDataset(result)
+
+
 # メイン処理
 def main(args):
     """
@@ -62,47 +200,49 @@ def main(args):
     - args: コマンドライン引数
     """
     # データセットのパス設定
-    contaminated_dataset_path = "/workspace/data/mydata/split_curator/1_cleaned_pro"  # 除去前のデータセット
-    decontaminated_output_path = "/workspace/data/mydata/split_curator/3_decontamination_pro"  # 除去後の出力先
-
-    # 除去の対象となるダウンストリームタスクを定義
-    downstream_tasks = [
-        Winogrande(),
-        Squad(),
-        TriviaQA(),
-        Quac(),
-        WebQA(),
-        Race(),
-        Drop(),
-        WiC(),
-        PIQA(),
-        ArcEasy(),
-        ArcChallenge(),
-        OpenBookQA(),
-        BoolQ(),
-        Copa(),
-        RTE(),
-        MultiRC(),
-        WSC(),
-        CB(),
-        ANLI(),
-        Record(),
-    ]
+    contaminated_dataset_path = args.input_data_dir  # 除去前のデータセット
+    decontaminated_output_path = args.output_data_dir  # 除去後の出力先
 
     # クライアント設定の準備
     client = get_client(**ArgumentHelper.parse_client_args(args))
 
-    # データセットの読み込み
-    target_dataset = load_dataset(contaminated_dataset_path)
+    if args.ngram_index and args.char_patterns:
+        raise ValueError("--ngram-indexと--char-patternsは同時に指定できません")
 
-    # 除去処理のインスタンス化と適用
-    decontaminator = nc.TaskDecontamination(downstream_tasks)
-    decontaminated_dataset = decontaminator(target_dataset)
+    with StageProfiler(client, args.profile_dir, "task_decontamination") as profiler:
+        with profiler.stage("read"):
+            # データセットの読み込み
+            target_dataset = load_dataset(
+                contaminated_dataset_path, args.input_format, args.blocksize, args.jsonl_partitioning
+            )
+            target_dataset = DocumentDataset(profiler.materialize(target_dataset.df))
 
-    # フィルタリングされたデータセットをディスクに書き出し
-    write_to_disk(
-        decontaminated_dataset.df, decontaminated_output_path, write_to_filename=True
-    )
+        with profiler.stage("decontaminate"):
+            if args.ngram_index:
+                # 作成済みのインデックスをメモリマップして照合する
+                decontaminated_dataset = decontaminate_with_matcher(
+                    target_dataset, ("ngram-index", args.ngram_index, 0)
+                )
+            elif args.char_patterns:
+                # 評価タスクの文字列をAho-Corasickオートマトンにまとめ、文字単位で照合する
+                decontaminated_dataset = decontaminate_with_matcher(
+                    target_dataset, ("aho-corasick", args.char_patterns, args.char_ngram)
+                )
+            else:
+                # 除去の対象となるダウンストリームタスクを定義し、除去処理をインスタンス化して適用
+                decontaminator = nc.TaskDecontamination(build_downstream_tasks())
+                decontaminated_dataset = decontaminator(target_dataset)
+            decontaminated_dataset = DocumentDataset(profiler.materialize(decontaminated_dataset.df))
+
+        with profiler.stage("write"):
+            # フィルタリングされたデータセットをディスクに書き出し
+            write_stage(
+                decontaminated_dataset.df,
+                decontaminated_output_path,
+                args.output_format,
+                partition_size=args.output_partition_size,
+                write_to_filename=True,
+            )
 
 
 # コマンドライン引数の設定
@@ -117,7 +257,35 @@ def attach_args(
     戻り値:
     - 引数を追加したArgumentParserオブジェクト
     """
-    return ArgumentHelper(parser).add_distributed_args()
+    parser = add_profile_args(ArgumentHelper(parser).add_distributed_args())
+    parser = add_stage_io_args(parser, input_format="jsonl", output_format="jsonl")
+    parser.add_argument(
+        "--input-data-dir",
+        default="/workspace/data/mydata/split_curator/1_cleaned_pro",
+        help="除去前のデータセットのディレクトリ",
+    )
+    parser.add_argument(
+        "--output-data-dir",
+        default="/workspace/data/mydata/split_curator/3_decontamination_pro",
+        help="除去後のデータセットの出力先",
+    )
+    parser.add_argument(
+        "--ngram-index",
+        default=None,
+        help="decontamination_index.pyで作成したタスクのn-gramのインデックス（省略時は実行のたびにタスクから作成する）",
+    )
+    parser.add_argument(
+        "--char-patterns",
+        default=None,
+        help="文字単位で照合する評価タスクの文字列のファイル（1行に1つの文字列、または'text'フィールドを持つJSONL）",
+    )
+    parser.add_argument(
+        "--char-ngram",
+        type=int,
+        default=20,
+        help="--char-patternsの文字列をこの文字数の部分文字列に分けて照合する（0の場合は文字列全体）",
+    )
+    return parser
 
 
 # スクリプトのエントリーポイント
@@ -0,0 +1,59 @@
+# Copyright (c) 2024, NVIDIA CORPORATION.  All rights reserved.
+#
+# このファイルはApache License 2.0のもとでライセンスされています。
+# stage_io.pyのパーティション計画と、ファイル名ごとのJSONLの書き出しのテストです。
+#
+# 使用例:
+# cd example && python -m pytest -q test_stage_io.py
+
+import json
+import os
+
+import pytest
+
+pytest.importorskip("dask")
+pytest.importorskip("nemo_curator")
+
+import dask
+import dask.dataframe as dd
+
+from stage_io import plan_partitions, read_jsonl_pieces, write_stage
+
+
+def write_jsonl(path, start, num_rows):
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(start, start + num_rows):
+            f.write(json.dumps({"id": i, "text": f"テキスト{i}" * 10}, ensure_ascii=False) + "\n")
+
+
+def test_split_file_is_written_back_completely(tmp_path):
+    input_dir, output_dir = tmp_path / "input", tmp_path / "output"
+    input_dir.mkdir()
+    write_jsonl(input_dir / "a_small.jsonl", 0, 50)
+    write_jsonl(input_dir / "b_large.jsonl", 50, 5000)
+    write_jsonl(input_dir / "c_small.jsonl", 5050, 50)
+    paths = sorted(str(path) for path in input_dir.iterdir())
+
+    partitions, _ = plan_partitions(paths, num_threads=4, min_bytes=1, max_bytes=64 * 1024)
+    large_ranges = [pieces for pieces in partitions if pieces[0][0].endswith("b_large.jsonl")]
+    assert len(large_ranges) > 1
+    # パーティションの順はファイルの順と一致する
+    assert [pieces[0][0] for pieces in partitions] == sorted(pieces[0][0] for pieces in partitions)
+
+    meta = read_jsonl_pieces(partitions[0][:1], add_filename=True, nrows=10).iloc[:0]
+    df = dd.from_map(read_jsonl_pieces, partitions, add_filename=True, meta=meta, enforce_metadata=False)
+    with dask.config.set(scheduler="synchronous"):
+        write_stage(df, str(output_dir), "jsonl", write_to_filename=True)
+
+    assert sorted(os.listdir(output_dir)) == ["a_small.jsonl", "b_large.jsonl", "c_small.jsonl"]
+    with open(output_dir / "b_large.jsonl", encoding="utf-8") as f:
+        ids = [json.loads(line)["id"] for line in f]
+    assert ids == list(range(50, 5050))
+
+
+def test_meta_sample_reads_only_leading_rows(tmp_path):
+    path = tmp_path / "large.jsonl"
+    write_jsonl(path, 0, 1000)
+    size = os.path.getsize(path)
+    sample = read_jsonl_pieces([(str(path), 0, size)], nrows=10)
+    assert sample["id"].tolist() == list(range(10))
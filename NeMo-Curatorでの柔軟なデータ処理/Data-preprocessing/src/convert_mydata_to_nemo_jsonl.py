@@ -5,34 +5,20 @@
 前処理に利用されます。
 """
 
-import json
 import os
-import random
+
+from external_shuffle import estimate_num_buckets, shuffle_split_jsonl
+from jsonl_io import read_jsonl, write_jsonl
  
 # 入力ファイルと出力ディレクトリのパスを指定
 INPUT_TRAIN = ""  # トレーニングデータの入力ファイル
 INPUT_VALID = ""  # 検証データの入力ファイル
 OUTPUT_DIR = "./data/mydata"  # 出力されるデータの保存ディレクトリ
+NUM_VALID = 1000  # トレーニングデータから検証データに回すレコード数
  
-# 乱数シードを固定することで結果の再現性を確保
-random.seed(42)
 # 出力ディレクトリを作成。既に存在する場合は何もしない
 os.makedirs(OUTPUT_DIR, exist_ok=True)
  
-# JSON Lines形式でファイルに書き出す関数
-def write_jsonl(fname, json_objs):
-    """
-    json_objsに含まれるオブジェクトをJSONL形式でファイルに書き出す。
-    
-    Parameters:
-    fname (str): 出力ファイルのパス
-    json_objs (list): JSONオブジェクトのリスト
-    """
-    with open(fname, 'wt') as f:
-        # json_objsの各オブジェクトを1行ごとに書き込む
-        for o in json_objs:
-            f.write(json.dumps(o, ensure_ascii=False) + "\n")
- 
 # データセットの1つのオブジェクトをフォーマットし、指示や入力を含むプロンプトを作成
 def form_data(obj):
     """
@@ -54,6 +40,25 @@ def form_data(obj):
     st += "### 応答:"
     return st
  
+# 入力データを1件ずつプロンプトと応答の形式に変換するジェネレーター
+def iter_processed(input_path):
+    """
+    入力ファイルを1行ずつ読み込み、プロンプトと応答を含む形式に変換して返す。
+    
+    Parameters:
+    input_path (str): 入力データファイルのパス
+    
+    Yields:
+    dict: 'input'と'output'を持つオブジェクト
+    """
+    for data in read_jsonl(input_path):
+        # プロンプトを作成
+        prompt = form_data(data)
+        # 正しい答えを取得
+        answer = data[f"choice{data['label']}"]
+        # 'input'と'output'として保存
+        yield {"input": prompt, "output": f"{answer}"}
+ 
 # データの処理を行う関数
 # input_path: 入力データファイルのパス
 # train: Trueの場合、データをトレーニングと検証に分割
@@ -65,30 +70,19 @@ def prosess(input_path, train=False):
     input_path (str): 入力データファイルのパス
     train (bool): トレーニング用データかどうか。Trueの場合、データをトレーニングと検証に分割。
     """
-    # 入力ファイルを読み込み、各行をJSON形式でロードする
-    with open(input_path) as f:
-        dataset = [json.loads(line) for line in f.readlines()]
- 
-    processed = []
-    # 各データを処理
-    for data in dataset:
-        # プロンプトを作成
-        prompt = form_data(data)
-        # 正しい答えを取得
-        answer = data[f"choice{data['label']}"]
-        # 'input'と'output'として保存
-        processed.append({"input": prompt, "output": f"{answer}"})
+    # 入力ファイルを1行ずつ読み込み、プロンプトと応答に変換するジェネレーター
+    processed = iter_processed(input_path)
 
-    # トレーニングデータの場合、シャッフルしてトレーニングと検証に分割
+    # トレーニングデータの場合、全件をメモリに載せずにディスク上でシャッフルし、
+    # 末尾のNUM_VALID件を検証データ、残りをトレーニングデータとして保存
     if train:
-        random.shuffle(processed)
-        train_ds = processed[:-1000]  # トレーニングデータ
-        valid_ds = processed[-1000:]  # 検証データ
-        # トレーニングと検証データをJSONLファイルとして保存
-        write_jsonl(f"{OUTPUT_DIR}/train-v1.1.jsonl", train_ds)
-        write_jsonl(f"{OUTPUT_DIR}/valid-v1.1.jsonl", valid_ds)
+        shuffle_split_jsonl(
+            processed, OUTPUT_DIR, split_names=("train-v1.1", "valid-v1.1"),
+            seed=42, num_buckets=estimate_num_buckets(input_path),
+            size_fn=lambda total: [max(total - NUM_VALID, 0), min(total, NUM_VALID)],
+        )
     else:
-        # テストデータをJSONLファイルとして保存
+        # テストデータをメモリに保持せず、そのままJSONLファイルとして保存
         write_jsonl(f"{OUTPUT_DIR}/test-v1.1.jsonl", processed)
  
     return
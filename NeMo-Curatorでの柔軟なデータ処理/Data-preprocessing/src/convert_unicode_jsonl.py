@@ -3,7 +3,7 @@
 変換後のデータを新しいJSONLファイルとして出力するためのものです。
 """
 
-import json
+from jsonl_io import read_jsonl, write_jsonl
 
 def convert_unicode_jsonl(input_file, output_file):
     """
@@ -13,19 +13,9 @@ def convert_unicode_jsonl(input_file, output_file):
     - input_file: 入力JSONLファイルのパス
     - output_file: 出力JSONLファイルのパス
     """
-    # JSONLファイルを読み込む
-    with open(input_file, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-
-    # JSONLファイルの各行をパースし、Unicodeエスケープシーケンスを変換
-    data = [json.loads(line) for line in lines]
-
-    # 変換後のデータを新しいJSONLファイルに書き込む
-    with open(output_file, 'w', encoding='utf-8') as f:
-        for item in data:
-            # ensure_ascii=Falseにより、Unicode文字がエスケープされないようにする
-            json.dump(item, f, ensure_ascii=False)
-            f.write('\n')
+    # JSONLファイルの各行を1行ずつパースし、Unicodeエスケープシーケンスを変換しながら
+    # 新しいJSONLファイルに書き込む（write_jsonlはUnicode文字をエスケープしない）
+    write_jsonl(output_file, read_jsonl(input_file))
 
 # 使用例
 input_file = '/workspace/results/elyza_7b_ptuning_test_jcommonsenseqa-v1.1_inputs_preds_labels.jsonl'
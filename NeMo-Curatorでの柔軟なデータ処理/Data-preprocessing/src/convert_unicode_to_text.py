@@ -3,7 +3,7 @@
 指定された出力ファイルに書き込むか、コンソールに出力するためのものです。
 """
 
-import json
+from jsonl_io import read_jsonl
 
 def convert_unicode_to_text(input_file, output_file=None):
     """
@@ -13,12 +13,8 @@ def convert_unicode_to_text(input_file, output_file=None):
     - input_file: 入力JSONLファイルのパス
     - output_file: 出力ファイルのパス（Noneの場合はコンソールに出力）
     """
-    # JSONLファイルを読み込む
-    with open(input_file, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-
-    # JSONLファイルの各行をパースし、Unicodeエスケープシーケンスを変換
-    data = [json.loads(line) for line in lines]
+    # JSONLファイルの各行を1行ずつパースし、Unicodeエスケープシーケンスを変換
+    data = read_jsonl(input_file)
 
     if output_file:
         # 変換後のデータを指定された出力ファイルに書き込む
@@ -0,0 +1,184 @@
+"""
+データセット全体をメモリに載せずにシャッフルし、トレーニング、検証、テストセットに分割するモジュールです。
+
+1. 各レコードをランダムに選んだディスク上の一時バケットに振り分けます（scatter）。
+2. バケットを1つずつ読み込んでメモリ上でシャッフルし、先頭から順に出力ファイルへ書き出します。
+
+各レコードのバケットをランダムに選び、バケット内をシャッフルして連結した結果は、全体を一様にシャッフルした結果と同じ分布になります。
+必要なメモリはバケット1つ分のサイズで抑えられ、データセットのサイズには依存しません。
+振り分け時に各バケットの展開後のバイト数を数え、見積もりより大きくなったバケットは読み込む前にさらに細かいバケットへ振り分け直します。
+
+使用例:
+from external_shuffle import estimate_num_buckets, shuffle_split_jsonl
+
+shuffle_split_jsonl(records, "/workspace/data/output", num_buckets=estimate_num_buckets("input.jsonl"))
+"""
+
+import math
+import os
+import random
+import tempfile
+
+from jsonl_io import GZIP_MAGIC, ZSTD_MAGIC, JsonlWriter, iter_lines, open_output
+
+DEFAULT_RATIOS = (0.8, 0.1, 0.1)  # トレーニング：80%、検証：10%、テスト：10%
+DEFAULT_SPLIT_NAMES = ("train", "valid", "test")
+DEFAULT_BUCKET_BYTES = 256 * 1024 * 1024  # 1バケットあたりの目安サイズ（256MB）
+COMPRESSION_RATIO = 5  # gzip / zstdで圧縮されたJSONLの展開後のサイズの目安（圧縮後のサイズの倍率）
+OVERSIZE_FACTOR = 1.5  # バケットがbucket_bytesのこの倍数を超えた場合に振り分け直す
+
+# 入力ファイルのサイズからバケット数を見積もる関数
+def estimate_num_buckets(input_path, bucket_bytes=DEFAULT_BUCKET_BYTES):
+    """
+    入力ファイルの展開後のサイズを基に、1バケットがbucket_bytes程度になるバケット数を見積もる。
+    gzip / zstdで圧縮されたファイルは、ファイルサイズにCOMPRESSION_RATIOを掛けて展開後のサイズとする。
+    見積もりが外れた場合も、shuffle_split_jsonlが大きすぎるバケットを振り分け直すため、メモリ使用量は抑えられる。
+
+    パラメータ:
+    - input_path: 入力ファイルのパス
+    - bucket_bytes: 1バケットあたりの目安サイズ（バイト）
+
+    戻り値:
+    - バケット数（1以上）
+    """
+    with open(input_path, 'rb') as f:
+        magic = f.read(4)
+    ratio = COMPRESSION_RATIO if magic.startswith((GZIP_MAGIC, ZSTD_MAGIC)) else 1
+    return max(1, math.ceil(os.path.getsize(input_path) * ratio / bucket_bytes))
+
+# 各分割のサイズを計算する関数
+def compute_split_sizes(total, ratios=DEFAULT_RATIOS):
+    """
+    レコード総数と比率から各分割のサイズを計算する。最後の分割には残りのレコードをすべて割り当てる。
+
+    パラメータ:
+    - total: レコード総数
+    - ratios: 各分割の比率
+
+    戻り値:
+    - 各分割のサイズのリスト
+    """
+    sizes = [int(total * ratio) for ratio in ratios[:-1]]
+    sizes.append(total - sum(sizes))
+    return sizes
+
+# レコードをディスク上の一時バケットにランダムに振り分ける関数
+def scatter_to_buckets(records, bucket_dir, num_buckets, rng):
+    """
+    各レコードをランダムに選んだバケットファイルに書き出す。
+
+    パラメータ:
+    - records: JSONオブジェクトのイテラブル
+    - bucket_dir: バケットファイルを書き出すディレクトリ
+    - num_buckets: バケット数
+    - rng: 乱数生成器（random.Random）
+
+    戻り値:
+    - ((バケットファイルのパス, レコード数, 展開後のバイト数)のリスト, レコード総数)のタプル
+    """
+    bucket_paths = [os.path.join(bucket_dir, f"bucket-{i:05d}.jsonl") for i in range(num_buckets)]
+    writers = [JsonlWriter(path) for path in bucket_paths]
+    total = 0
+    try:
+        for record in records:
+            writers[rng.randrange(num_buckets)].write(record)
+            total += 1
+    finally:
+        for writer in writers:
+            writer.close()
+    return [(w.path, w.count, w.num_bytes) for w in writers], total
+
+# バケットを読み込み、シャッフルした行のリストを返すジェネレーター
+def iter_shuffled_buckets(buckets, bucket_bytes, rng):
+    """
+    バケットを順に読み込んでシャッフルした行のリストを返す。
+    bucket_bytesのOVERSIZE_FACTOR倍を超えるバケットは、読み込む前に行単位でさらに細かいバケットへ振り分け直す。
+
+    パラメータ:
+    - buckets: (バケットファイルのパス, レコード数, 展開後のバイト数)のリスト
+    - bucket_bytes: 1バケットあたりの目安サイズ（バイト）
+    - rng: 乱数生成器（random.Random）
+
+    戻り値:
+    - シャッフルした行（バイト列）のリストを返すジェネレーター
+    """
+    for bucket_path, count, num_bytes in buckets:
+        if count > 1 and num_bytes > bucket_bytes * OVERSIZE_FACTOR:
+            num_sub_buckets = max(2, math.ceil(num_bytes / bucket_bytes))
+            sub_paths = [f"{bucket_path}.{i:03d}" for i in range(num_sub_buckets)]
+            sub_counts = [0] * num_sub_buckets
+            sub_bytes = [0] * num_sub_buckets
+            sub_files = [open(path, 'wb') for path in sub_paths]
+            try:
+                for line in iter_lines(bucket_path):
+                    i = rng.randrange(num_sub_buckets)
+                    sub_files[i].write(line)
+                    sub_counts[i] += 1
+                    sub_bytes[i] += len(line)
+            finally:
+                for f in sub_files:
+                    f.close()
+            os.remove(bucket_path)
+            yield from iter_shuffled_buckets(list(zip(sub_paths, sub_counts, sub_bytes)), bucket_bytes, rng)
+        else:
+            lines = list(iter_lines(bucket_path))
+            os.remove(bucket_path)
+            rng.shuffle(lines)
+            yield lines
+
+# データセットをディスク上でシャッフルし、分割して書き出す関数
+def shuffle_split_jsonl(records, output_dir, ratios=DEFAULT_RATIOS, split_names=DEFAULT_SPLIT_NAMES,
+                        seed=42, num_buckets=1, tmp_dir=None, bucket_bytes=DEFAULT_BUCKET_BYTES, size_fn=None):
+    """
+    レコードをメモリに全件保持することなくシャッフルし、指定された比率で分割してJSONLファイルに保存する。
+    出力ファイルは output_dir/<split_name>.jsonl となる。
+
+    パラメータ:
+    - records: JSONオブジェクトのイテラブル（ジェネレーターでもよい）
+    - output_dir: 出力ディレクトリ
+    - ratios: 各分割の比率
+    - split_names: 各分割の名前
+    - seed: 乱数シード
+    - num_buckets: 一時バケット数。メモリ使用量はおおよそ「データサイズ / num_buckets」になる
+    - tmp_dir: 一時バケットを置くディレクトリ（Noneの場合はoutput_dir）
+    - bucket_bytes: 1バケットあたりの上限の目安（バイト）。振り分け後にこれを大きく超えたバケットは振り分け直す
+    - size_fn: レコード総数から各分割のサイズのリストを計算する関数（Noneの場合はratiosから計算する）
+
+    戻り値:
+    - 分割名をキー、レコード数を値とする辞書
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    rng = random.Random(seed)
+
+    with tempfile.TemporaryDirectory(prefix=".shuffle_", dir=tmp_dir or output_dir) as bucket_dir:
+        # 1. レコードをランダムなバケットに振り分ける
+        buckets, total = scatter_to_buckets(records, bucket_dir, num_buckets, rng)
+        split_sizes = size_fn(total) if size_fn is not None else compute_split_sizes(total, ratios)
+
+        # 2. バケットごとにシャッフルし、先頭から順に各分割のファイルへ書き出す
+        split_index = 0
+        remaining = split_sizes[0]
+        outfile = open_output(os.path.join(output_dir, f"{split_names[0]}.jsonl"))
+        try:
+            for lines in iter_shuffled_buckets(buckets, bucket_bytes, rng):
+                position = 0
+                while position < len(lines):
+                    # 現在の分割が埋まったら次の分割のファイルに切り替える
+                    while remaining == 0 and split_index < len(split_names) - 1:
+                        outfile.close()
+                        split_index += 1
+                        remaining = split_sizes[split_index]
+                        outfile = open_output(os.path.join(output_dir, f"{split_names[split_index]}.jsonl"))
+                    chunk = lines[position:position + remaining]
+                    outfile.write(b''.join(chunk))
+                    position += len(chunk)
+                    remaining -= len(chunk)
+            # レコードが0件の分割も空ファイルとして作成する
+            while split_index < len(split_names) - 1:
+                outfile.close()
+                split_index += 1
+                outfile = open_output(os.path.join(output_dir, f"{split_names[split_index]}.jsonl"))
+        finally:
+            outfile.close()
+
+    return dict(zip(split_names, split_sizes))
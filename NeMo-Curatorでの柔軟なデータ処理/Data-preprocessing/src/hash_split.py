@@ -0,0 +1,183 @@
+"""
+レコードのキー（例: URLとチャンク番号）の安定したハッシュ値に基づいて、
+トレーニング、検証、テストセットへの割り当てを決定するモジュールです。
+
+割り当てはキーだけで決まるため、データを追加して再実行しても既存レコードの割り当ては変わりません。
+incremental=Trueの場合は、出力ディレクトリのキー一覧（split_keys.tsv）に記録済みのレコードを読み飛ばし、
+新しいレコードだけを既存の分割ファイルに追記します。
+
+キー一覧と分割ファイルは一定件数ごとにまとめて書き出し、分割ファイルを書き出してからキー一覧に
+その時点の各分割ファイルのサイズ（コミット行）を記録します。処理が途中で終了した場合、
+次のincrementalの実行時に最後のコミット行より後の書き込みを取り消すため、キー一覧と分割ファイルは常に一致します。
+
+使用例:
+from hash_split import hash_split_jsonl
+
+hash_split_jsonl(((r["url"], r) for r in records), "/workspace/data/output", incremental=True)
+"""
+
+import hashlib
+import os
+from collections import Counter
+
+from jsonl_io import DEFAULT_BATCH_SIZE, JsonlWriter
+
+DEFAULT_RATIOS = (0.8, 0.1, 0.1)  # トレーニング：80%、検証：10%、テスト：10%
+DEFAULT_SPLIT_NAMES = ("train", "valid", "test")
+KEY_MANIFEST = "split_keys.tsv"  # 書き出し済みのキーのダイジェストと分割名の一覧
+COMMIT_PREFIX = "#commit"  # キー一覧のコミット行（各分割ファイルのサイズを記録する）の先頭
+
+# キーのダイジェストを計算する関数
+def key_digest(key):
+    """
+    キーを64bitのBLAKE2bでハッシュ化し、16進数の文字列として返す。
+
+    パラメータ:
+    - key: レコードのキー文字列
+
+    戻り値:
+    - 16進数のダイジェスト文字列
+    """
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=8).hexdigest()
+
+# ダイジェストから分割を決定する関数
+def assign_split(digest, ratios=DEFAULT_RATIOS, split_names=DEFAULT_SPLIT_NAMES):
+    """
+    ダイジェストを[0, 1)の値に変換し、比率の累積和に従って分割名を決定する。
+
+    パラメータ:
+    - digest: key_digestで計算したダイジェスト
+    - ratios: 各分割の比率
+    - split_names: 各分割の名前
+
+    戻り値:
+    - 分割名
+    """
+    position = int(digest, 16) / 2 ** 64
+    cumulative = 0.0
+    for name, ratio in zip(split_names, ratios):
+        cumulative += ratio
+        if position < cumulative:
+            return name
+    return split_names[-1]
+
+# 書き出し済みのキーを読み込む関数
+def load_key_manifest(output_dir):
+    """
+    出力ディレクトリのキー一覧から、書き出し済みのダイジェストの集合を読み込む。
+
+    パラメータ:
+    - output_dir: 出力ディレクトリ
+
+    戻り値:
+    - ダイジェストの集合（キー一覧が存在しない場合は空集合）
+    """
+    manifest_path = os.path.join(output_dir, KEY_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return set()
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return {line.split('\t', 1)[0] for line in f if line.strip() and not line.startswith(COMMIT_PREFIX)}
+
+# 途中で終了した実行の書き込みを取り消す関数
+def recover_uncommitted(output_dir, split_names=DEFAULT_SPLIT_NAMES):
+    """
+    キー一覧の最後のコミット行より後の行を削除し、各分割ファイルをコミット行に記録されたサイズに切り詰める。
+    コミット行のないキー一覧（以前の形式）はそのままにする。
+
+    パラメータ:
+    - output_dir: 出力ディレクトリ
+    - split_names: 各分割の名前
+
+    戻り値:
+    - 取り消しを行った場合はTrue
+    """
+    manifest_path = os.path.join(output_dir, KEY_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return False
+    committed_bytes = None
+    committed_sizes = None
+    position = 0
+    with open(manifest_path, 'rb') as f:
+        for line in f:
+            position += len(line)
+            if line.startswith(COMMIT_PREFIX.encode('utf-8')) and line.endswith(b'\n'):
+                committed_bytes = position
+                fields = line.decode('utf-8').rstrip('\n').split('\t')[1:]
+                committed_sizes = {name: int(size) for name, size in (field.split('=', 1) for field in fields)}
+    split_paths = {name: os.path.join(output_dir, f"{name}.jsonl") for name in split_names}
+    if committed_sizes is None or (position == committed_bytes and all(
+            os.path.exists(path) and os.path.getsize(path) == committed_sizes.get(name, 0)
+            for name, path in split_paths.items())):
+        return False
+    with open(manifest_path, 'r+b') as f:
+        f.truncate(committed_bytes)
+    for name, path in split_paths.items():
+        with open(path, 'ab') as f:
+            f.truncate(committed_sizes.get(name, 0))
+    return True
+
+# キーのハッシュに基づいてデータセットを分割して書き出す関数
+def hash_split_jsonl(keyed_records, output_dir, ratios=DEFAULT_RATIOS,
+                     split_names=DEFAULT_SPLIT_NAMES, incremental=False, commit_size=DEFAULT_BATCH_SIZE):
+    """
+    各レコードをキーのハッシュで決まる分割に書き出す。出力ファイルは output_dir/<split_name>.jsonl となる。
+
+    パラメータ:
+    - keyed_records: (キー文字列, JSONオブジェクト)のタプルのイテラブル
+    - output_dir: 出力ディレクトリ
+    - ratios: 各分割の比率
+    - split_names: 各分割の名前
+    - incremental: Trueの場合、書き出し済みのレコードを読み飛ばし、新しいレコードだけを追記する
+    - commit_size: 分割ファイルとキー一覧をまとめて書き出すレコード数
+
+    戻り値:
+    - 分割名ごとに新しく書き出したレコード数と、読み飛ばした件数（'skipped'）、
+      途中で終了した実行の書き込みを取り消したかどうか（'recovered'）を記録したCounter
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if incremental and not os.path.exists(os.path.join(output_dir, KEY_MANIFEST)):
+        # キー一覧のない既存の分割ファイル（シャッフルで作成したものなど）に追記すると重複が生じる
+        for name in split_names:
+            split_path = os.path.join(output_dir, f"{name}.jsonl")
+            if os.path.exists(split_path) and os.path.getsize(split_path) > 0:
+                raise ValueError(f"{KEY_MANIFEST}がないため、既存の{split_path}に追記できません")
+    stats = Counter()
+    if incremental and recover_uncommitted(output_dir, split_names):
+        stats['recovered'] = 1
+    known_digests = load_key_manifest(output_dir) if incremental else set()
+
+    writers = {
+        name: JsonlWriter(os.path.join(output_dir, f"{name}.jsonl"), append=incremental)
+        for name in split_names
+    }
+    manifest_mode = 'a' if incremental else 'w'
+    pending = []  # 分割ファイルに書き出し済みで、まだキー一覧に記録していない行
+
+    def commit(manifest):
+        # 分割ファイルを先に書き出し、そのサイズをコミット行としてキー一覧に記録する
+        for writer in writers.values():
+            writer.sync()
+        sizes = '\t'.join(f"{name}={os.path.getsize(writer.path)}" for name, writer in writers.items())
+        manifest.write(''.join(pending) + f"{COMMIT_PREFIX}\t{sizes}\n")
+        manifest.flush()
+        pending.clear()
+
+    try:
+        with open(os.path.join(output_dir, KEY_MANIFEST), manifest_mode, encoding='utf-8') as manifest:
+            for key, record in keyed_records:
+                digest = key_digest(key)
+                if digest in known_digests:
+                    stats['skipped'] += 1
+                    continue
+                known_digests.add(digest)
+                split_name = assign_split(digest, ratios, split_names)
+                writers[split_name].write(record)
+                pending.append(f"{digest}\t{split_name}\n")
+                stats[split_name] += 1
+                if len(pending) >= commit_size:
+                    commit(manifest)
+            commit(manifest)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return stats
@@ -0,0 +1,303 @@
+'''
+このスクリプトは、評価結果（*_inputs_preds_labels.jsonl）などの大きなJSONLファイルに行オフセットのインデックスを作成し、
+ファイル全体をデコードせずに任意の行を参照したり、条件に合う行を絞り込んでテキストとして出力するためのものです。
+
+インデックスは <入力ファイル>.idx に各行の先頭バイト位置（8バイト）として保存され、入力ファイルが更新されると自動的に再作成されます。
+
+使用方法:
+# インデックスの作成
+python src/jsonl_index.py build /workspace/results/elyza_7b_ptuning_test_jcommonsenseqa-v1.1_inputs_preds_labels.jsonl
+
+# 指定した行を表示（0始まり）
+python src/jsonl_index.py show <input_file> --rows 10 25 100
+
+# 100件ずつのページ単位で表示（3ページ目）
+python src/jsonl_index.py show <input_file> --page 2 --page-size 100
+
+# 予測と正解が異なる行だけを絞り込み、テキストファイルに出力
+python src/jsonl_index.py filter <input_file> --where "pred!=label" --output mismatches.txt
+'''
+
+import argparse
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+
+from jsonl_io import loads
+
+INDEX_MAGIC = b'JLIDX001'
+INDEX_HEADER = struct.Struct('<8sQQ')  # マジック、入力ファイルのサイズ、入力ファイルの更新時刻（ns）
+OFFSET = struct.Struct('<Q')
+WHERE_PATTERN = re.compile(r'^\s*(\w+)\s*(==|!=|~=)\s*(.+?)\s*$')
+
+# インデックスファイルのパスを返す関数
+def index_path_for(input_file):
+    """
+    入力ファイルに対応するインデックスファイルのパス（<入力ファイル>.idx）を返す。
+    """
+    return input_file + '.idx'
+
+# 行オフセットのインデックスを作成する関数
+def build_index(input_file, index_file=None):
+    """
+    入力ファイルを1回だけ走査し、空行以外の各行の先頭バイト位置をインデックスファイルに書き出す。
+
+    パラメータ:
+    - input_file: 入力JSONLファイルのパス（非圧縮）
+    - index_file: インデックスファイルのパス（Noneの場合は<入力ファイル>.idx）
+
+    戻り値:
+    - インデックスに登録した行数
+    """
+    index_file = index_file or index_path_for(input_file)
+    stat = os.stat(input_file)
+    num_rows = 0
+    with open(input_file, 'rb') as infile, open(index_file + '.tmp', 'wb') as outfile:
+        outfile.write(INDEX_HEADER.pack(INDEX_MAGIC, stat.st_size, stat.st_mtime_ns))
+        buffer = bytearray()
+        position = 0
+        for line in infile:
+            if line.strip():
+                buffer += OFFSET.pack(position)
+                num_rows += 1
+                if len(buffer) >= 8 * 1024 * 1024:
+                    outfile.write(buffer)
+                    buffer.clear()
+            position += len(line)
+        outfile.write(buffer)
+    os.replace(index_file + '.tmp', index_file)
+    return num_rows
+
+class JsonlIndex:
+    """
+    インデックスファイルをメモリマップし、行番号からレコードを読み込むクラス。
+
+    使用例:
+    with JsonlIndex("preds.jsonl") as index:
+        print(len(index), index[10])
+    """
+
+    def __init__(self, input_file, index_file=None):
+        """
+        パラメータ:
+        - input_file: 入力JSONLファイルのパス
+        - index_file: インデックスファイルのパス（存在しないか古い場合は作成し直す）
+        """
+        self.input_file = input_file
+        self.index_file = index_file or index_path_for(input_file)
+        if not self._is_fresh():
+            build_index(input_file, self.index_file)
+        self._index_fp = open(self.index_file, 'rb')
+        self._index = mmap.mmap(self._index_fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._data = open(input_file, 'rb')
+        self.num_rows = (len(self._index) - INDEX_HEADER.size) // OFFSET.size
+
+    def _is_fresh(self):
+        """
+        インデックスファイルが存在し、入力ファイルのサイズと更新時刻が作成時と一致するかを判定する。
+        """
+        if not os.path.exists(self.index_file):
+            return False
+        stat = os.stat(self.input_file)
+        with open(self.index_file, 'rb') as f:
+            header = f.read(INDEX_HEADER.size)
+        if len(header) < INDEX_HEADER.size:
+            return False
+        magic, size, mtime_ns = INDEX_HEADER.unpack(header)
+        return magic == INDEX_MAGIC and size == stat.st_size and mtime_ns == stat.st_mtime_ns
+
+    def __len__(self):
+        return self.num_rows
+
+    def read_line(self, row):
+        """
+        指定された行のバイト列を読み込む。
+        """
+        if not 0 <= row < self.num_rows:
+            raise IndexError(f"行番号が範囲外です: {row}（行数: {self.num_rows}）")
+        (offset,) = OFFSET.unpack_from(self._index, INDEX_HEADER.size + row * OFFSET.size)
+        self._data.seek(offset)
+        return self._data.readline()
+
+    def __getitem__(self, row):
+        """
+        指定された行をデコードしたレコードを返す。
+        """
+        return loads(self.read_line(row))
+
+    def close(self):
+        """
+        メモリマップとファイルを閉じる。
+        """
+        self._index.close()
+        self._index_fp.close()
+        self._data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# 絞り込み条件を関数に変換する関数
+def parse_where(expression):
+    """
+    "フィールド 演算子 値" 形式の条件を、レコードを受け取って真偽値を返す関数に変換する。
+
+    - 演算子: ==（等しい）、!=（異なる）、~=（値を含む）
+    - 値: 引用符で囲んだ文字列や数値などのJSONリテラルはその値、それ以外はフィールド名として扱う
+    - 文字列は前後の空白を除いて比較する
+
+    例: "pred!=label", 'label=="A"', 'input~="選択肢"'
+
+    パラメータ:
+    - expression: 条件の文字列
+
+    戻り値:
+    - レコードを受け取る判定関数
+    """
+    match = WHERE_PATTERN.match(expression)
+    if not match:
+        raise ValueError(f"条件の形式が正しくありません: {expression}")
+    field, operator, operand = match.groups()
+    try:
+        literal = json.loads(operand)
+        get_value = lambda record: literal
+    except json.JSONDecodeError:
+        get_value = lambda record: record.get(operand)
+
+    def normalize(value):
+        return value.strip() if isinstance(value, str) else value
+
+    def predicate(record):
+        left = normalize(record.get(field))
+        right = normalize(get_value(record))
+        if operator == '==':
+            return left == right
+        if operator == '!=':
+            return left != right
+        return isinstance(left, str) and str(right) in left
+
+    return predicate
+
+# 条件に合う行を先頭から順に探すジェネレーター
+def scan_filter(input_file, predicate):
+    """
+    入力ファイルを先頭から1行ずつ走査し、条件に合う行の(行番号, レコード)を返す。
+
+    パラメータ:
+    - input_file: 入力JSONLファイルのパス
+    - predicate: レコードを受け取る判定関数
+
+    戻り値:
+    - (行番号, レコード)のタプルを返すジェネレーター
+    """
+    row = 0
+    with open(input_file, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = loads(line)
+            if predicate(record):
+                yield row, record
+            row += 1
+
+# レコードをテキスト形式に整形する関数
+def format_record(row, record):
+    """
+    convert_unicode_to_text.pyと同じ形式（Input / Prediction / Label）で整形する。
+    input、pred、labelを持たないレコードはJSONとして整形する。
+    """
+    if all(key in record for key in ('input', 'pred', 'label')):
+        return (f"# row {row}\n"
+                f"Input: {record['input']}\n"
+                f"Prediction: {record['pred']}\n"
+                f"Label: {record['label']}\n\n")
+    return f"# row {row}\n{json.dumps(record, ensure_ascii=False, indent=2)}\n\n"
+
+# 整形したレコードを出力する関数
+def write_records(rows_and_records, output_file=None):
+    """
+    (行番号, レコード)のイテラブルを整形し、ファイルまたは標準出力に書き出す。
+
+    戻り値:
+    - 出力した件数
+    """
+    out = open(output_file, 'w', encoding='utf-8') if output_file else sys.stdout
+    count = 0
+    try:
+        for row, record in rows_and_records:
+            out.write(format_record(row, record))
+            count += 1
+    finally:
+        if output_file:
+            out.close()
+    return count
+
+# コマンドライン引数の設定
+def attach_args():
+    """
+    コマンドライン引数を定義する関数。
+
+    戻り値:
+    - 引数を追加したArgumentParserオブジェクト
+    """
+    parser = argparse.ArgumentParser(description="JSONLファイルの行オフセットのインデックスを作成し、任意の行を参照します。")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build", help="インデックスを作成する")
+    build.add_argument("input_file", help="入力JSONLファイルのパス")
+
+    show = subparsers.add_parser("show", help="指定した行またはページを表示する")
+    show.add_argument("input_file", help="入力JSONLファイルのパス")
+    show.add_argument("--rows", type=int, nargs="+", help="表示する行番号（0始まり）")
+    show.add_argument("--page", type=int, default=0, help="表示するページ番号（0始まり）")
+    show.add_argument("--page-size", type=int, default=20, help="1ページあたりの行数")
+    show.add_argument("--output", help="出力ファイルのパス（省略時は標準出力）")
+
+    filter_parser = subparsers.add_parser("filter", help="条件に合う行を絞り込んで表示する")
+    filter_parser.add_argument("input_file", help="入力JSONLファイルのパス")
+    filter_parser.add_argument("--where", required=True, help='絞り込み条件（例: "pred!=label"）')
+    filter_parser.add_argument("--page", type=int, default=0, help="表示するページ番号（0始まり）")
+    filter_parser.add_argument("--page-size", type=int, default=20, help="1ページあたりの件数（0の場合はすべて）")
+    filter_parser.add_argument("--output", help="出力ファイルのパス（省略時は標準出力）")
+    return parser
+
+# メイン関数
+def main(args):
+    """
+    サブコマンドに応じてインデックスの作成、行の表示、絞り込みを行う。
+
+    パラメータ:
+    - args: コマンドライン引数
+    """
+    if args.command == "build":
+        num_rows = build_index(args.input_file)
+        print(f"インデックスを作成しました: {index_path_for(args.input_file)}（{num_rows}行）")
+    elif args.command == "show":
+        with JsonlIndex(args.input_file) as index:
+            if args.rows:
+                rows = args.rows
+            else:
+                start = args.page * args.page_size
+                rows = range(start, min(start + args.page_size, len(index)))
+            write_records(((row, index[row]) for row in rows), args.output)
+    elif args.command == "filter":
+        matches = scan_filter(args.input_file, parse_where(args.where))
+        start = args.page * args.page_size
+        selected = (
+            item for i, item in enumerate(matches)
+            if i >= start
+        )
+        if args.page_size > 0:
+            # ページの件数に達した時点で走査を打ち切る
+            selected = (item for _, item in zip(range(args.page_size), selected))
+        count = write_records(selected, args.output)
+        print(f"{count}件を出力しました", file=sys.stderr)
+
+# スクリプトが直接実行された場合、メイン関数を呼び出す
+if __name__ == "__main__":
+    main(attach_args().parse_args())
@@ -0,0 +1,327 @@
+"""
+前処理スクリプトで共通して使用するJSONLファイルの読み書きモジュールです。
+
+- レコードを1行ずつ遅延読み込みするため、ファイルサイズに比例してメモリを消費しません。
+- 書き込みはエンコード済みのバイト列をバッチ単位でまとめて書き出します。
+- orjsonがインストールされていれば高速なJSONコーデックとして使用し、なければ標準のjsonを使用します。
+- gzip / zstd で圧縮されたファイルは、先頭のマジックバイトから判定して透過的に展開します。
+  書き込み時は拡張子（.gz / .zst）に応じて圧縮します。
+- 非圧縮ファイルはオプションでメモリマップして読み込めます。
+- JsonArrayWriterは、JSON配列を要素ごとに逐次書き出します（全要素をリストとして保持する必要がありません）。
+
+使用例:
+from jsonl_io import read_jsonl, write_jsonl
+
+write_jsonl("output.jsonl", ({"text": r["text"]} for r in read_jsonl("input.jsonl.gz")))
+"""
+
+import gzip
+import io
+import json
+import mmap
+import os
+
+try:
+    import orjson  # 高速なJSONコーデック（任意）
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard  # zstd圧縮の読み書き（任意）
+except ImportError:
+    zstandard = None
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+DEFAULT_BATCH_SIZE = 1000
+
+# JSON文字列（またはバイト列）をデコードする関数
+def loads(line):
+    """
+    1行分のJSONをデコードする。orjsonが利用可能な場合はorjsonを使用する。
+
+    パラメータ:
+    - line: JSON文字列またはUTF-8のバイト列
+
+    戻り値:
+    - デコードされたオブジェクト
+    """
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line)
+
+# オブジェクトをJSONのバイト列にエンコードする関数
+def dumps(obj, indent=None):
+    """
+    オブジェクトをUTF-8のJSONバイト列にエンコードする。
+    非ASCII文字はエスケープしない（json.dumpsのensure_ascii=Falseと同等）。
+
+    パラメータ:
+    - obj: エンコードするオブジェクト
+    - indent: インデント幅（Noneの場合は改行を含まない1行で出力）
+
+    戻り値:
+    - UTF-8でエンコードされたJSONのバイト列
+    """
+    if orjson is not None and indent in (None, 2):
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+        except TypeError:
+            # orjsonが扱えない値（64bitを超える整数など）は標準のjsonにフォールバックする
+            pass
+    return json.dumps(obj, ensure_ascii=False, indent=indent).encode('utf-8')
+
+# 圧縮形式を判定してバイナリモードでファイルを開く関数
+def open_binary(path):
+    """
+    ファイル先頭のマジックバイトからgzip / zstdを判定し、展開済みのバイトストリームとして開く。
+
+    パラメータ:
+    - path: 入力ファイルのパス
+
+    戻り値:
+    - バイナリモードのファイルオブジェクト
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.open(path, 'rb')
+    if magic.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ImportError(f"zstd圧縮ファイルの読み込みにはzstandardが必要です: {path}")
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+        return io.BufferedReader(reader)
+    return open(path, 'rb')
+
+# ファイルの各行をバイト列として遅延読み込みするジェネレーター
+def iter_lines(path, use_mmap=False):
+    """
+    ファイルを1行ずつバイト列として返す。空行は読み飛ばす。
+
+    パラメータ:
+    - path: 入力ファイルのパス
+    - use_mmap: Trueの場合、非圧縮ファイルをメモリマップして読み込む
+
+    戻り値:
+    - 各行のバイト列を返すジェネレーター
+    """
+    with open_binary(path) as f:
+        # メモリマップは非圧縮の通常ファイルの場合のみ使用する
+        if use_mmap and isinstance(getattr(f, 'raw', None), io.FileIO) \
+                and os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for line in iter(mm.readline, b''):
+                    if line.strip():
+                        yield line
+        else:
+            for line in f:
+                if line.strip():
+                    yield line
+
+# JSONLファイルのレコードを遅延読み込みするジェネレーター
+def read_jsonl(path, use_mmap=False):
+    """
+    JSONLファイルを1レコードずつデコードして返す。
+
+    パラメータ:
+    - path: 入力JSONLファイルのパス（gzip / zstd圧縮も可）
+    - use_mmap: Trueの場合、非圧縮ファイルをメモリマップして読み込む
+
+    戻り値:
+    - 各レコードを返すジェネレーター
+    """
+    for line in iter_lines(path, use_mmap=use_mmap):
+        yield loads(line)
+
+# 拡張子に応じて書き込み用のファイルを開く関数
+def open_output(path, mode='wb'):
+    """
+    拡張子（.gz / .zst / .zstd）に応じて圧縮しながら書き込むファイルを開く。
+
+    パラメータ:
+    - path: 出力ファイルのパス
+    - mode: 'wb'（上書き）または'ab'（追記）
+
+    戻り値:
+    - バイナリモードのファイルオブジェクト
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    if path.endswith(('.zst', '.zstd')):
+        if zstandard is None:
+            raise ImportError(f"zstd圧縮ファイルの書き込みにはzstandardが必要です: {path}")
+        return zstandard.ZstdCompressor().stream_writer(open(path, mode), closefd=True)
+    return open(path, mode)
+
+class JsonlWriter:
+    """
+    レコードをバッチ単位でまとめてJSONLファイルに書き込むライター。
+
+    使用例:
+    with JsonlWriter("output.jsonl") as writer:
+        for record in records:
+            writer.write(record)
+    """
+
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE, append=False):
+        """
+        パラメータ:
+        - path: 出力ファイルのパス
+        - batch_size: まとめて書き出すレコード数
+        - append: Trueの場合、既存のファイルに追記する
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.count = 0
+        self.num_bytes = 0  # 書き込んだバイト数（圧縮前、改行を含む）
+        self._buffer = []
+        self._file = open_output(path, 'ab' if append else 'wb')
+
+    def write(self, obj):
+        """
+        1レコードをバッファに追加し、バッチサイズに達したら書き出す。
+        """
+        encoded = dumps(obj)
+        self._buffer.append(encoded)
+        self.count += 1
+        self.num_bytes += len(encoded) + 1
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def write_many(self, objs):
+        """
+        複数のレコードを順に書き込む。
+        """
+        for obj in objs:
+            self.write(obj)
+
+    def flush(self):
+        """
+        バッファ内のレコードをファイルに書き出す。
+        """
+        if self._buffer:
+            self._buffer.append(b'')
+            self._file.write(b'\n'.join(self._buffer))
+            self._buffer = []
+
+    def sync(self):
+        """
+        バッファ内のレコードを書き出し、ファイルオブジェクトのバッファもOSに渡す。
+        プロセスが終了しても、それまでに書き込んだレコードはファイルに残る。
+        """
+        self.flush()
+        self._file.flush()
+
+    def close(self):
+        """
+        バッファを書き出してファイルを閉じる。
+        """
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# JSON Lines形式でファイルに書き出す関数
+def write_jsonl(fname, json_objs, batch_size=DEFAULT_BATCH_SIZE, append=False):
+    """
+    json_objsに含まれるオブジェクトをJSONL形式でファイルに書き出す。
+    json_objsはリストだけでなくジェネレーターでもよく、その場合はメモリに全件を保持しない。
+
+    パラメータ:
+    - fname: 出力ファイルのパス
+    - json_objs: JSONオブジェクトのイテラブル
+    - batch_size: まとめて書き出すレコード数
+    - append: Trueの場合、既存のファイルに追記する
+
+    戻り値:
+    - 書き込んだレコード数
+    """
+    with JsonlWriter(fname, batch_size=batch_size, append=append) as writer:
+        writer.write_many(json_objs)
+    return writer.count
+
+class JsonArrayWriter:
+    """
+    JSON配列を要素ごとに逐次書き出すライター。メモリ使用量は要素数に依存しない。
+    indent=2の場合の出力は json.dump(list, f, ensure_ascii=False, indent=2) と同じ形式になり、
+    indent=Noneの場合は空白を含まないコンパクトな形式になる。
+
+    使用例:
+    with JsonArrayWriter("output.json") as writer:
+        for record in records:
+            writer.write(record)
+    """
+
+    def __init__(self, path, indent=2, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        パラメータ:
+        - path: 出力ファイルのパス
+        - indent: インデント幅（Noneの場合はコンパクトな形式）
+        - batch_size: まとめて書き出す要素数
+        """
+        self.path = path
+        self.indent = indent
+        self.batch_size = batch_size
+        self.count = 0
+        self._buffer = []
+        if indent:
+            self._separator = b',\n'
+            self._prefix = b'\n' + b' ' * indent
+        else:
+            self._separator = b','
+            self._prefix = b''
+        self._file = open_output(path, 'wb')
+        self._file.write(b'[')
+
+    def write(self, obj):
+        """
+        1要素をバッファに追加し、バッチサイズに達したら書き出す。
+        """
+        encoded = dumps(obj, indent=self.indent)
+        if self.indent:
+            # 要素の各行を配列の1段分だけ字下げする
+            encoded = b' ' * self.indent + encoded.replace(b'\n', self._prefix)
+        self._buffer.append(encoded)
+        self.count += 1
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def write_many(self, objs):
+        """
+        複数の要素を順に書き込む。
+        """
+        for obj in objs:
+            self.write(obj)
+
+    def flush(self):
+        """
+        バッファ内の要素をファイルに書き出す。
+        """
+        if self._buffer:
+            # 2回目以降の書き出しでは、直前の要素との区切りを先頭に付ける
+            leading = self._separator if self.count > len(self._buffer) else (b'\n' if self.indent else b'')
+            self._file.write(leading + self._separator.join(self._buffer))
+            self._buffer = []
+
+    def close(self):
+        """
+        バッファを書き出し、配列を閉じてファイルを閉じる。
+        """
+        if self._file is not None:
+            self.flush()
+            self._file.write(b'\n]' if self.indent and self.count else b']')
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
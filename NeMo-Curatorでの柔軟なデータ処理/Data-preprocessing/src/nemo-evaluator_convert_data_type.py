@@ -17,10 +17,15 @@ python src/nemo-evaluator_convert_data_type.py \
     /workspace/JGLUE/datasets/jcommonsenseqa-v1.1/train-v1.1.json \
     /workspace/data/nemo-evaluator/converted_preprocessed_file.json \
     /workspace/data/nemo-evaluator/converted_raw_file.json
+
+2つの入力ファイルは別々のプロセスで同時に変換され、変換された要素は逐次ファイルに書き出されます。
+--compactを指定すると、インデントなしのコンパクトなJSONとして出力します。
 '''
 
-import json
-import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from jsonl_io import JsonArrayWriter, read_jsonl
 
 # 前処理済みデータを変換する関数
 def convert_preprocessed_data(data):
@@ -63,50 +68,68 @@ def convert_raw_data(data):
         "q_id": data["q_id"]  # 質問IDを格納
     }
 
+# 1つのファイルを変換してJSON配列として逐次書き出す関数
+def convert_file(input_file, output_file, convert, indent=2):
+    """
+    JSONLファイルを1行ずつ読み込んで変換し、変換された要素をJSON配列として逐次書き出す。
+
+    パラメータ:
+    - input_file: 入力JSONLファイルのパス
+    - output_file: 出力JSONファイルのパス
+    - convert: 1件のデータを変換する関数
+    - indent: インデント幅（Noneの場合はコンパクトな形式）
+
+    戻り値:
+    - 変換した件数
+    """
+    with JsonArrayWriter(output_file, indent=indent) as writer:
+        for data in read_jsonl(input_file):
+            writer.write(convert(data))
+    return writer.count
+
 # メイン関数
-def main(preprocessed_file, raw_file, converted_preprocessed_file, converted_raw_file):
+def main(preprocessed_file, raw_file, converted_preprocessed_file, converted_raw_file, compact=False):
     """
     前処理済みデータと生データを読み込み、それぞれを変換してJSONファイルに保存する。
+    2つのファイルは別々のプロセスで同時に変換する。
 
     パラメータ:
     - preprocessed_file: 前処理済みデータのファイルパス
     - raw_file: 生データのファイルパス
     - converted_preprocessed_file: 変換された前処理済みデータの保存先ファイルパス
     - converted_raw_file: 変換された生データの保存先ファイルパス
+    - compact: Trueの場合、インデントなしのコンパクトなJSONとして出力する
     """
-    # 前処理済みデータの読み込みと変換
-    converted_preprocessed = []
-    with open(preprocessed_file, 'r', encoding='utf-8') as f:
-        for line in f:
-            data = json.loads(line.strip())
-            converted_preprocessed.append(convert_preprocessed_data(data))
-
-    # 生データの読み込みと変換
-    converted_raw = []
-    with open(raw_file, 'r', encoding='utf-8') as f:
-        for line in f:
-            data = json.loads(line.strip())
-            converted_raw.append(convert_raw_data(data))
-
-    # 変換された前処理済みデータの保存
-    with open(converted_preprocessed_file, 'w', encoding='utf-8') as f:
-        json.dump(converted_preprocessed, f, ensure_ascii=False, indent=2)
-
-    # 変換された生データの保存
-    with open(converted_raw_file, 'w', encoding='utf-8') as f:
-        json.dump(converted_raw, f, ensure_ascii=False, indent=2)
-
-# コマンドラインからの引数が正しいか確認し、メイン関数を実行
+    indent = None if compact else 2
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        # 前処理済みデータと生データの読み込み、変換、保存を同時に実行
+        preprocessed_future = executor.submit(
+            convert_file, preprocessed_file, converted_preprocessed_file, convert_preprocessed_data, indent
+        )
+        raw_future = executor.submit(
+            convert_file, raw_file, converted_raw_file, convert_raw_data, indent
+        )
+        print(f"Converted {preprocessed_future.result()} records -> {converted_preprocessed_file}")
+        print(f"Converted {raw_future.result()} records -> {converted_raw_file}")
+
+# コマンドライン引数の設定
+def attach_args():
+    """
+    コマンドライン引数を定義する関数。
+
+    戻り値:
+    - 引数を追加したArgumentParserオブジェクト
+    """
+    parser = argparse.ArgumentParser(description="前処理済みデータと生データをNeMo評価ツールの形式に変換します。")
+    parser.add_argument("preprocessed_file", help="前処理済みデータのファイルパス")
+    parser.add_argument("raw_file", help="生データのファイルパス")
+    parser.add_argument("converted_preprocessed_file", help="変換された前処理済みデータの保存先ファイルパス")
+    parser.add_argument("converted_raw_file", help="変換された生データの保存先ファイルパス")
+    parser.add_argument("--compact", action="store_true", help="インデントなしのコンパクトなJSONとして出力する")
+    return parser
+
+# コマンドライン引数を取得し、メイン関数を実行
 if __name__ == '__main__':
-    if len(sys.argv) != 5:
-        print("Usage: python script.py <preprocessed_file> <raw_file> <converted_preprocessed_file> <converted_raw_file>")
-        sys.exit(1)
-
-    # コマンドライン引数を取得
-    preprocessed_file = sys.argv[1]
-    raw_file = sys.argv[2]
-    converted_preprocessed_file = sys.argv[3]
-    converted_raw_file = sys.argv[4]
-    
-    # メイン関数を実行
-    main(preprocessed_file, raw_file, converted_preprocessed_file, converted_raw_file)
+    args = attach_args().parse_args()
+    main(args.preprocessed_file, args.raw_file, args.converted_preprocessed_file, args.converted_raw_file,
+         compact=args.compact)
@@ -1,29 +1,32 @@
 """
 このスクリプトは、入力されたJSONL形式のデータを読み込み、タイトルや本文に基づいてプロンプトを生成し、
 それをトレーニング、検証、およびテストデータセットに分割してJSONL形式で保存します。
+
+分割方法:
+- shuffle（デフォルト）: データ全体をシャッフルして80/10/10に分割します。
+- hash: URLとチャンク番号の安定したハッシュで分割を決定します。既存レコードの割り当ては再実行しても変わらず、
+  --incrementalを指定すると新しいレコードだけを既存の分割ファイルに追記します。
+
+使用例:
+python src/nemo_peft_pro_processed_data_json.py --split-mode hash --incremental
+
+入力ファイルと出力ディレクトリは--input-file、--output-dirで変更できます。
 """
 
-import json
+import argparse
 import os
 import random
 import re
+from collections import defaultdict
+
+from external_shuffle import estimate_num_buckets, shuffle_split_jsonl
+from hash_split import hash_split_jsonl
+from jsonl_io import read_jsonl
 
 # 入力ファイルと出力ディレクトリのパスを指定
 INPUT_FILE = "/workspace/data/mydata/split_curator/3_decontamination_pro/processed_pro.jsonl"
 OUTPUT_DIR = "/workspace/data/nemo_peft_pro_processed_data_split_curator"
-
-# JSONLファイルに書き出す関数
-def write_jsonl(fname, json_objs):
-    """
-    JSONL形式でデータをファイルに書き出す関数。
-
-    パラメータ:
-    - fname: 出力ファイルのパス
-    - json_objs: JSONオブジェクトのリスト
-    """
-    with open(fname, 'wt', encoding='utf-8') as f:
-        for o in json_objs:
-            f.write(json.dumps(o, ensure_ascii=False) + "\n")
+SEED = 42  # シャッフルの乱数シード（結果の再現性を確保）
 
 # タイトルが意味のあるものであるかを判定する関数
 def is_meaningful_title(title):
@@ -61,13 +64,14 @@ def extract_question_from_text(text, max_length=50):
     return question.strip()
 
 # プロンプトを生成する関数
-def form_prompt(title, text):
+def form_prompt(title, text, rng=random):
     """
     タイトルとテキストに基づいてプロンプトを生成する。
 
     パラメータ:
     - title: タイトル文字列
     - text: テキスト文字列
+    - rng: プロンプト候補の選択に使用する乱数生成器（デフォルトはrandomモジュール）
 
     戻り値:
     - 生成されたプロンプト
@@ -81,7 +85,7 @@ def form_prompt(title, text):
             f"{title}に関連する大学生活のアドバイスを提供してください。",
             f"{title}の情報を基に、大学のPRポイントを挙げてください。"
         ]
-        return random.choice(prompts)
+        return rng.choice(prompts)
     else:
         # タイトルが意味のない場合、テキストから質問を生成
         question = extract_question_from_text(text)
@@ -90,47 +94,100 @@ def form_prompt(title, text):
         else:
             return "この文書の内容を要約してください。"
 
-# データを処理してトレーニング、検証、テストセットに分割する関数
-def process(input_path):
+# レコードごとに安定したキーを付与するジェネレーター
+def iter_keyed_records(input_path):
     """
-    JSONLファイルを読み込み、プロンプトを生成し、データをトレーニング、検証、テストセットに分割して保存する。
+    JSONLファイルを1行ずつ読み込み、URLとチャンク番号からなるキーとプロンプトを生成する。
+    チャンク番号はレコードに'chunk_index'があればそれを使い、なければ同じURLの出現順から求める。
+    プロンプトの選択もキーから決まる乱数で行うため、同じレコードからは常に同じ出力が得られる。
 
     パラメータ:
     - input_path: 入力JSONLファイルのパス
-    """
-    # JSONLファイルを読み込む
-    with open(input_path, encoding='utf-8') as f:
-        dataset = [json.loads(line) for line in f]
 
-    processed = []
-    # 各データについてプロンプトを生成
-    for data in dataset:
-        prompt = form_prompt(data['title'], data['text'])
-        processed.append({"input": prompt, "output": data['text']})
+    戻り値:
+    - (キー文字列, {"input": プロンプト, "output": テキスト})のタプルを返すジェネレーター
+    """
+    chunk_counts = defaultdict(int)
+    for data in read_jsonl(input_path):
+        url = data['url']
+        chunk_index = data.get('chunk_index', chunk_counts[url])
+        chunk_counts[url] += 1
+        key = f"{url}#{chunk_index}"
+        prompt = form_prompt(data['title'], data['text'], rng=random.Random(key))
+        yield key, {"input": prompt, "output": data['text']}
+
+# キーのハッシュに基づいてトレーニング、検証、テストセットに分割する関数
+def process_hash_split(input_path, output_dir=OUTPUT_DIR, incremental=False):
+    """
+    JSONLファイルを読み込み、各レコードをキーのハッシュで決まる分割に書き出す。
 
-    # データセットをシャッフルして、トレーニング、検証、テストセットに分割
-    random.shuffle(processed)
-    train_size = int(len(processed) * 0.8)  # トレーニングセット：80%
-    valid_size = int(len(processed) * 0.1)  # 検証セット：10%
+    パラメータ:
+    - input_path: 入力JSONLファイルのパス
+    - output_dir: 出力ディレクトリ
+    - incremental: Trueの場合、書き出し済みのレコードを読み飛ばし、新しいレコードだけを追記する
+    """
+    stats = hash_split_jsonl(iter_keyed_records(input_path), output_dir, incremental=incremental)
+    if stats['recovered']:
+        print(f"Recovered {output_dir}: discarded writes of an interrupted previous run")
+    print(f"Written: train={stats['train']}, valid={stats['valid']}, test={stats['test']}, "
+          f"skipped (already assigned)={stats['skipped']}")
 
-    train_ds = processed[:train_size]
-    valid_ds = processed[train_size:train_size + valid_size]
-    test_ds = processed[train_size + valid_size:]
+# データを処理してトレーニング、検証、テストセットに分割する関数
+def process(input_path, output_dir=OUTPUT_DIR):
+    """
+    JSONLファイルを読み込み、プロンプトを生成し、データをトレーニング、検証、テストセットに分割して保存する。
 
-    # 各データセットをJSONLファイルに書き出す
-    write_jsonl(f"{OUTPUT_DIR}/train.jsonl", train_ds)
-    write_jsonl(f"{OUTPUT_DIR}/valid.jsonl", valid_ds)
-    write_jsonl(f"{OUTPUT_DIR}/test.jsonl", test_ds)
+    パラメータ:
+    - input_path: 入力JSONLファイルのパス
+    - output_dir: 出力ディレクトリ
+    """
+    # JSONLファイルを1行ずつ読み込み、各データについてプロンプトを生成
+    processed = (
+        {"input": form_prompt(data['title'], data['text']), "output": data['text']}
+        for data in read_jsonl(input_path)
+    )
+
+    # データをディスク上の一時バケットでシャッフルし、トレーニング（80%）、検証（10%）、テスト（10%）セットに分割して
+    # train.jsonl、valid.jsonl、test.jsonlに書き出す。メモリ使用量はバケット1つ分に抑えられる
+    split_sizes = shuffle_split_jsonl(
+        processed, output_dir, seed=SEED, num_buckets=estimate_num_buckets(input_path)
+    )
+    print(f"Split sizes: {split_sizes}")
 
 # メイン関数
-def main():
+def main(args):
     """
     メイン処理。出力ディレクトリを作成し、データを処理。
+
+    パラメータ:
+    - args: コマンドライン引数
+    """
+    os.makedirs(args.output_dir, exist_ok=True)
+    if args.split_mode == "hash":
+        process_hash_split(args.input_file, args.output_dir, incremental=args.incremental)
+    else:
+        # プロンプトの選択を再現可能にするため乱数シードを固定
+        random.seed(SEED)
+        process(args.input_file, args.output_dir)
+    print(f"Processing complete. Output saved to {args.output_dir}")
+
+# コマンドライン引数の設定
+def attach_args():
+    """
+    コマンドライン引数を定義する関数。
+
+    戻り値:
+    - 引数を追加したArgumentParserオブジェクト
     """
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-    process(INPUT_FILE)
-    print(f"Processing complete. Output saved to {OUTPUT_DIR}")
+    parser = argparse.ArgumentParser(description="PEFT用のトレーニング、検証、テストデータセットを作成します。")
+    parser.add_argument("--input-file", default=INPUT_FILE, help="入力JSONLファイルのパス")
+    parser.add_argument("--output-dir", default=OUTPUT_DIR, help="出力ディレクトリ")
+    parser.add_argument("--split-mode", choices=["shuffle", "hash"], default="shuffle",
+                        help="shuffle: 全体をシャッフルして分割 / hash: URLとチャンク番号のハッシュで分割")
+    parser.add_argument("--incremental", action="store_true",
+                        help="hashモードで、割り当て済みのレコードを読み飛ばし新しいレコードだけを追記する")
+    return parser
 
 # スクリプトが直接実行された場合、メイン関数を呼び出す
 if __name__ == "__main__":
-    main()
+    main(attach_args().parse_args())
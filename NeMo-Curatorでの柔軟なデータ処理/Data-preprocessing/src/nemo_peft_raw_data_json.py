@@ -3,13 +3,13 @@
 トレーニング、検証、およびテストデータセットに分割してJSONL形式で保存します。
 """
 
-import json
-import os
-import random
+from external_shuffle import estimate_num_buckets, shuffle_split_jsonl
+from jsonl_io import read_jsonl
 
 # 原データのパス（デフォルト）
 INPUT_FILE = "/workspace/data/raw_data/data.jsonl"
 OUTPUT_DIR = "/workspace/data/nemo_peft_raw_data_default"
+SEED = 42  # シャッフルの乱数シード（結果の再現性を確保）
 
 # rawデータを分割する場合
 # INPUT_FILE = "/workspace/data/raw_data/split_raw_data.jsonl"
@@ -23,19 +23,6 @@ OUTPUT_DIR = "/workspace/data/nemo_peft_raw_data_default"
 # INPUT_FILE = "/workspace/data/mydata/curator_split"
 # OUTPUT_DIR = "/workspace/data/nemo_peft_processed_data_curator_split"
 
-# JSONLファイルにデータを書き出す関数
-def write_jsonl(fname, json_objs):
-    """
-    JSONL形式でデータをファイルに書き出す関数。
-
-    パラメータ:
-    - fname: 出力ファイルのパス
-    - json_objs: JSONオブジェクトのリスト
-    """
-    with open(fname, 'wt') as f:
-        for o in json_objs:
-            f.write(json.dumps(o, ensure_ascii=False) + "\n")
-
 # タイトルに基づいてプロンプトを生成する関数
 def form_prompt(title):
     """
@@ -62,29 +49,18 @@ def process(input_path):
     パラメータ:
     - input_path: 入力JSONLファイルのパス
     """
-    # JSONLファイルを読み込む
-    with open(input_path) as f:
-        dataset = [json.loads(line) for line in f]
-
-    processed = []
-    # 各データに対してプロンプトを生成し、処理済みリストに追加
-    for data in dataset:
-        prompt = form_prompt(data['title'])
-        processed.append({"input": prompt, "output": data['text']})
-
-    # データをシャッフルし、トレーニング、検証、テストセットに分割
-    random.shuffle(processed)
-    train_size = int(len(processed) * 0.8)  # トレーニングセットのサイズ（80%）
-    valid_size = int(len(processed) * 0.1)  # 検証セットのサイズ（10%）
-
-    train_ds = processed[:train_size]
-    valid_ds = processed[train_size:train_size + valid_size]
-    test_ds = processed[train_size + valid_size:]
-
-    # 各データセットをJSONLファイルに書き出し
-    write_jsonl(f"{OUTPUT_DIR}/train.jsonl", train_ds)
-    write_jsonl(f"{OUTPUT_DIR}/valid.jsonl", valid_ds)
-    write_jsonl(f"{OUTPUT_DIR}/test.jsonl", test_ds)
+    # JSONLファイルを1行ずつ読み込み、各データについてプロンプトを生成
+    processed = (
+        {"input": form_prompt(data['title']), "output": data['text']}
+        for data in read_jsonl(input_path)
+    )
+
+    # データをディスク上の一時バケットでシャッフルし、トレーニング（80%）、検証（10%）、テスト（10%）セットに分割して
+    # train.jsonl、valid.jsonl、test.jsonlに書き出す。メモリ使用量はバケット1つ分に抑えられる
+    split_sizes = shuffle_split_jsonl(
+        processed, OUTPUT_DIR, seed=SEED, num_buckets=estimate_num_buckets(input_path)
+    )
+    print(f"Split sizes: {split_sizes}")
 
 # メイン関数
 def main():
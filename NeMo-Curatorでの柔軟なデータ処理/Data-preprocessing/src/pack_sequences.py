@@ -0,0 +1,282 @@
+'''
+このスクリプトは、nemo_peft_*スクリプトで作成したtrain.jsonl / valid.jsonlの{"input", "output"}の組をトークナイズし、
+複数の事例を固定長（pack_size）のシーケンスに詰め込む（シーケンスパッキング）ためのものです。
+短い事例を1つずつmax_seq_lengthまでパディングする代わりに詰め込むことで、1ステップあたりの有効なトークン数が増えます。
+
+詰め込みにはBest-Fit Decreasing（長い事例から順に、収まる中で残り容量が最も小さいシーケンスに入れる）を使用します。
+シーケンスは残り容量ごとのバケットで管理するため、事例数が多くても高速に動作します。
+
+出力形式は出力ファイルの拡張子で決まります。
+- .npy: NeMoのパッキング済みSFTデータセット（packed_sequence）と同じ形式。
+        各シーケンスは{'input_ids', 'loss_mask', 'seq_start_id'}の辞書で、numpyが必要です。
+- .jsonl: 同じ内容を1行1シーケンスのJSONLとして書き出します。
+
+loss_maskは'output'側のトークンが1、'input'側のトークンが0です。seq_start_idは各事例の先頭位置（境界）です。
+--index-outputを指定すると、各シーケンスに含まれる事例の元の行番号を記録したJSONLも書き出します。
+
+使用例:
+python src/pack_sequences.py \
+    /workspace/data/nemo_peft_pro_processed_data_split_curator/train.jsonl \
+    /workspace/data/nemo_peft_pro_processed_data_split_curator/packed_2048_train.npy \
+    --tokenizer /workspace/models/ELYZA-japanese-Llama-2-7b \
+    --pack-size 2048 --add-bos --add-eos --num-workers 16
+'''
+
+import argparse
+import bisect
+import json
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from jsonl_io import JsonlWriter, loads
+from profile_token_lengths import iter_chunks, load_tokenizer
+
+DEFAULT_PACK_SIZE = 2048
+
+_encode = None
+
+# トークナイザーの特殊トークンのIDを取得する関数
+def load_special_ids(tokenizer_path):
+    """
+    トークナイザーのBOSとEOSのトークンIDを返す。
+
+    パラメータ:
+    - tokenizer_path: SentencePieceのモデルファイル（.model）、またはHugging Faceトークナイザーのディレクトリ
+
+    戻り値:
+    - (BOSのID, EOSのID)のタプル（存在しない場合はNone）
+    """
+    if tokenizer_path.endswith('.model'):
+        import sentencepiece as spm
+        processor = spm.SentencePieceProcessor(model_file=tokenizer_path)
+        return processor.bos_id(), processor.eos_id()
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, local_files_only=True)
+    return tokenizer.bos_token_id, tokenizer.eos_token_id
+
+# ワーカープロセスの初期化関数
+def init_worker(tokenizer_path):
+    """
+    ワーカープロセスごとにトークナイザーを1回だけ読み込む。
+    """
+    global _encode
+    _encode = load_tokenizer(tokenizer_path)
+
+# 複数行をまとめてトークナイズする関数（ワーカープロセスで実行される）
+def tokenize_chunk(lines):
+    """
+    JSONLの複数行をデコードし、'input'と'output'をトークンIDに変換する。
+
+    パラメータ:
+    - lines: JSONLの行（バイト列）のリスト
+
+    戻り値:
+    - ('input'のトークンIDの配列, 'output'のトークンIDの配列)のタプルのリスト
+    """
+    return [
+        (array('I', _encode(record['input'])), array('I', _encode(record['output'])))
+        for record in map(loads, lines)
+    ]
+
+# 事例を1つのトークン列にまとめる関数
+def build_example(input_ids, output_ids, bos_id, eos_id, pack_size):
+    """
+    BOS + input + output + EOS を連結し、loss_maskの開始位置とともに返す。
+    pack_sizeを超える事例は末尾を切り詰める。
+
+    戻り値:
+    - (トークンIDの配列, 'output'の開始位置, 切り詰めたかどうか)のタプル
+    """
+    tokens = array('I')
+    if bos_id is not None:
+        tokens.append(bos_id)
+    tokens.extend(input_ids)
+    answer_start = len(tokens)
+    tokens.extend(output_ids)
+    if eos_id is not None:
+        tokens.append(eos_id)
+    truncated = len(tokens) > pack_size
+    return tokens[:pack_size], min(answer_start, pack_size), truncated
+
+# Best-Fit Decreasingで事例をシーケンスに詰め込む関数
+def pack_lengths(lengths, pack_size):
+    """
+    各事例の長さを基に、事例をpack_size以下のシーケンスに割り当てる。
+
+    長い事例から順に、収まるシーケンスのうち残り容量が最も小さいものに入れる（Best-Fit Decreasing）。
+    シーケンスを残り容量ごとのバケットに分けて保持し、残り容量の一覧を二分探索することで、
+    事例ごとにすべてのシーケンスを調べずに割り当て先を決める。
+
+    パラメータ:
+    - lengths: 各事例の長さ（pack_size以下）のシーケンス
+    - pack_size: 1シーケンスの長さ
+
+    戻り値:
+    - 各シーケンスに含まれる事例の番号のリストのリスト
+    """
+    packs = []
+    buckets = {}  # 残り容量 -> その残り容量を持つシーケンスの番号のリスト
+    free_spaces = []  # バケットが空でない残り容量の昇順リスト
+
+    for example_id in sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True):
+        length = lengths[example_id]
+        position = bisect.bisect_left(free_spaces, length)
+        if position < len(free_spaces):
+            space = free_spaces[position]
+            pack_id = buckets[space].pop()
+            if not buckets[space]:
+                del buckets[space]
+                del free_spaces[position]
+        else:
+            space = pack_size
+            pack_id = len(packs)
+            packs.append([])
+        packs[pack_id].append(example_id)
+
+        remaining = space - length
+        if remaining > 0:
+            if remaining not in buckets:
+                buckets[remaining] = []
+                bisect.insort(free_spaces, remaining)
+            buckets[remaining].append(pack_id)
+    return packs
+
+# パッキングしたシーケンスを組み立てるジェネレーター
+def iter_packed_sequences(examples, packs):
+    """
+    事例の番号のリストから、{'input_ids', 'loss_mask', 'seq_start_id'}の辞書を作成する。
+
+    パラメータ:
+    - examples: (トークンIDの配列, 'output'の開始位置)のタプルのリスト
+    - packs: pack_lengthsの戻り値
+
+    戻り値:
+    - シーケンスの辞書を返すジェネレーター
+    """
+    for pack in packs:
+        input_ids = []
+        loss_mask = []
+        seq_start_id = []
+        for example_id in pack:
+            tokens, answer_start = examples[example_id]
+            seq_start_id.append(len(input_ids))
+            input_ids.extend(tokens)
+            loss_mask.extend([0] * answer_start + [1] * (len(tokens) - answer_start))
+        yield {'input_ids': input_ids, 'loss_mask': loss_mask, 'seq_start_id': seq_start_id}
+
+# パッキングしたシーケンスを書き出す関数
+def write_packed(sequences, output_file):
+    """
+    拡張子が.npyの場合はNeMoのパッキング済みデータセットの形式、それ以外はJSONLで書き出す。
+
+    戻り値:
+    - 書き出したシーケンス数
+    """
+    if output_file.endswith('.npy'):
+        import numpy as np
+        sequences = list(sequences)
+        np.save(output_file, np.array(sequences, dtype=object), allow_pickle=True)
+        return len(sequences)
+    with JsonlWriter(output_file) as writer:
+        writer.write_many(sequences)
+        return writer.count
+
+# 入力ファイルを読み込んでパッキングする関数
+def pack_files(input_files, output_file, tokenizer_path, pack_size=DEFAULT_PACK_SIZE,
+               add_bos=False, add_eos=False, num_workers=None, index_output=None):
+    """
+    入力ファイルの事例をトークナイズしてパッキングし、出力ファイルに書き出す。
+
+    パラメータ:
+    - input_files: 入力JSONLファイルのパスのリスト
+    - output_file: 出力ファイルのパス（.npyまたは.jsonl）
+    - tokenizer_path: トークナイザーのパス
+    - pack_size: 1シーケンスの長さ
+    - add_bos / add_eos: 各事例の前後にBOS / EOSを付けるかどうか
+    - num_workers: トークナイズのワーカープロセス数
+    - index_output: 各シーケンスに含まれる事例の行番号を書き出すJSONLファイルのパス
+
+    戻り値:
+    - パッキング効率などの統計量の辞書
+    """
+    bos_id, eos_id = None, None
+    if add_bos or add_eos:
+        bos_id, eos_id = load_special_ids(tokenizer_path)
+        bos_id = bos_id if add_bos else None
+        eos_id = eos_id if add_eos else None
+
+    examples = []
+    num_truncated = 0
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker,
+                             initargs=(tokenizer_path,)) as executor:
+        for chunk in executor.map(tokenize_chunk, iter_chunks(input_files)):
+            for input_ids, output_ids in chunk:
+                tokens, answer_start, truncated = build_example(input_ids, output_ids, bos_id, eos_id, pack_size)
+                examples.append((tokens, answer_start))
+                num_truncated += truncated
+
+    lengths = [len(tokens) for tokens, _ in examples]
+    packs = pack_lengths(lengths, pack_size)
+    write_packed(iter_packed_sequences(examples, packs), output_file)
+
+    if index_output:
+        with JsonlWriter(index_output) as writer:
+            for pack in packs:
+                writer.write({'rows': pack, 'lengths': [lengths[i] for i in pack]})
+
+    total_tokens = sum(lengths)
+    num_examples = len(examples)
+    num_packs = len(packs)
+    return {
+        'examples': num_examples,
+        'truncated_examples': num_truncated,
+        'sequences': num_packs,
+        'tokens': total_tokens,
+        'pack_size': pack_size,
+        # 事例ごとにpack_sizeまでパディングした場合の、パディング以外のトークンの割合
+        'unpacked_efficiency': total_tokens / (num_examples * pack_size) if num_examples else 0.0,
+        # パッキングした場合の、パディング以外のトークンの割合
+        'packed_efficiency': total_tokens / (num_packs * pack_size) if num_packs else 0.0,
+        # 1シーケンスあたりの平均事例数（同じバッチサイズで1ステップに学習する事例数の倍率）
+        'examples_per_sequence': num_examples / num_packs if num_packs else 0.0,
+    }
+
+# コマンドライン引数の設定
+def attach_args():
+    """
+    コマンドライン引数を定義する関数。
+
+    戻り値:
+    - 引数を追加したArgumentParserオブジェクト
+    """
+    parser = argparse.ArgumentParser(description="PEFT用データセットの事例を固定長のシーケンスに詰め込みます。")
+    parser.add_argument("input_files", nargs="+", help="入力JSONLファイル（train.jsonlなど）")
+    parser.add_argument("output_file", help="出力ファイルのパス（.npyまたは.jsonl）")
+    parser.add_argument("--tokenizer", required=True,
+                        help="SentencePieceのモデルファイル（.model）、またはHugging Faceトークナイザーのディレクトリ")
+    parser.add_argument("--pack-size", type=int, default=DEFAULT_PACK_SIZE,
+                        help="1シーケンスの長さ（学習時のmax_seq_lengthに合わせる）")
+    parser.add_argument("--add-bos", action="store_true", help="各事例の先頭にBOSを付ける")
+    parser.add_argument("--add-eos", action="store_true", help="各事例の末尾にEOSを付ける")
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count(), help="ワーカープロセス数")
+    parser.add_argument("--index-output", help="各シーケンスに含まれる事例の行番号を書き出すJSONLファイルのパス")
+    return parser
+
+# メイン関数
+def main(args):
+    """
+    パッキングを実行し、パッキング効率を表示する。
+
+    パラメータ:
+    - args: コマンドライン引数
+    """
+    stats = pack_files(args.input_files, args.output_file, args.tokenizer, args.pack_size,
+                       args.add_bos, args.add_eos, args.num_workers, args.index_output)
+    print(json.dumps(stats, ensure_ascii=False, indent=2))
+    print(f"パディングを除いたトークンの割合: {stats['unpacked_efficiency']:.2%} -> {stats['packed_efficiency']:.2%}"
+          f"（1シーケンスあたり平均{stats['examples_per_sequence']:.2f}事例）")
+
+# スクリプトが直接実行された場合、メイン関数を呼び出す
+if __name__ == "__main__":
+    main(attach_args().parse_args())
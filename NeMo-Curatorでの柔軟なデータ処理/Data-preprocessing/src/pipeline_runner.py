@@ -0,0 +1,364 @@
+'''
+このスクリプトは、前処理の各ステージ（process_data_pro.py、言語識別、重複排除、デコンタミネーション、
+PEFT用データセット作成）をYAMLで宣言したDAGとして実行します。
+
+- 各ステージの入力ファイル、コード、コマンド（パラメータ）の内容ハッシュから指紋を計算し、
+  前回の実行から変化がなく出力も残っているステージはスキップします。
+- ステージ間の依存関係は入力パスと出力パスから自動的に求め、依存関係のないステージは並列に実行します。
+- 実行後にステージごとの実行時間を表示します。
+
+使用例:
+cd /workspace
+
+python src/pipeline_runner.py config/pipeline.yaml --jobs 2
+python src/pipeline_runner.py config/pipeline.yaml --force language_id  # 指定したステージと下流を強制的に再実行
+python src/pipeline_runner.py config/pipeline.yaml --dry-run  # 実行されるステージを確認
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import yaml
+
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+
+# 設定ファイルを読み込む関数
+def load_pipeline(config_path):
+    """
+    パイプラインの設定ファイルを読み込み、変数（vars）を各ステージの文字列に展開する。
+    相対パスは作業ディレクトリ（workdir、省略時はカレントディレクトリ）を基準に絶対パスへ変換する。
+
+    パラメータ:
+    - config_path: 設定ファイルのパス
+
+    戻り値:
+    - 設定内容の辞書（stagesは名前をキーとする辞書）
+    """
+    with open(config_path, 'r', encoding='utf-8') as f:
+        config = yaml.safe_load(f)
+
+    variables = config.get('vars', {})
+    workdir = os.path.abspath(config.get('workdir') or '.')
+
+    def resolve(path):
+        return os.path.normpath(os.path.join(workdir, path))
+
+    def expand(value):
+        if isinstance(value, str):
+            return value.format(**variables)
+        if isinstance(value, list):
+            return [expand(v) for v in value]
+        if isinstance(value, dict):
+            return {k: expand(v) for k, v in value.items()}
+        return value
+
+    stages = {}
+    for name, stage in config['stages'].items():
+        stage = expand(stage)
+        stages[name] = {
+            'cmd': stage['cmd'],
+            'inputs': [resolve(p) for p in stage.get('inputs', [])],
+            'outputs': [resolve(p) for p in stage.get('outputs', [])],
+            'code': [resolve(p) for p in stage.get('code', [])],
+            'params': stage.get('params', {}),
+            'deps': stage.get('deps', []),
+        }
+    config['stages'] = stages
+    config['workdir'] = workdir
+    config['state_file'] = resolve(expand(config.get('state_file', '.pipeline_state.json')))
+    return config
+
+# パスの包含関係を判定する関数
+def paths_overlap(a, b):
+    """
+    2つのパスが同一であるか、一方がもう一方の配下にあるかを判定する。
+    """
+    return a == b or a.startswith(b + os.sep) or b.startswith(a + os.sep)
+
+# ステージ間の依存関係を求める関数
+def resolve_dependencies(stages):
+    """
+    各ステージの入力パスと他のステージの出力パスの包含関係から依存関係を求め、明示的なdepsと合わせる。
+
+    パラメータ:
+    - stages: ステージ名をキーとする辞書
+
+    戻り値:
+    - ステージ名をキー、依存するステージ名の集合を値とする辞書
+    """
+    dependencies = {}
+    for name, stage in stages.items():
+        deps = set(stage['deps'])
+        for other_name, other in stages.items():
+            if other_name == name:
+                continue
+            if any(paths_overlap(i, o) for i in stage['inputs'] for o in other['outputs']):
+                deps.add(other_name)
+        unknown = deps - set(stages)
+        if unknown:
+            raise ValueError(f"ステージ{name}の依存先が存在しません: {sorted(unknown)}")
+        dependencies[name] = deps
+
+    # 循環依存がないことを確認する
+    visited, in_progress = set(), set()
+
+    def visit(name):
+        if name in in_progress:
+            raise ValueError(f"ステージの依存関係が循環しています: {name}")
+        if name not in visited:
+            in_progress.add(name)
+            for dep in dependencies[name]:
+                visit(dep)
+            in_progress.discard(name)
+            visited.add(name)
+
+    for name in stages:
+        visit(name)
+    return dependencies
+
+# 下流のステージをすべて求める関数
+def downstream_stages(names, dependencies):
+    """
+    指定されたステージと、それに依存するすべての下流ステージを求める。
+    """
+    result = set(names)
+    changed = True
+    while changed:
+        changed = False
+        for name, deps in dependencies.items():
+            if name not in result and deps & result:
+                result.add(name)
+                changed = True
+    return result
+
+class ContentHasher:
+    """
+    ファイルとディレクトリの内容ハッシュを計算するクラス。
+    (パス, サイズ, 更新時刻)が変わっていないファイルは前回のハッシュを再利用し、大きなファイルの再計算を避ける。
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache or {}
+
+    def hash_file(self, path):
+        """
+        ファイルの内容のSHA-256を返す。
+        """
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        cached = self.cache.get(path)
+        if cached and cached['stamp'] == stamp:
+            return cached['sha256']
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        self.cache[path] = {'stamp': stamp, 'sha256': digest.hexdigest()}
+        return digest.hexdigest()
+
+    def hash_path(self, path):
+        """
+        ファイルまたはディレクトリ（配下の全ファイルの相対パスと内容）のハッシュを返す。存在しない場合はNone。
+        """
+        if os.path.isfile(path):
+            return self.hash_file(path)
+        if not os.path.isdir(path):
+            return None
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for filename in sorted(files):
+                file_path = os.path.join(root, filename)
+                digest.update(os.path.relpath(file_path, path).encode('utf-8'))
+                digest.update(self.hash_file(file_path).encode('ascii'))
+        return digest.hexdigest()
+
+# ステージの指紋を計算する関数
+def stage_fingerprint(stage, hasher):
+    """
+    ステージのコマンド、パラメータ、コード、入力の内容から指紋を計算する。
+
+    パラメータ:
+    - stage: ステージの設定
+    - hasher: ContentHasherのインスタンス
+
+    戻り値:
+    - 指紋の16進数文字列
+    """
+    digest = hashlib.sha256()
+    digest.update(stage['cmd'].encode('utf-8'))
+    digest.update(json.dumps(stage['params'], sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    for path in stage['code'] + stage['inputs']:
+        digest.update(path.encode('utf-8'))
+        digest.update(str(hasher.hash_path(path)).encode('ascii'))
+    return digest.hexdigest()
+
+# 出力の指紋を計算する関数
+def outputs_fingerprint(stage, hasher):
+    """
+    ステージの出力の内容ハッシュを返す。出力が1つでも存在しない場合はNone。
+    """
+    hashes = [hasher.hash_path(path) for path in stage['outputs']]
+    if any(h is None for h in hashes):
+        return None
+    return hashlib.sha256(''.join(hashes).encode('ascii')).hexdigest()
+
+# ステージのコマンドを実行する関数
+def run_stage(name, stage, workdir):
+    """
+    ステージのコマンドをシェルで実行し、(終了コード, 実行時間)を返す。
+    """
+    for path in stage['outputs']:
+        parent = os.path.dirname(path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+    print(f"[{name}] 開始: {stage['cmd']}", flush=True)
+    t0 = time.time()
+    result = subprocess.run(stage['cmd'], shell=True, cwd=workdir)
+    elapsed = time.time() - t0
+    print(f"[{name}] 終了（終了コード {result.returncode}、{elapsed:.1f}秒）", flush=True)
+    return result.returncode, elapsed
+
+# 状態ファイルを読み込む関数
+def load_state(state_file):
+    """
+    前回までの指紋、実行時間、ファイルハッシュのキャッシュを読み込む。状態ファイルがない場合は空の状態を返す。
+    """
+    if os.path.exists(state_file):
+        with open(state_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return {'stages': {}, 'file_hashes': {}}
+
+# 状態ファイルを書き出す関数
+def save_state(state_file, state):
+    """
+    状態を一時ファイルに書き出してから置き換え、途中で中断しても状態ファイルが壊れないようにする。
+    """
+    tmp_path = state_file + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, state_file)
+
+# パイプラインを実行する関数
+def run_pipeline(config, jobs=1, force=(), dry_run=False):
+    """
+    依存関係に従ってステージを実行する。最新のステージはスキップし、依存関係のないステージは並列に実行する。
+
+    パラメータ:
+    - config: load_pipelineで読み込んだ設定
+    - jobs: 同時に実行するステージ数の上限
+    - force: 強制的に再実行するステージ名（下流のステージも再実行される）
+    - dry_run: Trueの場合、実行せずに各ステージの状態だけを表示する
+
+    戻り値:
+    - ステージ名をキー、{'status', 'seconds'}を値とする実行結果の辞書
+    """
+    stages = config['stages']
+    workdir = config['workdir']
+    state_file = config['state_file']
+    dependencies = resolve_dependencies(stages)
+    unknown = set(force) - set(stages)
+    if unknown:
+        raise ValueError(f"存在しないステージが指定されました: {sorted(unknown)}")
+    forced = downstream_stages(force, dependencies)
+
+    state = load_state(state_file)
+    hasher = ContentHasher(state.get('file_hashes'))
+    results = {}
+    pending = dict(dependencies)
+    running = {}
+
+    def is_up_to_date(name, fingerprint):
+        previous = state['stages'].get(name)
+        return (
+            name not in forced
+            and previous is not None
+            and previous['fingerprint'] == fingerprint
+            and previous['outputs'] == outputs_fingerprint(stages[name], hasher)
+        )
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            # 依存先がすべて完了したステージを処理する
+            for name in [n for n, deps in pending.items() if all(d in results for d in deps)]:
+                del pending[name]
+                if any(results[d]['status'] in ('failed', 'blocked') for d in dependencies[name]):
+                    results[name] = {'status': 'blocked', 'seconds': 0.0}
+                    continue
+                if dry_run:
+                    previous = state['stages'].get(name)
+                    stale = name in forced or previous is None or any(
+                        results[d]['status'] == 'would run' for d in dependencies[name])
+                    if not stale:
+                        stale = not is_up_to_date(name, stage_fingerprint(stages[name], hasher))
+                    results[name] = {'status': 'would run' if stale else 'skipped', 'seconds': 0.0}
+                    continue
+                fingerprint = stage_fingerprint(stages[name], hasher)
+                if is_up_to_date(name, fingerprint):
+                    print(f"[{name}] 最新のためスキップします", flush=True)
+                    results[name] = {'status': 'skipped', 'seconds': 0.0}
+                    continue
+                running[executor.submit(run_stage, name, stages[name], workdir)] = (name, fingerprint)
+
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, fingerprint = running.pop(future)
+                returncode, elapsed = future.result()
+                if returncode == 0:
+                    results[name] = {'status': 'ran', 'seconds': elapsed}
+                    state['stages'][name] = {
+                        'fingerprint': fingerprint,
+                        'outputs': outputs_fingerprint(stages[name], hasher),
+                        'seconds': elapsed,
+                        'finished_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+                    }
+                else:
+                    results[name] = {'status': 'failed', 'seconds': elapsed}
+                    state['stages'].pop(name, None)
+                state['file_hashes'] = hasher.cache
+                save_state(state_file, state)
+
+    return results
+
+# 実行結果を表示する関数
+def print_report(results, total_seconds):
+    """
+    ステージごとの状態と実行時間を表形式で表示する。
+    """
+    width = max([len(name) for name in results] + [5])
+    print(f"\n{'stage'.ljust(width)}  {'status':<10}  {'seconds':>10}")
+    for name, result in results.items():
+        print(f"{name.ljust(width)}  {result['status']:<10}  {result['seconds']:>10.1f}")
+    print(f"{'total'.ljust(width)}  {'':<10}  {total_seconds:>10.1f}")
+
+# コマンドライン引数の設定
+def attach_args():
+    """
+    コマンドライン引数を定義する関数。
+
+    戻り値:
+    - 引数を追加したArgumentParserオブジェクト
+    """
+    parser = argparse.ArgumentParser(description="前処理パイプラインをDAGとして実行します。")
+    parser.add_argument("config", help="パイプラインの設定ファイル（YAML）")
+    parser.add_argument("--jobs", type=int, default=1, help="同時に実行するステージ数の上限")
+    parser.add_argument("--force", nargs="*", default=[], help="強制的に再実行するステージ名")
+    parser.add_argument("--dry-run", action="store_true", help="実行せずに各ステージの状態を表示する")
+    return parser
+
+# メイン関数
+if __name__ == "__main__":
+    args = attach_args().parse_args()
+    config = load_pipeline(args.config)
+    t0 = time.time()
+    results = run_pipeline(config, jobs=args.jobs, force=args.force, dry_run=args.dry_run)
+    print_report(results, time.time() - t0)
+    if any(r['status'] in ('failed', 'blocked') for r in results.values()):
+        raise SystemExit(1)
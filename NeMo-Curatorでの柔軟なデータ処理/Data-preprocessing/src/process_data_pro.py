@@ -1,16 +1,34 @@
 '''
 このスクリプトは、入力されたJSONLファイルのデータを処理し、テキストをクリーニングした後、指定された最大長に従ってテキストを分割します。
 処理済みデータは新しいJSONファイルに出力されます。
+--num-workersを指定すると、入力ファイルを行境界に揃えたバイト範囲のシャードに分割し、プロセスプールで並列に処理します。
 
 使用例:
 python /workspace/src/process_data_pro.py \
     /workspace/data/raw_data/data.jsonl \
     /workspace/data/mydata/split_curator/0_processed_pro/processed_pro.json
+
+並列実行の例（入力順を保持して1ファイルに結合）:
+python /workspace/src/process_data_pro.py \
+    /workspace/data/raw_data/data.jsonl \
+    /workspace/data/mydata/split_curator/0_processed_pro/processed_pro.json \
+    --num-workers 16
+
+並列実行の例（シャードごとのファイルとしてディレクトリに出力）:
+python /workspace/src/process_data_pro.py \
+    /workspace/data/raw_data/data.jsonl \
+    /workspace/data/mydata/split_curator/0_processed_pro \
+    --num-workers 16 --sharded-output
 '''
 
+import argparse
 import json
-import sys
+import os
 import re
+import shutil
+import tempfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
 # テキストをクリーニングする関数
 def clean_text(text):
@@ -103,6 +121,35 @@ def split_text(data, max_length=300):
     
     return result
 
+# 1行分のJSONデータを処理して出力ファイルに書き込む関数
+def process_line(line, outfile, stats):
+    """
+    1行分のJSONデータを読み込み、テキストを分割・クリーニングした後、出力ファイルに書き込む。
+    エラーが発生した場合はメッセージを表示し、statsに件数を記録する。
+
+    パラメータ:
+    - line: 入力JSONLファイルの1行
+    - outfile: 書き込み先のファイルオブジェクト
+    - stats: 処理件数やエラー件数を記録するCounter
+    """
+    stats['lines'] += 1
+    try:
+        # 各行のJSONデータを読み込む
+        data = json.loads(line.strip())
+        # テキストを分割する
+        split_data = split_text(data)
+        # 分割されたデータを出力ファイルに書き込む
+        for item in split_data:
+            json.dump(item, outfile, ensure_ascii=False)
+            outfile.write('\n')
+        stats['records'] += len(split_data)
+    except json.JSONDecodeError:
+        stats['json_decode_errors'] += 1
+        print(f"JSONデコードエラー: {line}")
+    except KeyError as e:
+        stats['missing_keys'] += 1
+        print(f"データにキーがありません: {e}")
+
 # JSONLファイルを処理して出力ファイルに書き込む関数
 def process_jsonl(input_file, output_file):
     """
@@ -111,33 +158,149 @@ def process_jsonl(input_file, output_file):
     パラメータ:
     - input_file: 入力JSONLファイルのパス
     - output_file: 出力ファイルのパス
+
+    戻り値:
+    - 処理件数やエラー件数を記録したCounter
     """
+    stats = Counter()
     with open(input_file, 'r', encoding='utf-8') as infile, \
          open(output_file, 'w', encoding='utf-8') as outfile:
         for line in infile:
-            try:
-                # 各行のJSONデータを読み込む
-                data = json.loads(line.strip())
-                # テキストを分割する
-                split_data = split_text(data)
-                # 分割されたデータを出力ファイルに書き込む
-                for item in split_data:
-                    json.dump(item, outfile, ensure_ascii=False)
-                    outfile.write('\n')
-            except json.JSONDecodeError:
-                print(f"JSONデコードエラー: {line}")
-            except KeyError as e:
-                print(f"データにキーがありません: {e}")
+            process_line(line, outfile, stats)
+    return stats
+
+# 入力ファイルを行境界に揃えたバイト範囲のシャードに分割する関数
+def find_shard_ranges(input_file, num_shards):
+    """
+    入力ファイルをほぼ均等なバイト範囲に分割する。各範囲の開始位置は必ず行の先頭になるように調整する。
+
+    パラメータ:
+    - input_file: 入力JSONLファイルのパス
+    - num_shards: 分割数の目安
+
+    戻り値:
+    - (開始バイト, 終了バイト)のタプルのリスト
+    """
+    file_size = os.path.getsize(input_file)
+    boundaries = [0]
+    with open(input_file, 'rb') as f:
+        for i in range(1, num_shards):
+            position = file_size * i // num_shards
+            if position <= boundaries[-1]:
+                continue
+            # 直前の1バイトから行末まで読み飛ばし、次の行の先頭に揃える
+            f.seek(position - 1)
+            f.readline()
+            position = f.tell()
+            if position >= file_size:
+                break
+            if position > boundaries[-1]:
+                boundaries.append(position)
+    boundaries.append(file_size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+# 1つのシャードを処理する関数（ワーカープロセスで実行される）
+def process_shard(task):
+    """
+    入力ファイルの指定されたバイト範囲を処理し、結果をシャード用の出力ファイルに書き込む。
+
+    パラメータ:
+    - task: (入力ファイルのパス, 開始バイト, 終了バイト, 出力ファイルのパス)のタプル
+
+    戻り値:
+    - (出力ファイルのパス, 処理件数やエラー件数を記録したCounter)のタプル
+    """
+    input_file, start, end, output_file = task
+    stats = Counter()
+    with open(input_file, 'rb') as infile, \
+         open(output_file, 'w', encoding='utf-8') as outfile:
+        infile.seek(start)
+        position = start
+        while position < end:
+            line = infile.readline()
+            if not line:
+                break
+            position += len(line)
+            process_line(line.decode('utf-8'), outfile, stats)
+    return output_file, stats
+
+# JSONLファイルをシャードに分割し、複数プロセスで並列に処理する関数
+def process_jsonl_parallel(input_file, output_file, num_workers, sharded_output=False, shards_per_worker=4):
+    """
+    入力ファイルを行境界に揃えたバイト範囲のシャードに分割し、プロセスプールでクリーニングと分割を並列に行う。
+    sharded_outputがFalseの場合はシャードの結果を入力順に1つのファイルへ結合し、
+    Trueの場合はoutput_fileをディレクトリとしてシャードごとのファイルを書き出す。
+
+    パラメータ:
+    - input_file: 入力JSONLファイルのパス
+    - output_file: 出力ファイルのパス（sharded_outputがTrueの場合は出力ディレクトリ）
+    - num_workers: ワーカープロセス数
+    - sharded_output: シャードごとのファイルとして出力するかどうか
+    - shards_per_worker: 負荷を均等にするための、ワーカー1つあたりのシャード数
+
+    戻り値:
+    - 全ワーカーの処理件数やエラー件数を集計したCounter
+    """
+    shard_ranges = find_shard_ranges(input_file, num_workers * shards_per_worker)
+
+    if sharded_output:
+        os.makedirs(output_file, exist_ok=True)
+        shard_dir = output_file
+    else:
+        # 結合前のシャードは出力先と同じファイルシステム上の一時ディレクトリに書き出す
+        shard_dir = tempfile.mkdtemp(prefix='.shards_', dir=os.path.dirname(os.path.abspath(output_file)))
+
+    tasks = [
+        (input_file, start, end, os.path.join(shard_dir, f"part-{i:05d}.jsonl"))
+        for i, (start, end) in enumerate(shard_ranges)
+    ]
+
+    stats = Counter()
+    try:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            # mapは入力順に結果を返すため、シャードの順序がそのまま入力ファイルの順序になる
+            shard_results = list(executor.map(process_shard, tasks))
+        for _, shard_stats in shard_results:
+            stats.update(shard_stats)
+
+        if not sharded_output:
+            with open(output_file, 'wb') as outfile:
+                for shard_file, _ in shard_results:
+                    with open(shard_file, 'rb') as infile:
+                        shutil.copyfileobj(infile, outfile, 16 * 1024 * 1024)
+    finally:
+        if not sharded_output:
+            shutil.rmtree(shard_dir, ignore_errors=True)
+
+    return stats
+
+# コマンドライン引数の設定
+def attach_args():
+    """
+    コマンドライン引数を定義する関数。
+
+    戻り値:
+    - 引数を追加したArgumentParserオブジェクト
+    """
+    parser = argparse.ArgumentParser(description="JSONLファイルのテキストをクリーニングし、最大長に従って分割します。")
+    parser.add_argument("input_file", help="入力JSONLファイルのパス")
+    parser.add_argument("output_file", help="出力ファイルのパス（--sharded-output指定時は出力ディレクトリ）")
+    parser.add_argument("--num-workers", type=int, default=1,
+                        help="ワーカープロセス数。2以上の場合はシャードに分割して並列に処理する")
+    parser.add_argument("--sharded-output", action="store_true",
+                        help="結果を1ファイルに結合せず、シャードごとのファイルとして出力する")
+    return parser
 
 # メイン関数
 if __name__ == "__main__":
-    # コマンドライン引数の数をチェック
-    if len(sys.argv) != 3:
-        print("使用方法: python process_data_pro.py <input_file> <output_file>")
-        sys.exit(1)
-    
-    input_file = sys.argv[1]
-    output_file = sys.argv[2]
+    args = attach_args().parse_args()
+
     # JSONLデータの処理を実行
-    process_jsonl(input_file, output_file)
-    print(f"処理完了。出力ファイル: {output_file}")
+    if args.num_workers > 1 or args.sharded_output:
+        stats = process_jsonl_parallel(args.input_file, args.output_file, args.num_workers,
+                                       sharded_output=args.sharded_output)
+    else:
+        stats = process_jsonl(args.input_file, args.output_file)
+    print(f"処理行数: {stats['lines']}, 出力レコード数: {stats['records']}, "
+          f"JSONデコードエラー: {stats['json_decode_errors']}, キー欠落: {stats['missing_keys']}")
+    print(f"処理完了。出力ファイル: {args.output_file}")
@@ -0,0 +1,249 @@
+'''
+このスクリプトは、nemo_peft_*スクリプトで作成したtrain.jsonl / valid.jsonlの'input'と'output'をトークナイズし、
+トークン長の分布（ヒストグラム、パーセンタイル）と、候補のmax_seq_lengthごとに切り詰められるレコードの割合を表示します。
+max_seq_lengthやバッチサイズを決める際の目安として使用します。
+
+トークナイズはプロセスプールで並列に行い、トークナイザーは各ワーカーで1回だけ読み込みます。
+同じ文字列（定型のプロンプトなど）のトークン数はワーカーごとにキャッシュされます。
+
+トークナイザーには、ローカルのHugging Faceトークナイザーのディレクトリ、またはSentencePieceのモデルファイル（.model）を指定します。
+
+使用例:
+python src/profile_token_lengths.py \
+    /workspace/data/nemo_peft_pro_processed_data_split_curator/train.jsonl \
+    /workspace/data/nemo_peft_pro_processed_data_split_curator/valid.jsonl \
+    --tokenizer /workspace/models/ELYZA-japanese-Llama-2-7b \
+    --max-seq-lengths 512 1024 2048 4096 \
+    --num-workers 16
+'''
+
+import argparse
+import json
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from jsonl_io import iter_lines, loads
+
+DEFAULT_MAX_SEQ_LENGTHS = [256, 512, 1024, 2048, 4096]
+DEFAULT_PERCENTILES = [50, 75, 90, 95, 99, 99.9]
+CHUNK_SIZE = 2000  # ワーカーに一度に渡す行数
+CACHE_SIZE = 100000  # ワーカーごとにキャッシュする文字列の数
+
+_tokenizer = None
+
+# トークナイザーを読み込む関数
+def load_tokenizer(tokenizer_path):
+    """
+    ローカルのトークナイザーを読み込み、文字列をトークンIDのリストに変換する関数を返す。
+
+    パラメータ:
+    - tokenizer_path: SentencePieceのモデルファイル（.model）、またはHugging Faceトークナイザーのディレクトリ
+
+    戻り値:
+    - 文字列を受け取り、トークンIDのリストを返す関数
+    """
+    if tokenizer_path.endswith('.model'):
+        import sentencepiece as spm
+        processor = spm.SentencePieceProcessor(model_file=tokenizer_path)
+        return processor.encode
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, local_files_only=True)
+    return lambda text: tokenizer.encode(text, add_special_tokens=False)
+
+# ワーカープロセスの初期化関数
+def init_worker(tokenizer_path):
+    """
+    ワーカープロセスごとにトークナイザーを1回だけ読み込む。
+    """
+    global _tokenizer
+    _tokenizer = load_tokenizer(tokenizer_path)
+    count_tokens.cache_clear()
+
+# 文字列のトークン数を数える関数（ワーカーごとにキャッシュ）
+@lru_cache(maxsize=CACHE_SIZE)
+def count_tokens(text):
+    """
+    文字列をトークナイズしてトークン数を返す。同じ文字列の結果はキャッシュから返す。
+    """
+    return len(_tokenizer(text))
+
+# 複数行をまとめてトークナイズする関数（ワーカープロセスで実行される）
+def tokenize_chunk(lines):
+    """
+    JSONLの複数行をデコードし、'input'と'output'のトークン数を数える。
+
+    パラメータ:
+    - lines: JSONLの行（バイト列）のリスト
+
+    戻り値:
+    - ('input'のトークン数の配列, 'output'のトークン数の配列)のタプル
+    """
+    input_lengths = array('I')
+    output_lengths = array('I')
+    for line in lines:
+        record = loads(line)
+        input_lengths.append(count_tokens(record['input']))
+        output_lengths.append(count_tokens(record['output']))
+    return input_lengths, output_lengths
+
+# 行をまとめてチャンクにするジェネレーター
+def iter_chunks(input_files, chunk_size=CHUNK_SIZE):
+    """
+    入力ファイルの行をchunk_size行ずつのリストにまとめて返す。
+    """
+    chunk = []
+    for input_file in input_files:
+        for line in iter_lines(input_file):
+            chunk.append(line)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+# 入力ファイルのトークン数を並列に数える関数
+def collect_lengths(input_files, tokenizer_path, num_workers):
+    """
+    入力ファイルのすべてのレコードについて'input'と'output'のトークン数をプロセスプールで数える。
+
+    パラメータ:
+    - input_files: 入力JSONLファイルのパスのリスト
+    - tokenizer_path: トークナイザーのパス
+    - num_workers: ワーカープロセス数
+
+    戻り値:
+    - ('input'のトークン数の配列, 'output'のトークン数の配列)のタプル（入力順）
+    """
+    input_lengths = array('I')
+    output_lengths = array('I')
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker,
+                             initargs=(tokenizer_path,)) as executor:
+        for chunk_inputs, chunk_outputs in executor.map(tokenize_chunk, iter_chunks(input_files)):
+            input_lengths.extend(chunk_inputs)
+            output_lengths.extend(chunk_outputs)
+    return input_lengths, output_lengths
+
+# パーセンタイルを計算する関数
+def percentile(sorted_values, q):
+    """
+    昇順に並んだ値から線形補間でqパーセンタイルを求める。
+    """
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+# トークン長の分布を要約する関数
+def summarize(lengths, max_seq_lengths, percentiles=DEFAULT_PERCENTILES):
+    """
+    トークン長の統計量と、候補の長さごとの切り詰め率・パディング率を計算する。
+
+    パラメータ:
+    - lengths: トークン長のシーケンス
+    - max_seq_lengths: 候補のmax_seq_lengthのリスト
+    - percentiles: 計算するパーセンタイル
+
+    戻り値:
+    - 統計量の辞書
+    """
+    values = sorted(lengths)
+    total_tokens = sum(values)
+    summary = {
+        'count': len(values),
+        'mean': total_tokens / len(values) if values else 0.0,
+        'min': values[0] if values else 0,
+        'max': values[-1] if values else 0,
+        'percentiles': {str(q): percentile(values, q) for q in percentiles},
+        'max_seq_length': {},
+    }
+    for max_length in max_seq_lengths:
+        truncated = sum(1 for v in values if v > max_length)
+        kept_tokens = sum(min(v, max_length) for v in values)
+        summary['max_seq_length'][str(max_length)] = {
+            # max_lengthを超えて切り詰められるレコードの割合
+            'truncated_ratio': truncated / len(values) if values else 0.0,
+            # 切り詰めで失われるトークンの割合
+            'truncated_token_ratio': 1 - kept_tokens / total_tokens if total_tokens else 0.0,
+            # max_lengthまでパディングした場合に、パディングが占める割合
+            'padding_ratio': 1 - kept_tokens / (max_length * len(values)) if values else 0.0,
+        }
+    return summary
+
+# ヒストグラムを作成する関数
+def histogram(lengths, bin_width, max_bins=40):
+    """
+    トークン長をbin_width刻みで集計する。max_bins以降は最後のビンにまとめる。
+
+    戻り値:
+    - (ビンの下限, 件数)のタプルのリスト
+    """
+    counts = {}
+    for value in lengths:
+        bin_index = min(value // bin_width, max_bins - 1)
+        counts[bin_index] = counts.get(bin_index, 0) + 1
+    return [(i * bin_width, counts[i]) for i in sorted(counts)]
+
+# 結果を表示する関数
+def print_report(name, lengths, summary, bin_width):
+    """
+    統計量、パーセンタイル、候補の長さごとの切り詰め率、ヒストグラムを表示する。
+    """
+    print(f"\n=== {name} (n={summary['count']}) ===")
+    print(f"mean={summary['mean']:.1f}  min={summary['min']}  max={summary['max']}")
+    print("  ".join(f"p{q}={v:.0f}" for q, v in summary['percentiles'].items()))
+    print(f"{'max_seq_length':>14}  {'truncated':>10}  {'lost tokens':>11}  {'padding':>8}")
+    for max_length, stats in summary['max_seq_length'].items():
+        print(f"{max_length:>14}  {stats['truncated_ratio']:>10.2%}  "
+              f"{stats['truncated_token_ratio']:>11.2%}  {stats['padding_ratio']:>8.2%}")
+    bins = histogram(lengths, bin_width)
+    peak = max((count for _, count in bins), default=1)
+    for lower, count in bins:
+        bar = '#' * max(1, round(count / peak * 50))
+        print(f"{lower:>7}-  {count:>9}  {bar}")
+
+# コマンドライン引数の設定
+def attach_args():
+    """
+    コマンドライン引数を定義する関数。
+
+    戻り値:
+    - 引数を追加したArgumentParserオブジェクト
+    """
+    parser = argparse.ArgumentParser(description="PEFT用データセットのトークン長の分布を調べます。")
+    parser.add_argument("input_files", nargs="+", help="入力JSONLファイル（train.jsonl、valid.jsonlなど）")
+    parser.add_argument("--tokenizer", required=True,
+                        help="SentencePieceのモデルファイル（.model）、またはHugging Faceトークナイザーのディレクトリ")
+    parser.add_argument("--max-seq-lengths", type=int, nargs="+", default=DEFAULT_MAX_SEQ_LENGTHS,
+                        help="切り詰め率を計算する候補のmax_seq_length")
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count(), help="ワーカープロセス数")
+    parser.add_argument("--bin-width", type=int, default=128, help="ヒストグラムのビンの幅（トークン数）")
+    parser.add_argument("--json-output", help="統計量をJSONとして保存するファイルのパス")
+    return parser
+
+# メイン関数
+def main(args):
+    """
+    トークン長を数え、'input'、'output'、両者の合計（input + output）の分布を表示する。
+
+    パラメータ:
+    - args: コマンドライン引数
+    """
+    input_lengths, output_lengths = collect_lengths(args.input_files, args.tokenizer, args.num_workers)
+    total_lengths = array('I', (i + o for i, o in zip(input_lengths, output_lengths)))
+
+    report = {}
+    for name, lengths in (('input', input_lengths), ('output', output_lengths), ('input+output', total_lengths)):
+        report[name] = summarize(lengths, args.max_seq_lengths)
+        print_report(name, lengths, report[name], args.bin_width)
+
+    if args.json_output:
+        with open(args.json_output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+# スクリプトが直接実行された場合、メイン関数を呼び出す
+if __name__ == "__main__":
+    main(attach_args().parse_args())